@@ -0,0 +1,464 @@
+"""
+asyncio backend of the proxy engine: every client connection is a task on one event
+loop thread instead of an OS thread, so idle keep-alive tunnels cost a few KiB each.
+Routing is the threaded handler's, inherited from ProxyRequestHandler: same request
+parsing, rule matching, SNI routing, hostname resolution and upstream proxies.
+Only the blocking parts that have no asyncio counterpart here (proxy handshakes,
+PySocks, DNS lookups, PAC builds) run on a small thread pool while connecting.
+"""
+import asyncio
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+from .http_proxy import (HTTPParseError, MAX_HEAD_SIZE, find_head_end, parse_request_head, parse_response_head,
+                         request_body, request_target, response_body, rewrite_request_head)
+from .pac import PAC_CONTENT_TYPE, PAC_PATHS
+from .proxy_engine import (BUFFER_SIZE, HTTP_IDLE_TIMEOUT, HTTP_IDLE_UPSTREAMS, HTTP_UPSTREAM_TIMEOUT, SNI_PEEK_PORTS,
+                           SNI_PEEK_TIMEOUT, SOCKS_ERRORS, ProxyRequestHandler, client_hello_length, normalize_host, parse_sni)
+
+CONNECT_WORKERS = 32 # Threads for blocking connection setup, relaying never uses them
+INITIAL_READ_TIMEOUT = 5.0 # Same as the threaded handler's first select()
+DIRECT_CONNECT_TIMEOUT = 10
+LISTEN_BACKLOG = 1024
+
+
+def raise_fd_limit() -> int | None:
+    """Raises the soft open-files limit to the hard one (each tunnel holds two sockets); returns the new limit."""
+    if resource is None:
+        return None
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            return hard
+        return soft
+    except (ValueError, OSError):
+        return None
+
+
+class AsyncProxyConnection(ProxyRequestHandler):
+    """
+    One client connection served on the event loop. Subclasses ProxyRequestHandler for
+    its routing helpers; socketserver's constructor (which would run handle()) is not used.
+    """
+
+    def __init__(self, engine, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, executor):
+        self.engine = engine
+        self.reader = reader
+        self.writer = writer
+        self.executor = executor
+        self.client_address = writer.get_extra_info("peername")
+        self.bytes_relayed = 0
+        self.tunnel_established = False
+        self.response_started = False
+
+    async def _blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def serve(self):
+        """Processes a client connection, following ProxyRequestHandler.handle() step by step."""
+        target_host = "Unknown"
+        upstream_writer = None
+        is_connect = False
+        matched_rule_id = None
+        target_proxy_info = None
+        try:
+            # 1. Receive initial data
+            try:
+                initial_data = await asyncio.wait_for(self.reader.read(BUFFER_SIZE), INITIAL_READ_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"[Handler {self.client_address}] No data received within timeout.")
+                return
+            if not initial_data:
+                return
+            if await self._serve_pac_async(initial_data):
+                return
+
+            # 2. Plain HTTP is read, routed and forwarded request by request; parse the CONNECT target
+            if not self._is_connect(initial_data):
+                await self._serve_http_async(initial_data)
+                return
+            target_host, target_port, is_connect, remaining_data = self._parse_request(initial_data)
+            if target_host:
+                target_host = normalize_host(target_host)
+            if not target_host or not target_port:
+                print(f"[Handler {self.client_address}] Failed to parse target.")
+                self._send_error_response(400, "Bad Request")
+                return
+
+            # 3. Match against the rules
+            server_name = None
+            if is_connect and self.engine.sni_routing and target_port in SNI_PEEK_PORTS and self._is_ip_address(target_host):
+                self.writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+                self.tunnel_established = True
+                server_name, remaining_data = await self._peek_server_name_async()
+            matched_proxy_id, matched_rule_id, connect_host, resolved_addresses = \
+                await self._route_async(target_host, target_port, server_name)
+
+            if matched_proxy_id == "__BLOCK__":
+                print(f"[Handler {self.client_address}] BLOCK rule matched for '{target_host}:{target_port}'. Blocking connection.")
+                self._send_error_response(403, "Blocked by Rule")
+                return
+            target_proxy_info = self.engine._proxies.get(matched_proxy_id) if matched_proxy_id else None
+            route = f"via proxy '{target_proxy_info.get('name', matched_proxy_id)}'" if target_proxy_info else "directly"
+            print(f"[Handler {self.client_address}] {'CONNECT ' if is_connect else ''}{target_host}:{target_port} "
+                  f"routed {route} (Rule: {matched_rule_id}).")
+
+            # 4. Establish the upstream connection
+            upstream_reader, upstream_writer = await self._open_upstream_async(
+                target_proxy_info, matched_proxy_id, target_host, connect_host, target_port, resolved_addresses)
+
+            # 5. Confirm the tunnel, or forward the ClientHello read for its server name
+            if not self.tunnel_established:
+                self.writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+            elif remaining_data:
+                upstream_writer.write(remaining_data)
+                self.bytes_relayed += len(remaining_data)
+
+            # 6. Relay data bidirectionally
+            await self._relay_async(upstream_reader, upstream_writer)
+
+        except asyncio.CancelledError:
+            raise # Engine stopping
+        except ConnectionRefusedError as e:
+            print(f"[Handler {self.client_address}] Connection Refused for '{target_host}': {e}")
+            if not is_connect or upstream_writer is None:
+                self._send_error_response(502, "Connection Refused")
+        except (socket.timeout, asyncio.TimeoutError):
+            print(f"[Handler {self.client_address}] Timeout during connection/relay for '{target_host}'")
+            if not is_connect or upstream_writer is None:
+                self._send_error_response(504, "Gateway Timeout")
+        except (NotImplementedError, *SOCKS_ERRORS) as e:
+            proxy_name_err = target_proxy_info.get('name', 'Unknown Proxy') if target_proxy_info else 'N/A'
+            print(f"[Handler {self.client_address}] Proxy Error for '{target_host}' via '{proxy_name_err}': {e}")
+            if not is_connect or upstream_writer is None:
+                self._send_error_response(502, "Bad Gateway (Proxy Error)")
+        except socket.gaierror as e:
+            print(f"[Handler {self.client_address}] DNS Error for '{target_host}': {e}")
+            if not is_connect or upstream_writer is None:
+                self._send_error_response(502, "Bad Gateway (DNS Error)")
+        except Exception as e:
+            print(f"[Handler {self.client_address}] Unexpected error handling connection for '{target_host}': {e}")
+            if not is_connect or upstream_writer is None:
+                self._send_error_response(500, "Internal Server Error")
+        finally:
+            if matched_rule_id and self.bytes_relayed:
+                self.engine.rule_stats.record(matched_rule_id, hits=0, byte_count=self.bytes_relayed)
+            if upstream_writer is not None:
+                upstream_writer.close()
+            self.writer.close()
+
+    async def _route_async(self, host: str, port: int, server_name: str | None = None) -> tuple:
+        """Async counterpart of ProxyRequestHandler._route; only hostname resolution leaves the loop."""
+        matcher = self.engine.rule_matcher
+        proxy_id = rule_id = None
+        if server_name:
+            proxy_id, rule_id = matcher.match(server_name, port)
+        if rule_id is None:
+            proxy_id, rule_id = matcher.match(host, port)
+        connect_host = host
+        resolved_addresses = None
+        if rule_id is None and self.engine.resolve_hostnames and matcher.has_ip_rules():
+            proxy_id, rule_id, resolved_addresses, matched_address = await self._blocking(self._match_resolved, host, port)
+            if matched_address is not None:
+                connect_host = matched_address
+        return proxy_id, rule_id, connect_host, resolved_addresses
+
+    async def _open_upstream_async(self, proxy_info: dict | None, proxy_id: str | None, host: str, connect_host: str,
+                                   port: int, addresses: list | None = None) -> tuple:
+        """Async counterpart of ProxyRequestHandler._open_upstream, returning (reader, writer)."""
+        if proxy_info:
+            sock = await self._blocking(self._connect_via_proxy, proxy_info, proxy_id, connect_host, port)
+            if sock is None:
+                raise ConnectionRefusedError(f"Invalid proxy configuration for '{proxy_id}'")
+            sock.setblocking(False)
+            return await asyncio.open_connection(sock=sock)
+        return await self._connect_directly_async(host, port, addresses)
+
+    async def _serve_http_async(self, data: bytes):
+        """Async counterpart of ProxyRequestHandler._serve_http: plain-HTTP requests routed one by one."""
+        buffer = data
+        idle_upstreams = {} # {(proxy_id, host, port): (reader, writer)}, oldest first
+        upstream = None
+        rule_id = None
+        try:
+            while True:
+                self.response_started = False
+                try:
+                    head, buffer = await self._read_head_async(self.reader, buffer, parse_request_head, HTTP_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return
+                except HTTPParseError as e:
+                    print(f"[Handler {self.client_address}] Invalid request: {e}")
+                    self._send_error_response(400, "Bad Request")
+                    return
+                if head is None:
+                    return
+                host, port, origin_target = request_target(head)
+                host = normalize_host(host) if host else None
+                if not host or not port or head.method == "CONNECT":
+                    print(f"[Handler {self.client_address}] Failed to parse target of '{head.method} {head.target[:80]}'.")
+                    self._send_error_response(400, "Bad Request")
+                    return
+                try:
+                    body = request_body(head)
+                except HTTPParseError as e:
+                    print(f"[Handler {self.client_address}] Invalid request: {e}")
+                    self._send_error_response(400, "Bad Request")
+                    return
+
+                proxy_id, rule_id, connect_host, addresses = await self._route_async(host, port)
+                if proxy_id == "__BLOCK__":
+                    print(f"[Handler {self.client_address}] BLOCK rule matched for '{host}:{port}'. Blocking request.")
+                    self._send_error_response(403, "Blocked by Rule")
+                    return
+                proxy_info = self.engine._proxies.get(proxy_id) if proxy_id else None
+                route = f"via proxy '{proxy_info.get('name', proxy_id)}'" if proxy_info else "directly"
+                print(f"[Handler {self.client_address}] {head.method} {host}:{port}{origin_target[:80]} routed {route} (Rule: {rule_id}).")
+
+                key = (proxy_id if proxy_info else None, connect_host, port)
+                upstream = idle_upstreams.pop(key, None)
+                if upstream is not None and (upstream[0].at_eof() or upstream[1].is_closing()):
+                    upstream[1].close()
+                    upstream = None
+                if upstream is None:
+                    upstream = await self._open_upstream_async(proxy_info, proxy_id, host, connect_host, port, addresses)
+                upstream_reader, upstream_writer = upstream
+                upstream_buffer = b""
+
+                request_bytes = rewrite_request_head(head, origin_target)
+                upstream_writer.write(request_bytes)
+                self.bytes_relayed += len(request_bytes)
+                expect_continue = "100-continue" in head.tokens("expect")
+                if not expect_continue:
+                    buffer, count = await self._forward_body_async(self.reader, upstream_writer, body, buffer, HTTP_IDLE_TIMEOUT)
+                    self.bytes_relayed += count
+
+                while True:
+                    response, upstream_buffer = await self._read_head_async(
+                        upstream_reader, upstream_buffer, parse_response_head, HTTP_UPSTREAM_TIMEOUT)
+                    if response is None:
+                        raise ConnectionResetError("Server closed the connection without responding")
+                    self.response_started = True
+                    self.writer.write(response.raw)
+                    self.bytes_relayed += len(response.raw)
+                    if response.status >= 200 or response.status == 101:
+                        break
+                    if response.status == 100 and expect_continue and not body.done:
+                        buffer, count = await self._forward_body_async(self.reader, upstream_writer, body, buffer, HTTP_IDLE_TIMEOUT)
+                        self.bytes_relayed += count
+                        self.response_started = False
+                if response.status == 101:
+                    if buffer:
+                        upstream_writer.write(buffer)
+                    if upstream_buffer:
+                        self.writer.write(upstream_buffer)
+                    await self._relay_async(upstream_reader, upstream_writer)
+                    return
+                response_framer = response_body(response, head.method)
+                upstream_buffer, count = await self._forward_body_async(
+                    upstream_reader, self.writer, response_framer, upstream_buffer, HTTP_UPSTREAM_TIMEOUT)
+                self.bytes_relayed += count
+                self._record_bytes(rule_id)
+
+                if not response.keep_alive() or response_framer.kind == response_framer.UNTIL_CLOSE:
+                    return
+                if not head.keep_alive() or not body.done:
+                    return
+                if upstream_buffer:
+                    upstream_writer.close()
+                else:
+                    idle_upstreams[key] = upstream
+                    if len(idle_upstreams) > HTTP_IDLE_UPSTREAMS:
+                        idle_upstreams.pop(next(iter(idle_upstreams)))[1].close()
+                upstream = None
+        finally:
+            self._record_bytes(rule_id)
+            if upstream is not None:
+                upstream[1].close()
+            for _reader, idle_writer in idle_upstreams.values():
+                idle_writer.close()
+
+    @staticmethod
+    async def _read_head_async(reader: asyncio.StreamReader, buffer: bytes, parse, timeout: float) -> tuple:
+        """Async counterpart of ProxyRequestHandler._read_head."""
+        while (end := find_head_end(buffer)) < 0:
+            if len(buffer) > MAX_HEAD_SIZE:
+                raise HTTPParseError("Header section too large")
+            chunk = await asyncio.wait_for(reader.read(BUFFER_SIZE), timeout)
+            if not chunk:
+                if buffer.strip():
+                    raise HTTPParseError("Connection closed in the middle of a header section")
+                return None, b""
+            buffer += chunk
+        return parse(buffer[:end]), buffer[end:]
+
+    @staticmethod
+    async def _forward_body_async(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, framer, buffer: bytes,
+                                  timeout: float) -> tuple[bytes, int]:
+        """Async counterpart of ProxyRequestHandler._forward_body; drain() keeps buffering bounded."""
+        count = 0
+        while True:
+            if buffer:
+                length = framer.feed(buffer)
+                if length:
+                    writer.write(buffer[:length] if length < len(buffer) else buffer)
+                    count += length
+                    await writer.drain()
+                buffer = buffer[length:]
+            if framer.done:
+                return buffer, count
+            buffer = await asyncio.wait_for(reader.read(BUFFER_SIZE), timeout)
+            if not buffer:
+                framer.finish()
+                return b"", count
+
+    async def _serve_pac_async(self, data: bytes) -> bool:
+        """Async counterpart of ProxyRequestHandler._serve_pac."""
+        request_line = data.split(b"\r\n", 1)[0].split()
+        if len(request_line) < 2 or request_line[0] not in (b"GET", b"HEAD"):
+            return False
+        if request_line[1].split(b"?", 1)[0].decode("ascii", errors="ignore") not in PAC_PATHS:
+            return False
+        script = await self._blocking(self.engine.pac_script, self.writer.get_extra_info("sockname")[0])
+        body = script.encode("utf-8")
+        header = (f"HTTP/1.1 200 OK\r\nContent-Type: {PAC_CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n"
+                  "Cache-Control: no-cache\r\nConnection: close\r\n\r\n").encode("ascii")
+        self.writer.write(header if request_line[0] == b"HEAD" else header + body)
+        await self.writer.drain()
+        return True
+
+    async def _peek_server_name_async(self) -> tuple[str | None, bytes]:
+        """Async counterpart of ProxyRequestHandler._peek_server_name."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SNI_PEEK_TIMEOUT
+        data = b""
+        try:
+            while True:
+                chunk = await asyncio.wait_for(self.reader.read(BUFFER_SIZE), max(0.0, deadline - loop.time()))
+                if not chunk:
+                    break
+                data += chunk
+                needed = client_hello_length(data)
+                if needed is None or len(data) >= needed:
+                    break
+        except asyncio.TimeoutError:
+            print(f"[Handler {self.client_address}] No complete ClientHello within {SNI_PEEK_TIMEOUT}s.")
+        return parse_sni(data), data
+
+    async def _connect_directly_async(self, host: str, port: int, addresses: list | None = None) -> tuple:
+        """Async counterpart of ProxyRequestHandler._connect_directly: (reader, writer) of the first address that answers."""
+        if addresses is None:
+            addresses = await self._blocking(self.engine.dns_cache.resolve, host, port)
+        last_error = None
+        for _family, sockaddr in addresses:
+            try:
+                return await asyncio.wait_for(asyncio.open_connection(sockaddr[0], sockaddr[1]), DIRECT_CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                last_error = e
+        raise last_error or OSError(f"No addresses for {host}")
+
+    async def _relay_async(self, upstream_reader: asyncio.StreamReader, upstream_writer: asyncio.StreamWriter):
+        """
+        Copies both directions until either side closes, like _relay_data. drain() holds
+        a direction back while the other end is slow, so buffering stays bounded per tunnel.
+        """
+        async def pump(reader, writer):
+            while True:
+                data = await reader.read(BUFFER_SIZE)
+                if not data:
+                    return
+                writer.write(data)
+                self.bytes_relayed += len(data)
+                await writer.drain()
+
+        tasks = [asyncio.ensure_future(pump(self.reader, upstream_writer)),
+                 asyncio.ensure_future(pump(upstream_reader, self.writer))]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, OSError):
+                print(f"[Relay {self.client_address}] Socket error during relay: {result}")
+
+    def _send_error_response(self, code: int, message: str):
+        """Queues a basic HTTP error response; it is flushed when the connection closes."""
+        if self.tunnel_established or self.response_started or self.writer.is_closing():
+            return
+        self.writer.write(f"HTTP/1.1 {code} {message}\r\nConnection: close\r\nContent-Length: 0\r\n\r\n".encode())
+
+
+class AsyncProxyServer:
+    """
+    Event loop server with the socketserver interface ProxyEngine drives: the listening
+    socket is bound by the constructor, serve_forever() runs the loop (on the engine's
+    server thread) and shutdown() stops it from another thread.
+    """
+
+    def __init__(self, server_address: tuple, engine):
+        self.engine = engine
+        self.loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(CONNECT_WORKERS, thread_name_prefix="proxy-connect")
+        self._stopped = threading.Event()
+        fd_limit = raise_fd_limit()
+        if fd_limit:
+            print(f"[AsyncServer] Open file limit: {fd_limit} (about {fd_limit // 2} tunnels).")
+        host, port = server_address
+        try:
+            self._server = self.loop.run_until_complete(asyncio.start_server(
+                self._on_client, host or None, port, reuse_address=True, backlog=LISTEN_BACKLOG))
+        except Exception:
+            self.loop.close()
+            self._executor.shutdown(wait=False)
+            raise
+        self.active_connections = 0
+
+    async def _on_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.active_connections += 1
+        try:
+            await AsyncProxyConnection(self.engine, reader, writer, self._executor).serve()
+        except asyncio.CancelledError:
+            pass # Engine stopping; start_server() would log the cancellation as an error
+        finally:
+            self.active_connections -= 1
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        finally:
+            self.loop.close()
+            self._executor.shutdown(wait=False)
+            self._stopped.set()
+
+    def _stop(self):
+        self._server.close()
+        self.loop.stop()
+
+    def shutdown(self):
+        """Stops serve_forever() and waits until every connection task is cancelled."""
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self._stop)
+        self._stopped.wait(5)
+
+    def server_close(self):
+        """Closes the listening socket (done by shutdown() already if the loop was running)."""
+        if not self.loop.is_closed() and not self.loop.is_running():
+            self._server.close()
+            self.loop.close()
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,65 @@
+import math
+import zlib
+
+
+class BloomFilter:
+    """
+    Blocked Bloom filter over byte strings: every key sets hash_count bits inside a
+    single 64-bit word, so a membership test is two CRC-32s, one word read and one mask
+    compare. Answers "definitely absent" or "maybe present"; hashing is stable across
+    processes so the bit array can be persisted (see rule_index) and mapped back in.
+    """
+
+    MAX_HASHES = 5 # Bit positions taken from the second hash, 6 bits each
+
+    def __init__(self, word_count: int, hash_count: int, bits=None, key_count: int = 0):
+        self.word_count = word_count
+        self.hash_count = hash_count
+        self.key_count = key_count # Keys added, for the false positive estimate
+        self.bits = bits if bits is not None else bytearray(word_count * 8)
+        self._words = memoryview(self.bits).cast("Q") # Native order; persisted filters are little-endian only
+
+    @classmethod
+    def for_capacity(cls, key_count: int, fp_rate: float = 0.01) -> "BloomFilter":
+        """Sizes a filter for key_count keys at roughly the given false positive rate."""
+        key_count = max(1, key_count)
+        # Classic sizing plus ~25% for the uneven load of single-word blocks
+        bit_count = -key_count * math.log(fp_rate) / (math.log(2) ** 2) * 1.25
+        hash_count = min(cls.MAX_HASHES, max(1, round(bit_count / key_count * math.log(2))))
+        return cls(max(1, math.ceil(bit_count / 64)), hash_count)
+
+    def _mask(self, g: int) -> int:
+        mask = 0
+        for _ in range(self.hash_count):
+            mask |= 1 << (g & 63)
+            g >>= 6
+        return mask
+
+    def add(self, key: bytes):
+        word = (zlib.crc32(key) * self.word_count) >> 32
+        self._words[word] |= self._mask(zlib.crc32(key[::-1])) # Reversed key: a second, independent CRC
+        self.key_count += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        word = self._words[(zlib.crc32(key) * self.word_count) >> 32]
+        g = zlib.crc32(key[::-1])
+        if self.hash_count == self.MAX_HASHES: # Unrolled for the usual case, this is the hot path
+            mask = (1 << (g & 63)) | (1 << (g >> 6 & 63)) | (1 << (g >> 12 & 63)) | (1 << (g >> 18 & 63)) | (1 << (g >> 24 & 63))
+        else:
+            mask = self._mask(g)
+        return word & mask == mask
+
+    def size_bytes(self) -> int:
+        return len(self.bits)
+
+    def false_positive_rate(self) -> float:
+        """Expected false positive rate for the keys added so far."""
+        # Keys per word are ~Poisson(load); a word holding i keys has about
+        # 64 * (1 - (1 - 1/64) ** (k * i)) bits set.
+        load = self.key_count / self.word_count
+        k = self.hash_count
+        rate, probability = 0.0, math.exp(-load)
+        for i in range(int(load * 4) + 30):
+            rate += probability * (1 - (1 - 1 / 64) ** (k * i)) ** k
+            probability *= load / (i + 1)
+        return rate
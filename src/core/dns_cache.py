@@ -0,0 +1,83 @@
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+
+class DNSCache:
+    """
+    Resolver cache shared by the handler threads: one getaddrinfo() per host until its
+    answer expires, and threads asking for a host that is being resolved wait for that
+    answer instead of querying again. The stdlib resolver does not report record TTLs,
+    so answers are kept for a fixed ttl (failures for negative_ttl), short enough not to
+    outlive typical DNS TTLs by much.
+    """
+
+    def __init__(self, ttl: float = 60.0, negative_ttl: float = 5.0, max_size: int = 1024):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict() # {host: (expires, [(family, sockaddr)] or the resolver error)}
+        self._pending = {}            # {host: threading.Event} for lookups in flight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host: str, port: int) -> list:
+        """
+        Returns the addresses of host as [(family, sockaddr)] with port filled in, in
+        resolver order. Raises socket.gaierror (or the resolver's error) if it fails.
+        """
+        key = host.lower()
+        while True:
+            with self._lock:
+                item = self._entries.get(key)
+                if item is not None and item[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._with_port(item[1], port)
+                pending = self._pending.get(key)
+                if pending is None:
+                    pending = self._pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+            pending.wait() # Another thread is resolving this host, use its answer
+
+        result, ttl = None, self.negative_ttl
+        try:
+            result = [(family, sockaddr) for family, _type, _proto, _name, sockaddr in
+                      socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)]
+            ttl = self.ttl
+        except (OSError, UnicodeError) as e:
+            result = e
+        finally:
+            with self._lock:
+                if result is not None:
+                    self._entries[key] = (time.monotonic() + ttl, result)
+                    self._entries.move_to_end(key)
+                    if len(self._entries) > self.max_size:
+                        self._entries.popitem(last=False)
+                del self._pending[key]
+            pending.set()
+        return self._with_port(result, port)
+
+    @staticmethod
+    def _with_port(result, port: int) -> list:
+        if isinstance(result, Exception):
+            raise result
+        return [(family, (sockaddr[0], port) + sockaddr[2:]) for family, sockaddr in result]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters and the current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,460 @@
+"""
+Country and ASN lookups for 'geo:DE' / 'asn:13335' rules, against local databases that
+are memory-mapped and searched in place (no per-lookup file reads or parsing):
+
+  - MaxMind DB files (.mmdb: GeoLite2-Country/City/ASN, DB-IP, IPinfo), read with a
+    stdlib-only decoder: one bit-trie walk per address, record decoded once per offset.
+  - Range databases compiled from a CSV (.geodb), bisected on sorted range starts:
+
+    python -m src.core.geo_db compile dbip-country-lite.csv country.geodb --kind country
+    python -m src.core.geo_db compile ip2asn-v4.tsv asn.geodb --kind asn --value-column 2
+    python -m src.core.geo_db lookup country.geodb asn.geodb 1.1.1.1
+
+CSV rows are 'network,value' or 'start,end,value' (comma or tab separated); the value
+is the last column unless --value-column says otherwise.
+"""
+import argparse
+import ipaddress
+import mmap
+import os
+import re
+import struct
+import sys
+from bisect import bisect_right
+
+GEO_PREFIX, ASN_PREFIX = "geo:", "asn:"
+KIND_COUNTRY, KIND_ASN = "country", "asn"
+
+_GEO_TARGET_RE = re.compile(r"^geo:([a-z]{2})$")
+_ASN_TARGET_RE = re.compile(r"^asn:(?:as)?(\d{1,10})$")
+
+
+def parse_geo_target(target_lower: str) -> str | None:
+    """
+    Returns the normalized rule key of a 'geo:xx' (ISO country code) or 'asn:N' /
+    'asn:ASN' target, e.g. 'geo:de' or 'asn:13335'; None for any other target.
+    """
+    if not target_lower.startswith((GEO_PREFIX, ASN_PREFIX)):
+        return None
+    match = _GEO_TARGET_RE.match(target_lower)
+    if match:
+        return GEO_PREFIX + match.group(1)
+    match = _ASN_TARGET_RE.match(target_lower)
+    if match and 0 < int(match.group(1)) < 1 << 32: # AS 0 marks unrouted space
+        return ASN_PREFIX + str(int(match.group(1)))
+    return None
+
+
+def _value_key(kind: str, value) -> str | None:
+    """Rule key for a database value (country code or AS number), None if it is not one."""
+    if value is None:
+        return None
+    if kind == KIND_ASN:
+        return parse_geo_target(ASN_PREFIX + str(value).strip().lower())
+    return parse_geo_target(GEO_PREFIX + str(value).strip().lower())
+
+
+class MMDBReader:
+    """
+    Read-only MaxMind DB (format 2.x) reader over an mmap. The search tree is walked
+    bit by bit straight from the mapping; the data record an address ends in is only
+    decoded the first time its offset is seen, later hits are one dict lookup.
+    """
+
+    METADATA_MARKER = b"\xab\xcd\xefMaxMind.com"
+    METADATA_MAX_SIZE = 128 * 1024
+    JUMP_BITS = 16 # Leading bits walked once per distinct prefix, then looked up in a dict
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mm
+        marker_at = mm.rfind(self.METADATA_MARKER, max(0, len(mm) - self.METADATA_MAX_SIZE))
+        if marker_at < 0:
+            mm.close()
+            raise ValueError(f"'{path}' is not a MaxMind DB file")
+        metadata_at = marker_at + len(self.METADATA_MARKER)
+        self.metadata, _ = self._decode(metadata_at, metadata_at) # Its pointers are relative to itself
+        self.node_count = self.metadata.get("node_count") if isinstance(self.metadata, dict) else None
+        self.record_size = self.metadata.get("record_size") if isinstance(self.metadata, dict) else None
+        if not isinstance(self.node_count, int) or self.record_size not in (24, 28, 32):
+            mm.close()
+            raise ValueError(f"'{path}': unsupported MaxMind DB layout (record size {self.record_size})")
+        self.ip_version = self.metadata.get("ip_version", 6)
+        self._node_bytes = self.record_size // 4
+        self._tree_size = self._node_bytes * self.node_count
+        self._data_at = self._tree_size + 16 # 16 zero bytes separate the tree and the data
+        self.kind = KIND_ASN if "asn" in str(self.metadata.get("database_type", "")).lower() else KIND_COUNTRY
+        self._ipv4_start = 0
+        if self.ip_version == 6: # IPv4 addresses live under ::/96
+            node = 0
+            for _ in range(96):
+                if node >= self.node_count:
+                    break
+                node = self._record(node, 0)
+            self._ipv4_start = node
+        self._keys = {} # {record offset: rule key or None}
+        # Node reached after the first JUMP_BITS bits, per leading bits seen so far
+        self._jump4, self._jump6 = {}, {}
+
+    def close(self):
+        self._mm.close()
+
+    def _record(self, node: int, bit: int) -> int:
+        mm = self._mm
+        at = node * self._node_bytes
+        if self.record_size == 24:
+            at += 3 * bit
+            return mm[at] << 16 | mm[at + 1] << 8 | mm[at + 2]
+        if self.record_size == 28:
+            if bit:
+                return (mm[at + 3] & 0x0F) << 24 | mm[at + 4] << 16 | mm[at + 5] << 8 | mm[at + 6]
+            return (mm[at + 3] & 0xF0) << 20 | mm[at] << 16 | mm[at + 1] << 8 | mm[at + 2]
+        at += 4 * bit
+        return mm[at] << 24 | mm[at + 1] << 16 | mm[at + 2] << 8 | mm[at + 3]
+
+    def _size(self, size: int, at: int) -> tuple:
+        """Resolves the 29/30/31 size escapes: (size, offset after the size bytes)."""
+        mm = self._mm
+        if size < 29:
+            return size, at
+        if size == 29:
+            return 29 + mm[at], at + 1
+        if size == 30:
+            return 285 + (mm[at] << 8 | mm[at + 1]), at + 2
+        return 65821 + int.from_bytes(mm[at:at + 3], "big"), at + 3
+
+    def _decode(self, at: int, section: int | None = None) -> tuple:
+        """Decodes the data field at offset at: (value, offset after it)."""
+        mm = self._mm
+        base = self._data_at if section is None else section
+        control = mm[at]
+        at += 1
+        kind = control >> 5
+        if kind == 1: # Pointer, value lives elsewhere in the data section
+            ss, vvv = (control >> 3) & 3, control & 7
+            if ss == 0:
+                pointer, at = vvv << 8 | mm[at], at + 1
+            elif ss == 1:
+                pointer, at = (vvv << 16 | mm[at] << 8 | mm[at + 1]) + 2048, at + 2
+            elif ss == 2:
+                pointer, at = (vvv << 24 | int.from_bytes(mm[at:at + 3], "big")) + 526336, at + 3
+            else:
+                pointer, at = int.from_bytes(mm[at:at + 4], "big"), at + 4
+            value, _ = self._decode(base + pointer, section)
+            return value, at
+        if kind == 0: # Extended type
+            kind, at = 7 + mm[at], at + 1
+        size, at = self._size(control & 0x1F, at)
+        if kind == 2:
+            return mm[at:at + size].decode("utf-8", "replace"), at + size
+        if kind == 7:
+            value = {}
+            for _ in range(size):
+                key, at = self._decode(at, section)
+                value[key], at = self._decode(at, section)
+            return value, at
+        if kind in (5, 6, 9, 10):
+            return int.from_bytes(mm[at:at + size], "big"), at + size
+        if kind == 8:
+            return int.from_bytes(mm[at:at + size], "big", signed=size == 4), at + size
+        if kind == 11:
+            value = []
+            for _ in range(size):
+                item, at = self._decode(at, section)
+                value.append(item)
+            return value, at
+        if kind == 3:
+            return struct.unpack_from(">d", mm, at)[0], at + 8
+        if kind == 15:
+            return struct.unpack_from(">f", mm, at)[0], at + 4
+        if kind == 14:
+            return bool(size), at
+        if kind == 4:
+            return bytes(mm[at:at + size]), at + size
+        return None, at # Data cache container / end marker carry no value
+
+    def _key_at(self, offset: int) -> str | None:
+        record, _ = self._decode(offset)
+        if not isinstance(record, dict):
+            return None
+        if self.kind == KIND_ASN:
+            return _value_key(KIND_ASN, record.get("autonomous_system_number", record.get("asn")))
+        for field in ("country", "registered_country"):
+            country = record.get(field)
+            if isinstance(country, dict):
+                country = country.get("iso_code")
+            if country:
+                return _value_key(KIND_COUNTRY, country)
+        return _value_key(KIND_COUNTRY, record.get("country_code"))
+
+    def _walk(self, node: int, value: int, bits: int) -> int:
+        """Follows the top bits of value down the tree from node, stopping at a leaf."""
+        node_count, record = self.node_count, self._record
+        for shift in range(bits - 1, -1, -1):
+            if node >= node_count:
+                break
+            node = record(node, value >> shift & 1)
+        return node
+
+    def lookup(self, address) -> str | None:
+        """Rule key ('geo:de' or 'asn:13335') of an ipaddress address, None if it is not listed."""
+        if address.version == 6:
+            if self.ip_version == 4:
+                return None
+            node, bits, jump = 0, 128, self._jump6
+        else:
+            node, bits, jump = self._ipv4_start, 32, self._jump4
+        key = int(address)
+        rest = bits - self.JUMP_BITS
+        head = key >> rest
+        start = jump.get(head)
+        if start is None:
+            start = jump[head] = self._walk(node, head, self.JUMP_BITS)
+        node = self._walk(start, key, rest)
+        node_count = self.node_count
+        if node <= node_count: # node_count itself means 'no data'
+            return None
+        offset = self._tree_size + node - node_count
+        keys = self._keys
+        if offset not in keys:
+            keys[offset] = self._key_at(offset)
+        return keys[offset]
+
+
+GEODB_MAGIC = b"PWGEODB\0"
+GEODB_VERSION = 1
+# Header: magic, version, kind (0 country, 1 asn), IPv4 range count, IPv6 range count,
+# key count, then the file offsets of the IPv4, IPv6 and key sections.
+_GEODB_HEADER = struct.Struct("<8sHBxIII3I")
+_GEODB_KINDS = (KIND_COUNTRY, KIND_ASN)
+
+#
+# Layout (integers little-endian, sections 4-byte aligned):
+#   ipv4: u32 starts[n4], u32 ends[n4], u32 key ids[n4], sorted by start, not overlapping
+#   ipv6: u8 starts[n6][16], u8 ends[n6][16] (big-endian), u32 key ids[n6]
+#   keys: u32 offsets[k + 1], blob of rule keys ('geo:de', 'asn:13335')
+#
+
+
+class RangeDatabase:
+    """
+    Read-only view of a compiled range database (see compile_csv). IPv4 lookups bisect
+    the u32 range starts in place; IPv6 lookups binary-search the 16-byte starts.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if sys.byteorder != "little":
+            raise ValueError("compiled geo databases are little-endian")
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self._mm
+        if len(mm) < _GEODB_HEADER.size or len(mm) % 4:
+            mm.close()
+            raise ValueError(f"'{path}' is not a compiled geo database")
+        magic, version, kind, self._v4_count, self._v6_count, key_count, v4_at, self._v6_at, keys_at = \
+            _GEODB_HEADER.unpack_from(mm, 0)
+        if magic != GEODB_MAGIC or version != GEODB_VERSION or kind >= len(_GEODB_KINDS):
+            mm.close()
+            raise ValueError(f"'{path}' is not a compiled geo database (version {GEODB_VERSION})")
+        self.kind = _GEODB_KINDS[kind]
+        self._words = memoryview(mm).cast("I")
+        self._v4_starts = v4_at // 4
+        offsets = self._words[keys_at // 4:keys_at // 4 + key_count + 1]
+        blob = keys_at + (key_count + 1) * 4
+        self._keys = [mm[blob + offsets[i]:blob + offsets[i + 1]].decode("ascii") for i in range(key_count)]
+
+    def close(self):
+        self._words.release()
+        self._mm.close()
+
+    def lookup(self, address) -> str | None:
+        """Rule key of an ipaddress address, None if no range contains it."""
+        key = int(address)
+        words = self._words
+        if address.version == 4:
+            count, starts = self._v4_count, self._v4_starts
+            i = bisect_right(words, key, starts, starts + count) - 1
+            if i < starts or words[i + count] < key:
+                return None
+            return self._keys[words[i + 2 * count]]
+        mm, at, count = self._mm, self._v6_at, self._v6_count
+        needle = key.to_bytes(16, "big")
+        lo, hi = 0, count
+        while lo < hi: # First range starting above the address
+            mid = (lo + hi) // 2
+            if mm[at + mid * 16:at + mid * 16 + 16] <= needle:
+                lo = mid + 1
+            else:
+                hi = mid
+        i = lo - 1
+        ends_at = at + count * 16
+        if i < 0 or mm[ends_at + i * 16:ends_at + i * 16 + 16] < needle:
+            return None
+        return self._keys[words[(ends_at + count * 16) // 4 + i]]
+
+
+def _parse_row(fields: list, value_column: int | None) -> tuple | None:
+    """(version, start, end, value) of a CSV row, None for a header or comment row."""
+    try:
+        end_address = ipaddress.ip_address(fields[1].strip()) if len(fields) > 2 else None
+    except ValueError:
+        end_address = None
+    try:
+        if end_address is not None:
+            start_address = ipaddress.ip_address(fields[0].strip())
+            if start_address.version != end_address.version:
+                return None
+            start, end, version = int(start_address), int(end_address), start_address.version
+            default_column = 2
+        else:
+            network = ipaddress.ip_network(fields[0].strip(), strict=False)
+            start, end, version = int(network.network_address), int(network.broadcast_address), network.version
+            default_column = 1
+    except ValueError:
+        return None
+    column = default_column if value_column is None else value_column
+    if column >= len(fields) or start > end:
+        return None
+    return version, start, end, fields[column]
+
+
+def compile_csv(csv_path: str, out_path: str, kind: str, value_column: int | None = None) -> dict:
+    """
+    Compiles a CSV/TSV of networks or address ranges into a range database at out_path
+    (written to a temporary file, then renamed). Rows whose value is not a country code
+    (kind 'country') or AS number (kind 'asn', e.g. '13335' or 'AS13335') are skipped,
+    adjacent ranges with the same value are merged. Overlapping ranges raise ValueError.
+    Returns {"ipv4": count, "ipv6": count, "keys": count, "skipped": count}.
+    """
+    ranges = {4: [], 6: []}
+    key_ids, keys = {}, []
+    skipped = 0
+    with open(csv_path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            fields = [field.strip().strip('"') for field in (line.split("\t") if "\t" in line else line.split(","))]
+            row = _parse_row(fields, value_column)
+            key = _value_key(kind, row[3]) if row is not None else None
+            if key is None:
+                skipped += 1
+                continue
+            if key not in key_ids:
+                key_ids[key] = len(keys)
+                keys.append(key)
+            ranges[row[0]].append((row[1], row[2], key_ids[key]))
+
+    for version in (4, 6):
+        merged = []
+        for start, end, key_id in sorted(ranges[version]):
+            if merged and start <= merged[-1][1]:
+                address = (ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address)(start)
+                raise ValueError(f"{csv_path}: overlapping ranges at {address}")
+            if merged and start == merged[-1][1] + 1 and key_id == merged[-1][2]:
+                merged[-1][1] = end
+            else:
+                merged.append([start, end, key_id])
+        ranges[version] = merged
+
+    v4, v6 = ranges[4], ranges[6]
+    buf = bytearray(_GEODB_HEADER.size)
+    v4_at = len(buf)
+    buf += struct.pack(f"<{3 * len(v4)}I", *(r[0] for r in v4), *(r[1] for r in v4), *(r[2] for r in v4))
+    v6_at = len(buf)
+    buf += b"".join(r[0].to_bytes(16, "big") for r in v6)
+    buf += b"".join(r[1].to_bytes(16, "big") for r in v6)
+    buf += struct.pack(f"<{len(v6)}I", *(r[2] for r in v6))
+    keys_at = len(buf)
+    encoded = [key.encode("ascii") for key in keys]
+    offsets, position = [], 0
+    for key in encoded:
+        offsets.append(position)
+        position += len(key)
+    offsets.append(position)
+    buf += struct.pack(f"<{len(offsets)}I", *offsets) + b"".join(encoded)
+    buf.extend(b"\0" * (-len(buf) % 4))
+    _GEODB_HEADER.pack_into(buf, 0, GEODB_MAGIC, GEODB_VERSION, _GEODB_KINDS.index(kind),
+                            len(v4), len(v6), len(keys), v4_at, v6_at, keys_at)
+    temp_path = out_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(buf)
+    os.replace(temp_path, out_path)
+    return {"ipv4": len(v4), "ipv6": len(v6), "keys": len(keys), "skipped": skipped}
+
+
+def open_database(path: str):
+    """Opens a compiled range database or a MaxMind DB file, whichever path holds."""
+    with open(path, "rb") as f:
+        magic = f.read(len(GEODB_MAGIC))
+    return RangeDatabase(path) if magic == GEODB_MAGIC else MMDBReader(path)
+
+
+class GeoDatabase:
+    """
+    The country and ASN databases the 'geo:' / 'asn:' rules are matched against.
+    lookup() returns the rule keys of an address, AS number first: a rule for the
+    network operator is more specific than one for the whole country.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.databases = [open_database(path) for path in self.paths]
+        # ASN databases first, so their key comes first in lookup()
+        self._ordered = sorted(self.databases, key=lambda database: database.kind != KIND_ASN)
+
+    def close(self):
+        for database in self.databases:
+            database.close()
+
+    def lookup(self, address) -> list:
+        """Rule keys for an ipaddress address, e.g. ['asn:13335', 'geo:us'] (empty if unknown)."""
+        keys = []
+        for database in self._ordered:
+            key = database.lookup(address)
+            if key is not None and key not in keys:
+                keys.append(key)
+        return keys
+
+
+def main(argv: list | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Compile or query geo/ASN databases for 'geo:' and 'asn:' rules.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compile_parser = commands.add_parser("compile", help="Compile a CSV/TSV of ranges into a .geodb file")
+    compile_parser.add_argument("csv", help="Rows of 'network,value' or 'start,end,value'")
+    compile_parser.add_argument("output", help="Database file to write")
+    compile_parser.add_argument("--kind", choices=_GEODB_KINDS, required=True, help="What the value column holds")
+    compile_parser.add_argument("--value-column", type=int, default=None, help="0-based value column (default: the one after the range)")
+    lookup_parser = commands.add_parser("lookup", help="Print the rule keys of addresses")
+    lookup_parser.add_argument("databases", nargs="+", help="Database files, then the addresses")
+    args = parser.parse_args(argv)
+
+    if args.command == "compile":
+        try:
+            counts = compile_csv(args.csv, args.output, args.kind, args.value_column)
+        except (OSError, ValueError) as e:
+            print(f"[GeoDB] Error: {e}", file=sys.stderr)
+            return 2
+        print(f"[GeoDB] Wrote '{args.output}': {counts['ipv4']} IPv4 and {counts['ipv6']} IPv6 ranges, "
+              f"{counts['keys']} distinct values, {counts['skipped']} rows skipped.")
+        return 0
+
+    paths = [value for value in args.databases if os.path.exists(value)]
+    addresses = [value for value in args.databases if value not in paths]
+    geo_database = GeoDatabase(paths)
+    for value in addresses:
+        try:
+            address = ipaddress.ip_address(value)
+        except ValueError:
+            print(f"{value}\tinvalid address")
+            continue
+        print(f"{value}\t{' '.join(geo_database.lookup(address)) or '-'}")
+    geo_database.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+Hostname normalization shared by rule compilation and lookups, so that every spelling
+of a host ('Bücher.DE.', 'xn--bcher-kva.de', '%62ücher.de') reaches the same rules
+and the same cached decisions.
+"""
+from functools import lru_cache
+import re
+from urllib.parse import unquote
+
+HOST_CACHE_SIZE = 4096 # Distinct raw host spellings whose normalized form is memoized
+
+_GLOB_CHARS = ("*", "?", "[")
+_GLOB_ESCAPES = re.compile(r"(%(?:2a|3f|5b))", re.IGNORECASE) # Percent-encoded '*', '?' and '['
+
+
+def _idna_label(label: str) -> str:
+    """Punycode form of one label, or the label itself if it is ASCII, a glob or not encodable."""
+    if label.isascii() or any(c in label for c in _GLOB_CHARS):
+        return label
+    try:
+        return label.encode("idna").decode("ascii")
+    except UnicodeError:
+        return label
+
+
+def _canonical(name: str, pattern: bool) -> str:
+    """
+    Shared by normalize_host and normalize_rule_target. With pattern (a rule target),
+    escapes of glob characters are not decoded, so '%2A' cannot turn into a wildcard,
+    and labels holding glob characters are left out of the IDNA encoding.
+    """
+    name = name.strip()
+    if "%" in name:
+        if pattern: # Odd parts are the glob escapes; they are single bytes, so no UTF-8 sequence is split
+            name = "".join(part if i % 2 else unquote(part) for i, part in enumerate(_GLOB_ESCAPES.split(name)))
+        else:
+            name = unquote(name)
+    if name.startswith("[") and name.endswith("]"):
+        name = name[1:-1]
+    name = name.lower()
+    if not name.isascii():
+        try:
+            if pattern:
+                raise UnicodeError # Encoded label by label, around the glob characters
+            name = name.encode("idna").decode("ascii") # Also maps '。' and friends to '.'
+        except UnicodeError:
+            name = ".".join(_idna_label(label) for label in name.split("."))
+    return name.rstrip(".")
+
+
+@lru_cache(maxsize=HOST_CACHE_SIZE)
+def normalize_host(host: str) -> str:
+    """
+    Canonical form of a requested host: percent-decoded, without IPv6 brackets or
+    trailing dots, lower case, and IDNA (punycode) encoded. Results are memoized, so
+    repeated lookups of a host cost one dict hit. Unencodable names are kept as they are.
+    """
+    return _canonical(host, pattern=False)
+
+
+def normalize_rule_target(target: str) -> str:
+    """
+    Canonical form of a rule's domain/IP field, matching normalize_host: percent-decoded
+    (except for escaped glob characters), lower case, no IPv6 brackets or trailing dot,
+    and every non-ASCII label without glob characters in punycode, so '*.bücher.de' and
+    'b%C3%BCcher.de' match 'www.xn--bcher-kva.de' and 'xn--bcher-kva.de'.
+    """
+    return _canonical(target, pattern=True)
+
+
+def cache_stats() -> dict:
+    """Returns hit/miss counters and the current size of the normalize_host memo."""
+    info = normalize_host.cache_info()
+    lookups = info.hits + info.misses
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize,
+            "hit_rate": info.hits / lookups if lookups else 0.0}
@@ -0,0 +1,215 @@
+"""
+Incremental HTTP/1.x framing for the plain-HTTP (non-CONNECT) proxy loop. Request and
+response heads are parsed once they are complete, and bodies are followed as their bytes
+pass through (Content-Length, chunked or until close) without being decoded, so every
+message is forwarded as it is and the next request on a kept-alive connection is found.
+No I/O happens here; the threaded and the asyncio handler drive it.
+"""
+from urllib.parse import urlsplit
+
+MAX_HEAD_SIZE = 65536 # Largest request/response head accepted
+MAX_LINE_SIZE = 8192  # Largest chunk-size or trailer line accepted
+HEAD_END = b"\r\n\r\n"
+_DROPPED_REQUEST_HEADERS = {"proxy-connection", "proxy-authorization"} # Meant for this proxy, not the server
+
+
+class HTTPParseError(ValueError):
+    """Malformed or unsupported HTTP framing; the connection cannot be used further."""
+
+
+class MessageHead:
+    """Start line and header fields of a request or response, plus the raw bytes they came from."""
+    __slots__ = ("raw", "version", "method", "target", "status", "headers")
+
+    def __init__(self, raw: bytes, version: str, headers: list, method: str = "", target: str = "", status: int = 0):
+        self.raw = raw
+        self.version = version
+        self.method = method
+        self.target = target
+        self.status = status
+        self.headers = headers # [(name, value)] in order, values latin-1 decoded
+
+    def header(self, name: str) -> str | None:
+        """Value of a header, occurrences joined with ', ' as RFC 9110 allows; None if absent."""
+        values = [value for field, value in self.headers if field.lower() == name]
+        return ", ".join(values) if values else None
+
+    def tokens(self, name: str) -> list:
+        """Lower-case comma-separated elements of a header, e.g. the options of Connection."""
+        value = self.header(name)
+        return [token.strip().lower() for token in value.split(",") if token.strip()] if value else []
+
+    def keep_alive(self) -> bool:
+        """Whether the sender allows another message on this connection afterwards."""
+        options = self.tokens("connection") + self.tokens("proxy-connection")
+        if self.version == "HTTP/1.0":
+            return "keep-alive" in options
+        return "close" not in options
+
+
+def find_head_end(buffer) -> int:
+    """Offset just past the blank line ending the head at the start of buffer, or -1."""
+    end = buffer.find(HEAD_END)
+    return end + len(HEAD_END) if end >= 0 else -1
+
+
+def _parse_head(data: bytes) -> tuple[list, list]:
+    if len(data) > MAX_HEAD_SIZE:
+        raise HTTPParseError("Header section too large")
+    lines = data[:-len(HEAD_END)].decode("latin-1").split("\r\n")
+    headers = []
+    for line in lines[1:]:
+        if line[:1] in (" ", "\t"):
+            raise HTTPParseError("Obsolete header line folding")
+        name, colon, value = line.partition(":")
+        if not colon or not name or name != name.strip():
+            raise HTTPParseError(f"Malformed header line {line[:40]!r}")
+        headers.append((name, value.strip()))
+    return lines[0].split(" ", 2), headers
+
+
+def parse_request_head(data: bytes) -> MessageHead:
+    """Parses a complete request head (ending with the blank line)."""
+    start_line, headers = _parse_head(data)
+    if len(start_line) != 3 or not start_line[2].startswith("HTTP/1."):
+        raise HTTPParseError(f"Malformed request line {' '.join(start_line)[:80]!r}")
+    method, target, version = start_line
+    return MessageHead(data, version, headers, method=method.upper(), target=target)
+
+
+def parse_response_head(data: bytes) -> MessageHead:
+    """Parses a complete response head (ending with the blank line)."""
+    start_line, headers = _parse_head(data)
+    if len(start_line) < 2 or not start_line[0].startswith("HTTP/1.") or not start_line[1].isdigit() or len(start_line[1]) != 3:
+        raise HTTPParseError(f"Malformed status line {' '.join(start_line)[:80]!r}")
+    return MessageHead(data, start_line[0], headers, status=int(start_line[1]))
+
+
+def request_target(head: MessageHead) -> tuple[str | None, int | None, str]:
+    """
+    Returns (host, port, origin-form target) of a proxy request: from an absolute URI
+    ('GET http://host:8080/path'), or else from its Host header.
+    """
+    target = head.target
+    default_port = 80
+    if "://" in target:
+        parts = urlsplit(target)
+        default_port = 443 if parts.scheme.lower() == "https" else 80
+        authority = parts.netloc.rpartition("@")[2]
+        path = parts.path or "/"
+        target = f"{path}?{parts.query}" if parts.query else path
+    else:
+        authority = head.header("host") or ""
+    try:
+        parts = urlsplit("//" + authority)
+        return parts.hostname, parts.port or default_port, target
+    except ValueError: # Invalid port or brackets
+        return None, None, target
+
+
+def rewrite_request_head(head: MessageHead, origin_target: str) -> bytes:
+    """The request head as sent upstream: origin-form target, without the proxy's own headers."""
+    lines = [f"{head.method} {origin_target} {head.version}"]
+    dropped = _DROPPED_REQUEST_HEADERS
+    if head.header("transfer-encoding") is not None:
+        dropped = dropped | {"content-length"} # Framed by Transfer-Encoding, a second length could be read differently upstream
+    lines += [f"{name}: {value}" for name, value in head.headers if name.lower() not in dropped]
+    if head.header("host") is None and "://" in head.target:
+        lines.insert(1, f"Host: {urlsplit(head.target).netloc.rpartition('@')[2]}")
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+class BodyFramer:
+    """
+    Follows one message body through the bytes after its head: feed() says how many of
+    them belong to the body, and done is set once it is complete.
+    """
+    LENGTH, CHUNKED, UNTIL_CLOSE = "length", "chunked", "until-close"
+    _SIZE, _DATA, _DATA_END, _TRAILER = range(4) # Chunked decoder states
+
+    __slots__ = ("kind", "remaining", "done", "_state", "_line")
+
+    def __init__(self, kind: str, length: int = 0):
+        self.kind = kind
+        self.remaining = length # LENGTH: body bytes still to come, CHUNKED: bytes left of the current chunk
+        self.done = kind == self.LENGTH and length == 0
+        self._state = self._SIZE
+        self._line = b""        # Partial chunk-size or trailer line
+
+    def feed(self, data: bytes) -> int:
+        """Consumes the body's share of data (bytes) and returns its length."""
+        if self.done:
+            return 0
+        if self.kind == self.UNTIL_CLOSE:
+            return len(data)
+        if self.kind == self.LENGTH:
+            count = min(len(data), self.remaining)
+            self.remaining -= count
+            self.done = not self.remaining
+            return count
+        position, size = 0, len(data)
+        while position < size:
+            if self._state == self._DATA:
+                count = min(size - position, self.remaining)
+                position += count
+                self.remaining -= count
+                if not self.remaining:
+                    self._state = self._DATA_END
+                continue
+            newline = data.find(b"\n", position)
+            if newline < 0:
+                self._line += data[position:]
+                if len(self._line) > MAX_LINE_SIZE:
+                    raise HTTPParseError("Chunk line too long")
+                return size
+            line = (self._line + data[position:newline]).rstrip(b"\r")
+            self._line = b""
+            position = newline + 1
+            if self._state == self._SIZE:
+                try:
+                    self.remaining = int(line.split(b";", 1)[0].strip(), 16)
+                except ValueError:
+                    raise HTTPParseError(f"Invalid chunk size {line[:20]!r}") from None
+                self._state = self._DATA if self.remaining else self._TRAILER
+            elif self._state == self._DATA_END:
+                if line:
+                    raise HTTPParseError("Missing CRLF after chunk data")
+                self._state = self._SIZE
+            elif not line: # End of the trailer section
+                self.done = True
+                return position
+        return position
+
+    def finish(self):
+        """The connection was closed: fine for an until-close body, an error for the others."""
+        if self.kind != self.UNTIL_CLOSE and not self.done:
+            raise HTTPParseError("Connection closed in the middle of a message body")
+        self.done = True
+
+
+def _framing(head: MessageHead) -> BodyFramer | None:
+    """Framer from Transfer-Encoding/Content-Length, None if the message has neither."""
+    codings = head.tokens("transfer-encoding")
+    if codings:
+        return BodyFramer(BodyFramer.CHUNKED) if codings[-1] == "chunked" else None
+    length = head.header("content-length")
+    if length is None:
+        return None
+    values = {value.strip() for value in length.split(",")}
+    if len(values) != 1 or not next(iter(values)).isdigit():
+        raise HTTPParseError(f"Invalid Content-Length {length[:40]!r}")
+    return BodyFramer(BodyFramer.LENGTH, int(values.pop()))
+
+
+def request_body(head: MessageHead) -> BodyFramer:
+    """Framing of a request's body; requests without length information have none."""
+    if head.tokens("transfer-encoding") and head.tokens("transfer-encoding")[-1] != "chunked":
+        raise HTTPParseError("Request body without a determinable length")
+    return _framing(head) or BodyFramer(BodyFramer.LENGTH, 0)
+
+
+def response_body(head: MessageHead, request_method: str) -> BodyFramer:
+    """Framing of a response's body (RFC 9112 section 6.3)."""
+    if request_method == "HEAD" or head.status < 200 or head.status in (204, 304):
+        return BodyFramer(BodyFramer.LENGTH, 0)
+    return _framing(head) or BodyFramer(BodyFramer.UNTIL_CLOSE)
@@ -0,0 +1,166 @@
+import ipaddress
+
+
+class _RadixNode:
+    """One node of a path-compressed (Patricia) binary trie."""
+    __slots__ = ("key", "length", "value", "children")
+
+    def __init__(self, key: int, length: int, value=None):
+        self.key = key         # Network bits, left-aligned and masked to `length`
+        self.length = length   # Prefix length in bits
+        self.value = value     # Payload for this exact prefix (None for branch-only nodes)
+        self.children = [None, None]
+
+
+class IPRadixTree:
+    """
+    Longest-prefix-match radix (Patricia) tree for one address family.
+    Lookups walk at most one node per address bit, whatever the number of prefixes.
+    """
+
+    def __init__(self, bits: int):
+        self.bits = bits # 32 for IPv4, 128 for IPv6
+        self.root = None
+        self.size = 0    # Number of prefixes carrying a value
+        self._masks = [((1 << length) - 1) << (bits - length) for length in range(bits + 1)]
+
+    def _bit(self, key: int, index: int) -> int:
+        """Returns bit `index` of key, counting from the most significant bit."""
+        return (key >> (self.bits - 1 - index)) & 1
+
+    def _common_length(self, a: int, b: int, limit: int) -> int:
+        """Number of leading bits a and b share, capped at limit."""
+        diff = a ^ b
+        if not diff:
+            return limit
+        return min(limit, self.bits - diff.bit_length())
+
+    def node_for(self, key: int, length: int) -> _RadixNode:
+        """Returns the node for prefix key/length, creating (and splitting) nodes as needed."""
+        key &= self._masks[length]
+        if self.root is None:
+            self.root = _RadixNode(key, length)
+            return self.root
+
+        parent, parent_bit, node = None, 0, self.root
+        while True:
+            common = self._common_length(node.key, key, min(node.length, length))
+            if common < node.length:
+                # The new prefix diverges inside this node's compressed path: split it
+                if common == length:
+                    new_node = _RadixNode(key, length)
+                    new_node.children[self._bit(node.key, length)] = node
+                    result = new_node
+                else:
+                    new_node = _RadixNode(key & self._masks[common], common)
+                    result = _RadixNode(key, length)
+                    new_node.children[self._bit(node.key, common)] = node
+                    new_node.children[self._bit(key, common)] = result
+                if parent is None:
+                    self.root = new_node
+                else:
+                    parent.children[parent_bit] = new_node
+                return result
+            if node.length == length:
+                return node
+            bit = self._bit(key, node.length)
+            child = node.children[bit]
+            if child is None:
+                child = _RadixNode(key, length)
+                node.children[bit] = child
+                return child
+            parent, parent_bit, node = node, bit, child
+
+    def find(self, key: int, length: int) -> _RadixNode | None:
+        """Returns the node for exactly prefix key/length, or None if it does not exist."""
+        key &= self._masks[length]
+        node = self.root
+        while node is not None and node.length <= length:
+            if (key & self._masks[node.length]) != node.key:
+                return None
+            if node.length == length:
+                return node
+            node = node.children[self._bit(key, node.length)]
+        return None
+
+    def set_value(self, key: int, length: int, value):
+        """Stores the value of prefix key/length, or clears it when value is None."""
+        node = self.node_for(key, length) if value is not None else self.find(key, length)
+        if node is None:
+            return
+        if node.value is None and value is not None:
+            self.size += 1
+        elif node.value is not None and value is None:
+            self.size -= 1
+        node.value = value # Single reference store, safe for concurrent lookups
+
+    def parent_value(self, key: int, length: int):
+        """Returns the value of the longest prefix strictly shorter than key/length that contains it."""
+        key &= self._masks[length]
+        masks = self._masks
+        value = None
+        node = self.root
+        while node is not None and node.length < length:
+            if (key & masks[node.length]) != node.key:
+                break
+            if node.value is not None:
+                value = node.value
+            node = node.children[self._bit(key, node.length)]
+        return value
+
+    def lookup(self, key: int) -> list:
+        """Returns the values of every prefix containing key, most specific first."""
+        hits = []
+        masks = self._masks
+        node = self.root
+        while node is not None:
+            if (key & masks[node.length]) != node.key:
+                break
+            if node.value is not None:
+                hits.append(node.value)
+            if node.length == self.bits:
+                break
+            node = node.children[self._bit(key, node.length)]
+        hits.reverse()
+        return hits
+
+    def prefix_lengths(self, key: int) -> list:
+        """Lengths of the prefixes lookup(key) returns, in the same order."""
+        lengths = []
+        masks = self._masks
+        node = self.root
+        while node is not None:
+            if (key & masks[node.length]) != node.key:
+                break
+            if node.value is not None:
+                lengths.append(node.length)
+            if node.length == self.bits:
+                break
+            node = node.children[self._bit(key, node.length)]
+        lengths.reverse()
+        return lengths
+
+
+def parse_ip_target(target: str) -> list | None:
+    """
+    Parses an IP rule target into a list of ipaddress networks.
+    Accepts a single address ('1.2.3.4'), a CIDR block ('10.0.0.0/8', '2001:db8::/32')
+    or an inclusive start-end range ('10.0.0.1-10.0.0.50'), which is split into the
+    CIDR blocks that cover it exactly. Returns None if target is not an IP target.
+    """
+    target = target.strip()
+    if not target or '*' in target or '?' in target:
+        return None
+    try:
+        if '/' in target:
+            return [ipaddress.ip_network(target, strict=False)]
+        if '-' in target:
+            start, end = (part.strip() for part in target.split('-', 1))
+            first = ipaddress.ip_address(start)
+            last = ipaddress.ip_address(end)
+            if first.version != last.version or first > last:
+                return None
+            return list(ipaddress.summarize_address_range(first, last))
+        return [ipaddress.ip_network(target)] # Single address as /32 or /128
+    except ValueError:
+        return None
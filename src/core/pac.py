@@ -0,0 +1,206 @@
+"""
+Proxy auto-config (PAC) generation: compiles the routing rules into a FindProxyForURL
+script, so a browser configured with it connects directly wherever the rules say
+"Direct" and only hands the proxied (and blocked) hosts to the engine.
+
+The script replays RuleMatcher's lookup order in JavaScript (profile layer, then the
+global layer: exact host, best of '*.suffix' and glob patterns, parent domains; IPv4
+prefixes longest first, port qualifiers included). Whatever a PAC script cannot decide
+on its own - country/AS rules, IPv6 prefixes, hostname resolution for IP rules, TLS
+server names - is left to the engine.
+"""
+import json
+
+from .rule_matcher import CompiledRules, GlobAutomaton
+
+PAC_PATHS = ("/proxy.pac", "/wpad.dat") # Paths the engine serves the script on
+PAC_CONTENT_TYPE = "application/x-ns-proxy-autoconfig"
+
+_ENGINE, _DIRECT = 1, 0 # Decisions stored in the script's port tables
+
+_PAC_TEMPLATE = """// Generated by ProxieWy from the rules of profile %(profile)s. Do not edit, it is rewritten on every rule change.
+var ENGINE = %(engine)s;
+var LAYERS = %(layers)s;
+var ENGINE_UNMATCHED = %(engine_unmatched)s; // Unmatched hostnames are resolved and matched against IP rules by the engine
+var SNI_PORTS = %(sni_ports)s; // HTTPS to an IP address on these ports is routed by its TLS server name
+
+(function () {
+    for (var l = 0; l < LAYERS.length; l++) {
+        var globs = LAYERS[l].globs;
+        for (var g = 0; g < globs.length; g++) globs[g][0] = new RegExp(globs[g][0]);
+    }
+})();
+
+function pickPort(table, port) {
+    // Exact port, then the narrowest range containing it, then all ports
+    if (table[1].hasOwnProperty(port)) return table[1][port];
+    var ranges = table[2];
+    for (var i = 0; i < ranges.length; i++) {
+        if (ranges[i][0] <= port && port <= ranges[i][1]) return ranges[i][2];
+    }
+    return table[0];
+}
+
+function parseIPv4(host) {
+    var parts = host.split(".");
+    if (parts.length != 4) return null;
+    var value = 0;
+    for (var i = 0; i < 4; i++) {
+        if (!/^(0|[1-9]\\d{0,2})$/.test(parts[i]) || +parts[i] > 255) return null;
+        value = value * 256 + (+parts[i]);
+    }
+    return value;
+}
+
+function matchGlob(globs, domain, port, anchoredOnly) {
+    for (var i = 0; i < globs.length; i++) {
+        var glob = globs[i];
+        if (anchoredOnly && !glob[2]) continue;
+        if (glob[0].test(domain)) {
+            var decision = pickPort(glob[3], port);
+            if (decision !== null) return [glob[1], decision];
+        }
+    }
+    return null;
+}
+
+function matchLayer(layer, host, port, ipv4, isIPv6) {
+    if (ipv4 !== null) {
+        var prefixHit = false;
+        for (var b = 0; b < layer.ipv4.length; b++) {
+            var length = layer.ipv4[b][0];
+            var network = length ? ipv4 - ipv4 %% Math.pow(2, 32 - length) : 0;
+            var table = layer.ipv4[b][1][network];
+            if (table === undefined) continue;
+            prefixHit = true;
+            var decision = pickPort(table, port);
+            if (decision !== null) return decision;
+        }
+        if (layer.geo) return %(engine_value)d;
+        if (prefixHit) return null;
+    } else if (isIPv6 && (layer.ipv6 || layer.geo)) {
+        return %(engine_value)d;
+    }
+    var labels = host.split(".");
+    var n = labels.length;
+    var exactHits = [];
+    var wildcard = null, wildcardPattern = null;
+    for (var depth = 1; depth <= n; depth++) {
+        var suffix = labels.slice(n - depth).join(".");
+        var exact = layer.exact[suffix];
+        exactHits[depth] = exact === undefined ? null : pickPort(exact, port);
+        var wild = depth < n ? layer.wildcard[suffix] : undefined;
+        if (wild !== undefined) {
+            var entry = pickPort(wild, port);
+            if (entry !== null) { wildcard = entry; wildcardPattern = "*." + suffix; }
+        }
+    }
+    if (exactHits[n] !== null) return exactHits[n];
+    // Deepest '*.suffix' against the best glob: longer pattern first, then alphabetical
+    var glob = matchGlob(layer.globs, host, port, false);
+    if (glob !== null && (wildcardPattern === null || glob[0].length > wildcardPattern.length ||
+                          (glob[0].length == wildcardPattern.length && glob[0] < wildcardPattern))) {
+        return glob[1];
+    }
+    if (wildcardPattern !== null) return wildcard;
+    for (var i = 1; i < n; i++) {
+        if (exactHits[n - i] !== null) return exactHits[n - i];
+        var parent = matchGlob(layer.globs, labels.slice(i).join("."), port, true);
+        if (parent !== null) return parent[1];
+    }
+    return null;
+}
+
+function FindProxyForURL(url, host) {
+    host = host.toLowerCase().replace(/^\\[|\\]$/g, "").replace(/\\.+$/, "");
+    var m = /^([a-z][a-z0-9+.-]*):\\/\\/(?:[^\\/?#@]*@)?(\\[[^\\]]*\\]|[^\\/:?#]*)(?::(\\d+))?/i.exec(url);
+    var scheme = m ? m[1].toLowerCase() : "http";
+    var port = m && m[3] ? +m[3] : (scheme == "https" || scheme == "wss" ? 443 : 80);
+    var ipv4 = parseIPv4(host);
+    var isIPv6 = host.indexOf(":") >= 0;
+    if ((ipv4 !== null || isIPv6) && SNI_PORTS.indexOf(port) >= 0) return ENGINE;
+    for (var l = 0; l < LAYERS.length; l++) {
+        var decision = matchLayer(LAYERS[l], host, port, ipv4, isIPv6);
+        if (decision !== null) return decision == %(engine_value)d ? ENGINE : "DIRECT";
+    }
+    if (ENGINE_UNMATCHED && ipv4 === null && !isIPv6) return ENGINE;
+    return "DIRECT";
+}
+"""
+
+
+def glob_to_regex(pattern: str) -> str:
+    """JavaScript RegExp source matching exactly the hosts GlobAutomaton matches pattern against."""
+    parts = ["^"]
+    for kind, value in GlobAutomaton._tokenize(pattern):
+        if kind == GlobAutomaton._STAR:
+            parts.append(".*")
+        elif kind == GlobAutomaton._ANY:
+            parts.append(".")
+        elif kind == GlobAutomaton._CHAR:
+            parts.append("\\" + value if not value.isalnum() else value)
+        else:
+            chars, negate = value
+            if not chars:
+                parts.append("[^]" if negate else "(?!)")
+                continue
+            body = "".join("\\" + c if c in "\\]^-[" else c for c in sorted(chars))
+            parts.append(f"[{'^' if negate else ''}{body}]")
+    parts.append("$")
+    return "".join(parts)
+
+
+def _port_table(table) -> list:
+    """[all-ports decision, {port: decision}, [[start, end, decision]] narrowest first]."""
+    def decision(entry):
+        return _DIRECT if entry[0] is None else _ENGINE
+    ranges = sorted(table.ranges.items(), key=lambda item: (item[0][1] - item[0][0], item[0][0]))
+    return [decision(table.any_port) if table.any_port is not None else None,
+            {str(port): decision(entry) for port, entry in table.ports.items()},
+            [[start, end, decision(entry)] for (start, end), entry in ranges]]
+
+
+def compile_layer(rules: dict) -> dict:
+    """Compiles one layer of rules into the data the script's matchLayer() reads."""
+    compiled, slot_rules = CompiledRules.build(rules, 0)
+    layer = {"exact": {}, "wildcard": {}, "globs": [], "ipv4": {}, "ipv6": False, "geo": False}
+    for slot in slot_rules:
+        table = compiled.table_for(slot)
+        if table is None:
+            continue
+        kind = slot[0]
+        if kind == CompiledRules.EXACT:
+            layer["exact"][slot[1]] = _port_table(table)
+        elif kind == CompiledRules.WILDCARD:
+            layer["wildcard"][slot[1]] = _port_table(table)
+        elif kind == CompiledRules.GEO:
+            layer["geo"] = True
+        elif kind == CompiledRules.IP:
+            if slot[1] == 6:
+                layer["ipv6"] = True
+            else:
+                layer["ipv4"].setdefault(slot[3], {})[str(slot[2])] = _port_table(table)
+    layer["globs"] = [[glob_to_regex(pattern), pattern, not pattern.startswith("*"), _port_table(table)]
+                      for _specificity, pattern, table in compiled.wildcard_domain_rules]
+    layer["ipv4"] = sorted(layer["ipv4"].items(), reverse=True) # Longest prefix first
+    return layer
+
+
+def build_pac(layers: list, engine_address: str, profile_name: str = "",
+              resolve_hostnames: bool = False, sni_ports=()) -> str:
+    """
+    Returns the PAC script for rule layers ([{rule_id: rule_data}], highest precedence
+    first). engine_address is the engine's 'host:port'; hosts routed to a proxy or
+    blocked go there. With resolve_hostnames, hosts no rule matches go there too if a
+    layer has IP or country/AS rules, since only the engine resolves them.
+    """
+    compiled_layers = [compile_layer(rules) for rules in layers]
+    has_ip_rules = any(layer["ipv4"] or layer["ipv6"] or layer["geo"] for layer in compiled_layers)
+    return _PAC_TEMPLATE % {
+        "profile": json.dumps(profile_name),
+        "engine": json.dumps(f"PROXY {engine_address}"),
+        "layers": json.dumps(compiled_layers, separators=(",", ":")),
+        "engine_unmatched": "true" if resolve_hostnames and has_ip_rules else "false",
+        "sni_ports": json.dumps(list(sni_ports)),
+        "engine_value": _ENGINE,
+    }
@@ -1,8 +1,9 @@
+import os
+import ipaddress
 import time
 import threading
 import socket
 import socketserver
-import select
 from urllib.parse import urlparse
 import base64 # For HTTP Basic Auth encoding
 import urllib.request
@@ -16,14 +17,33 @@ except ImportError:
     socks = None
     print("[Engine] Warning: PySocks not found. SOCKS5 proxy support will be disabled.")
 
-from PySide6.QtCore import QObject, Signal
+from PySide6.QtCore import QObject, Signal, QTimer
 
 # Import the matcher using a relative path
-from .rule_matcher import RuleMatcher
+from .dns_cache import DNSCache
+from .geo_db import GeoDatabase
+from .hostnames import cache_stats as hostname_cache_stats, normalize_host
+from .http_proxy import (HTTPParseError, MAX_HEAD_SIZE, find_head_end, parse_request_head, parse_response_head,
+                         request_body, request_target, response_body, rewrite_request_head)
+from .pac import PAC_CONTENT_TYPE, PAC_PATHS, build_pac
+from .relay_loop import RelayLoopGroup
+from .rule_matcher import GLOBAL_PROFILE_ID, RuleMatcher
+from .tls_sni import client_hello_length, parse_sni
+from .rule_stats import RuleStats
 
 # Define default listening port
 DEFAULT_LISTENING_PORT = 8080
 BUFFER_SIZE = 8192 # Increase buffer size slightly
+RULE_STATS_INTERVAL_MS = 2000 # How often per-rule counters are merged and published
+PAC_WRITE_DELAY_MS = 1000 # Rule edits within this delay are written to the PAC file at once
+SNI_PEEK_PORTS = (443, 8443) # CONNECT ports whose ClientHello is read for its server name (see sni_routing)
+SNI_PEEK_TIMEOUT = 3.0 # Seconds to wait for the ClientHello
+HTTP_IDLE_TIMEOUT = 60 # Seconds a kept-alive plain-HTTP client may wait before its next request
+HTTP_UPSTREAM_TIMEOUT = 300 # Seconds without data from the server while a response is awaited
+HTTP_IDLE_UPSTREAMS = 4 # Idle server connections a plain-HTTP client connection keeps for its next requests
+SOCKS_ERRORS = (socks.ProxyConnectionError, socks.GeneralProxyError) if socks else () # Safe in except clauses without PySocks
+BACKEND_THREADS = "threads" # One OS thread per client connection (socketserver)
+BACKEND_ASYNCIO = "asyncio" # All connections on one event loop thread, see async_engine
 
 class HTTPResponseParser:
     def __init__(self, sock):
@@ -87,24 +107,35 @@ class ProxyRequestHandler(socketserver.BaseRequestHandler):
         target_host = "Unknown" # Initialize for logging
         server_socket = None # Initialize server socket
         is_connect = False # Initialize connect flag
+        matched_rule_id = None # Rule credited with the relayed bytes
+        self.bytes_relayed = 0
+        self.tunnel_established = False # '200 Connection Established' already sent
+        self.response_started = False # Part of a plain-HTTP response forwarded, an error response would corrupt it
 
         try:
             # 1. Receive initial data
-            # Use select for non-blocking read initially to get headers
-            self.request.setblocking(False)
-            ready = select.select([self.request], [], [], 5.0) # 5 sec timeout
-            if not ready[0]:
+            # A socket timeout rather than select(), which cannot watch fds above FD_SETSIZE
+            self.request.settimeout(5.0) # 5 sec timeout
+            try:
+                initial_data = self.request.recv(BUFFER_SIZE)
+            except socket.timeout:
                  print(f"[Handler {self.client_address}] No data received from {self.client_address} within timeout.")
                  return
-            initial_data = self.request.recv(BUFFER_SIZE)
             if not initial_data:
                  print(f"[Handler {self.client_address}] Client {self.client_address} disconnected immediately.")
                  return
-            self.request.setblocking(True) # Set back to blocking for relay
+            self.request.settimeout(None) # Set back to blocking for relay
             print(f"[Handler {self.client_address}] Received initial {len(initial_data)} bytes.")
+            if self._serve_pac(initial_data): # A browser fetching its proxy auto-config from us
+                return
 
-            # 2. Parse target host and port
+            # 2. Plain HTTP is read, routed and forwarded request by request; parse the CONNECT target
+            if not self._is_connect(initial_data):
+                self._serve_http(initial_data)
+                return
             target_host, target_port, is_connect, remaining_data = self._parse_request(initial_data)
+            if target_host:
+                target_host = normalize_host(target_host) # Once per connection: punycode, no trailing dot
             if not target_host or not target_port:
                  print(f"[Handler {self.client_address}] Failed to parse target.")
                  self._send_error_response(400, "Bad Request") # Use 400 for bad client request
@@ -117,8 +148,16 @@ class ProxyRequestHandler(socketserver.BaseRequestHandler):
             matched_rule_id = None
             target_proxy_info = None
             # Ensure match is attempted *before* deciding route
-            print(f"[Handler {self.client_address}] Attempting rule match for '{target_host}'...")
-            matched_proxy_id, matched_rule_id = self.engine.rule_matcher.match(target_host, target_port)
+            server_name = None # TLS server name of a CONNECT to an IP address, see sni_routing
+            if is_connect and self.engine.sni_routing and target_port in SNI_PEEK_PORTS and self._is_ip_address(target_host):
+                # The client only names the server once the tunnel is up: confirm it now,
+                # read the ClientHello and connect upstream once the route is decided.
+                self.request.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
+                self.tunnel_established = True
+                server_name, remaining_data = self._peek_server_name()
+                print(f"[Handler {self.client_address}] TLS server name for {target_host}: {server_name or 'none'}")
+            # connect_host: target handed to an upstream proxy, resolved_addresses: reused for a direct connect
+            matched_proxy_id, matched_rule_id, connect_host, resolved_addresses = self._route(target_host, target_port, server_name)
 
             # --- Block Connection logic ---
             if matched_proxy_id == "__BLOCK__":
@@ -142,33 +181,28 @@ class ProxyRequestHandler(socketserver.BaseRequestHandler):
             # 4. Establish upstream connection
             connection_start_time = time.time()
             print(f"[Handler {self.client_address}] Attempting upstream connection to {target_host}:{target_port} {'via proxy' if target_proxy_info else 'directly'}...")
-            if target_proxy_info:
-                 server_socket = self._connect_via_proxy(target_proxy_info, matched_proxy_id, target_host, target_port)
-            else:
-                 server_socket = self._connect_directly(target_host, target_port)
+            server_socket = self._open_upstream(target_proxy_info, matched_proxy_id, target_host, connect_host,
+                                                target_port, resolved_addresses)
 
             connection_time = time.time() - connection_start_time
             print(f"[Handler {self.client_address}] Upstream connection established in {connection_time:.3f}s.")
 
-            # 5. Handle CONNECT method (send 200 OK) or forward initial data
-            if is_connect:
+            # 5. Confirm the tunnel (send 200 OK)
+            if not self.tunnel_established:
                  # Send 200 OK response *immediately* after successful upstream connection
                  print(f"[Handler {self.client_address}] Sending '200 Connection Established' to client.")
                  self.request.sendall(b"HTTP/1.1 200 Connection Established\r\n\r\n")
                  print(f"[Handler {self.client_address}] Sent 200 OK.")
                  # Do NOT forward any initial data for CONNECT requests
-            else:
-                 # Forward the initial data for non-CONNECT requests
-                 if remaining_data:
-                     print(f"[Handler {self.client_address}] Forwarding initial {len(remaining_data)} bytes to {target_host}")
-                     server_socket.sendall(remaining_data)
-                 else:
-                     print(f"[Handler {self.client_address}] No initial data buffered to forward for non-CONNECT.")
+            elif remaining_data:
+                 # Tunnel confirmed before routing: forward the ClientHello read for its server name
+                 server_socket.sendall(remaining_data)
+                 self.bytes_relayed += len(remaining_data)
 
             # 6. Relay data bidirectionally
-            print(f"[Handler {self.client_address}] Starting data relay between client and {target_host}")
-            self._relay_data(server_socket)
-            print(f"[Handler {self.client_address}] Data relay finished.")
+            print(f"[Handler {self.client_address}] Handing relay between client and {target_host} to the relay loop")
+            self._relay_data(server_socket, matched_rule_id, target_host)
+            server_socket = None # Owned and closed by the relay loop now
 
         except ConnectionRefusedError as e:
              print(f"[Handler {self.client_address}] Connection Refused for '{target_host}': {e}")
@@ -179,7 +213,7 @@ class ProxyRequestHandler(socketserver.BaseRequestHandler):
              print(f"[Handler {self.client_address}] Timeout during connection/relay for '{target_host}'")
              if not is_connect or server_socket is None:
                   self._send_error_response(504, "Gateway Timeout")
-        except (NotImplementedError, socks.ProxyConnectionError if socks else None, socks.GeneralProxyError if socks else None) as e:
+        except (NotImplementedError, *SOCKS_ERRORS) as e:
              proxy_name_err = target_proxy_info.get('name','Unknown Proxy') if target_proxy_info else 'N/A'
              print(f"[Handler {self.client_address}] Proxy Error for '{target_host}' via '{proxy_name_err}': {e}")
              if not is_connect or server_socket is None:
@@ -189,28 +223,32 @@ class ProxyRequestHandler(socketserver.BaseRequestHandler):
              if not is_connect or server_socket is None:
                   self._send_error_response(502, "Bad Gateway (DNS Error)")
         except Exception as e:
-             print(f"[Handler {self.client_address}] Unexpected error handling connection for '{target_host}': {e}", exc_info=True)
+             print(f"[Handler {self.client_address}] Unexpected error handling connection for '{target_host}': {e}")
              # Send error only if before successful CONNECT response or if not a CONNECT request at all
              if not is_connect or server_socket is None:
-                 # Check if socket is still writable before sending error
                  try:
-                     # A brief timeout to check writability without blocking forever
-                     _, write_ready, _ = select.select([], [self.request], [], 0.1)
-                     if write_ready:
-                         self._send_error_response(500, "Internal Server Error")
-                     else:
-                         print(f"[Handler {self.client_address}] Client socket not writable, cannot send error.")
+                     # A brief timeout so an unwritable client cannot block the thread
+                     self.request.settimeout(0.1)
+                     self._send_error_response(500, "Internal Server Error")
                  except Exception as send_err:
                      print(f"[Handler {self.client_address}] Error trying to send error response: {send_err}")
         finally:
+             if matched_rule_id and self.bytes_relayed:
+                 self.engine.rule_stats.record(matched_rule_id, hits=0, byte_count=self.bytes_relayed)
              if server_socket:
                  print(f"[Handler {self.client_address}] Closing upstream socket to {target_host}.")
                  server_socket.close()
              print(f"[Handler {self.client_address}] Closing client connection.")
              # self.request (client socket) is closed by socketserver
 
+    @staticmethod
+    def _is_connect(data: bytes) -> bool:
+        """Whether data starts with a CONNECT request; anything else is plain HTTP for _serve_http."""
+        method = data.lstrip().split(None, 1)[:1]
+        return bool(method) and method[0].upper() == b"CONNECT"
+
     def _parse_request(self, data: bytes):
-        """Very basic parsing of HTTP request to find Host or CONNECT target."""
+        """Very basic parsing of a CONNECT request's target (plain HTTP is parsed by http_proxy)."""
         try:
             lines = data.split(b'\r\n')
             request_line = lines[0].decode('utf-8', errors='ignore')
@@ -229,42 +267,298 @@ class ProxyRequestHandler(socketserver.BaseRequestHandler):
                 host_port = url.split(':')
                 host = host_port[0]
                 port = int(host_port[1]) if len(host_port) > 1 else 443 # Default HTTPS port
-            else:
-                # Look for Host header
-                host_header = next((line for line in lines[1:] if line.lower().startswith(b'host:')), None)
-                if host_header:
-                    host_value = host_header.split(b':', 1)[1].strip().decode('utf-8', errors='ignore')
-                    # Check if host header includes port
-                    if ':' in host_value:
-                         host, port_str = host_value.split(':', 1)
-                         port = int(port_str)
-                    else:
-                         host = host_value
-                         # Guess port based on URL scheme if available, else default 80
-                         parsed_url = urlparse(url)
-                         port = 443 if parsed_url.scheme == 'https' else 80 # Default HTTP/HTTPS ports
-                else:
-                    # Fallback: Try parsing host from URL (less reliable for proxies)
-                    parsed_url = urlparse(url)
-                    host = parsed_url.hostname
-                    # Corrected ternary expression for port fallback
-                    port = parsed_url.port if parsed_url.port else (443 if parsed_url.scheme == 'https' else 80)
-
 
-            return host, port, is_connect, data # Return original data as remaining for non-CONNECT
+            return host, port, is_connect, data
         except Exception as e:
             print(f"[Handler] Error parsing request: {e}\nData: {data[:200]}")
             return None, None, False, data
 
 
-    def _connect_directly(self, host: str, port: int, timeout=10):
-        """Establishes a direct TCP connection."""
+    def _serve_pac(self, data: bytes) -> bool:
+        """Answers 'GET /proxy.pac' (or /wpad.dat) sent to the engine itself; False for any other request."""
+        request_line = data.split(b"\r\n", 1)[0].split()
+        if len(request_line) < 2 or request_line[0] not in (b"GET", b"HEAD"):
+            return False
+        path = request_line[1].split(b"?", 1)[0].decode("ascii", errors="ignore")
+        if path not in PAC_PATHS:
+            return False
+        # Point the script at the address the client reached us on
+        body = self.engine.pac_script(self.request.getsockname()[0]).encode("utf-8")
+        header = (f"HTTP/1.1 200 OK\r\nContent-Type: {PAC_CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n"
+                  "Cache-Control: no-cache\r\nConnection: close\r\n\r\n").encode("ascii")
+        self.request.sendall(header if request_line[0] == b"HEAD" else header + body)
+        print(f"[Handler {self.client_address}] Served PAC script ({len(body)} bytes).")
+        return True
+
+    @staticmethod
+    def _is_ip_address(host: str) -> bool:
+        try:
+            ipaddress.ip_address(host)
+            return True
+        except ValueError:
+            return False
+
+    def _route(self, host: str, port: int, server_name: str | None = None) -> tuple:
+        """
+        Matches a request against the rules: by the TLS server name if there is one, then by
+        host, then (with resolve_hostnames) by its addresses against the IP rules. Returns
+        (proxy_id, rule_id, connect_host, resolved_addresses); connect_host is the address an
+        IP rule matched, or host.
+        """
+        matcher = self.engine.rule_matcher
+        proxy_id = rule_id = None
+        if server_name:
+            proxy_id, rule_id = matcher.match(server_name, port)
+        if rule_id is None:
+            print(f"[Handler {self.client_address}] Attempting rule match for '{host}'...")
+            proxy_id, rule_id = matcher.match(host, port)
+        connect_host = host
+        resolved_addresses = None
+        if rule_id is None and self.engine.resolve_hostnames and matcher.has_ip_rules():
+            proxy_id, rule_id, resolved_addresses, matched_address = self._match_resolved(host, port)
+            if matched_address is not None:
+                print(f"[Handler {self.client_address}] '{host}' resolved to {matched_address}, which matched rule {rule_id}.")
+                connect_host = matched_address # The proxy connects to the address the rule was chosen for
+        return proxy_id, rule_id, connect_host, resolved_addresses
+
+    def _open_upstream(self, proxy_info: dict | None, proxy_id: str | None, host: str, connect_host: str, port: int,
+                       addresses: list | None = None):
+        """Connects to host:port through proxy_info, or directly if it is None."""
+        if proxy_info:
+            server_socket = self._connect_via_proxy(proxy_info, proxy_id, connect_host, port)
+            if server_socket is None:
+                raise ConnectionRefusedError(f"Invalid proxy configuration for '{proxy_id}'")
+            return server_socket
+        return self._connect_directly(host, port, addresses=addresses)
+
+    def _serve_http(self, data: bytes):
+        """
+        Proxies the plain-HTTP requests of a client connection one after another: each
+        request is routed by its own target, its body and the response are forwarded with
+        their own framing, and the upstream connection is kept for the next request to the
+        same route. Ends when either side does not keep the connection alive.
+        """
+        client = self.request
+        client.settimeout(HTTP_IDLE_TIMEOUT)
+        buffer = data # Client bytes read but not forwarded yet
+        idle_upstreams = {} # {(proxy_id, host, port): socket} kept open after a response, oldest first
+        upstream = None # Server connection of the current request
+        rule_id = None
+        try:
+            while True:
+                self.response_started = False
+                try:
+                    head, buffer = self._read_head(client, buffer, parse_request_head)
+                except socket.timeout:
+                    return # Idle keep-alive connection
+                except HTTPParseError as e:
+                    print(f"[Handler {self.client_address}] Invalid request: {e}")
+                    self._send_error_response(400, "Bad Request")
+                    return
+                if head is None:
+                    return # Client closed between requests
+                host, port, origin_target = request_target(head)
+                host = normalize_host(host) if host else None
+                if not host or not port or head.method == "CONNECT":
+                    print(f"[Handler {self.client_address}] Failed to parse target of '{head.method} {head.target[:80]}'.")
+                    self._send_error_response(400, "Bad Request")
+                    return
+                try:
+                    body = request_body(head)
+                except HTTPParseError as e:
+                    print(f"[Handler {self.client_address}] Invalid request: {e}")
+                    self._send_error_response(400, "Bad Request")
+                    return
+
+                proxy_id, rule_id, connect_host, addresses = self._route(host, port)
+                if proxy_id == "__BLOCK__":
+                    print(f"[Handler {self.client_address}] BLOCK rule matched for '{host}:{port}'. Blocking request.")
+                    self._send_error_response(403, "Blocked by Rule")
+                    return
+                proxy_info = self.engine._proxies.get(proxy_id) if proxy_id else None
+                route = f"via proxy '{proxy_info.get('name', proxy_id)}'" if proxy_info else "directly"
+                print(f"[Handler {self.client_address}] {head.method} {host}:{port}{origin_target[:80]} routed {route} (Rule: {rule_id}).")
+
+                key = (proxy_id if proxy_info else None, connect_host, port)
+                upstream = idle_upstreams.pop(key, None)
+                if upstream is not None and not self._upstream_idle(upstream):
+                    upstream.close() # The server closed it (or sent something unrequested) since the last response
+                    upstream = None
+                if upstream is None:
+                    upstream = self._open_upstream(proxy_info, proxy_id, host, connect_host, port, addresses)
+                    upstream.settimeout(HTTP_UPSTREAM_TIMEOUT)
+                upstream_buffer = b""
+
+                request_bytes = rewrite_request_head(head, origin_target)
+                upstream.sendall(request_bytes)
+                expect_continue = "100-continue" in head.tokens("expect")
+                if not expect_continue:
+                    buffer, count = self._forward_body(client, upstream, body, buffer)
+                    self.bytes_relayed += count
+                self.bytes_relayed += len(request_bytes)
+
+                # Interim responses, then the final one
+                while True:
+                    response, upstream_buffer = self._read_head(upstream, upstream_buffer, parse_response_head)
+                    if response is None:
+                        raise ConnectionResetError("Server closed the connection without responding")
+                    self.response_started = True
+                    client.sendall(response.raw)
+                    self.bytes_relayed += len(response.raw)
+                    if response.status >= 200 or response.status == 101:
+                        break
+                    if response.status == 100 and expect_continue and not body.done:
+                        buffer, count = self._forward_body(client, upstream, body, buffer)
+                        self.bytes_relayed += count
+                        self.response_started = False
+                if response.status == 101: # Upgraded (e.g. WebSocket): a raw tunnel from now on
+                    if buffer:
+                        upstream.sendall(buffer)
+                    if upstream_buffer:
+                        client.sendall(upstream_buffer)
+                    self._record_bytes(rule_id)
+                    self._relay_data(upstream, rule_id, host)
+                    upstream = None
+                    return
+                response_framer = response_body(response, head.method)
+                upstream_buffer, count = self._forward_body(upstream, client, response_framer, upstream_buffer)
+                self.bytes_relayed += count
+                self._record_bytes(rule_id)
+
+                if not response.keep_alive() or response_framer.kind == response_framer.UNTIL_CLOSE:
+                    return # The client sees the end of the response by the connection closing as well
+                if not head.keep_alive() or not body.done:
+                    return # Also if the server answered an 'Expect: 100-continue' without reading the body
+                if upstream_buffer: # Anything after the response would be mistaken for the next one
+                    upstream.close()
+                else:
+                    idle_upstreams[key] = upstream
+                    if len(idle_upstreams) > HTTP_IDLE_UPSTREAMS:
+                        idle_upstreams.pop(next(iter(idle_upstreams))).close()
+                upstream = None
+                client.settimeout(HTTP_IDLE_TIMEOUT)
+        finally:
+            self._record_bytes(rule_id)
+            if upstream is not None:
+                upstream.close()
+            for idle_upstream in idle_upstreams.values():
+                idle_upstream.close()
+
+    def _read_head(self, sock, buffer: bytes, parse) -> tuple:
+        """Reads from sock until buffer holds a complete head; returns (parsed head or None on EOF, bytes after it)."""
+        while (end := find_head_end(buffer)) < 0:
+            if len(buffer) > MAX_HEAD_SIZE:
+                raise HTTPParseError("Header section too large")
+            chunk = sock.recv(BUFFER_SIZE)
+            if not chunk:
+                if buffer.strip():
+                    raise HTTPParseError("Connection closed in the middle of a header section")
+                return None, b""
+            buffer += chunk
+        return parse(buffer[:end]), buffer[end:]
+
+    @staticmethod
+    def _forward_body(source, destination, framer, buffer: bytes) -> tuple[bytes, int]:
+        """Copies a message body from source (after buffer) to destination; returns (bytes after it, body length)."""
+        count = 0
+        while True:
+            if buffer:
+                length = framer.feed(buffer)
+                if length:
+                    destination.sendall(buffer[:length] if length < len(buffer) else buffer)
+                    count += length
+                buffer = buffer[length:]
+            if framer.done:
+                return buffer, count
+            buffer = source.recv(BUFFER_SIZE)
+            if not buffer:
+                framer.finish() # Raises unless the body ends with the connection
+                return b"", count
+
+    @staticmethod
+    def _upstream_idle(sock) -> bool:
+        """Whether a kept-alive server connection is still open and has sent nothing unrequested."""
+        timeout = sock.gettimeout()
+        try:
+            sock.setblocking(False)
+            sock.recv(1, socket.MSG_PEEK)
+            return False # Data or EOF: not reusable
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            try:
+                sock.settimeout(timeout)
+            except OSError:
+                pass
+
+    def _record_bytes(self, rule_id: str | None):
+        """Credits the bytes relayed since the last call to rule_id."""
+        if rule_id and self.bytes_relayed:
+            self.engine.rule_stats.record(rule_id, hits=0, byte_count=self.bytes_relayed)
+        self.bytes_relayed = 0
+
+    def _peek_server_name(self) -> tuple[str | None, bytes]:
+        """
+        Reads the first client bytes of a confirmed tunnel, up to the end of the first TLS
+        record, and returns (server name of the ClientHello or None, bytes read).
+        The bytes still have to be forwarded upstream.
+        """
+        data = b""
+        self.request.settimeout(SNI_PEEK_TIMEOUT)
+        try:
+            while True:
+                chunk = self.request.recv(BUFFER_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+                needed = client_hello_length(data)
+                if needed is None or len(data) >= needed: # Not TLS, or the record is complete
+                    break
+        except socket.timeout:
+            print(f"[Handler {self.client_address}] No complete ClientHello within {SNI_PEEK_TIMEOUT}s.")
+        finally:
+            self.request.settimeout(None)
+        return parse_sni(data), data
+
+    def _match_resolved(self, host: str, port: int) -> tuple:
+        """
+        Resolves a hostname no domain rule matched and checks its addresses, in resolver
+        order, against the IP rules. Returns (proxy_id, rule_id, addresses, matched_address),
+        with (None, None, addresses, None) if no address matches.
+        """
+        addresses = self.engine.dns_cache.resolve(host, port)
+        matcher = self.engine.rule_matcher
+        for _family, sockaddr in addresses:
+            proxy_id, rule_id = matcher.match(sockaddr[0], port)
+            if rule_id is not None:
+                return proxy_id, rule_id, addresses, sockaddr[0]
+        return None, None, addresses, None
+
+    def _connect_directly(self, host: str, port: int, timeout=10, addresses: list | None = None):
+        """
+        Establishes a direct TCP connection, trying each address of host in turn.
+        addresses ([(family, sockaddr)]) skips the lookup when the host was resolved already;
+        otherwise it goes through the engine's shared DNS cache.
+        """
         try:
             print(f"[Handler] Connecting directly to {host}:{port}...")
-            # Use create_connection which handles IPv4/IPv6 and DNS resolution
-            s = socket.create_connection((host, port), timeout=timeout)
-            print(f"[Handler] Direct connection established to {s.getpeername()}.")
-            return s
+            if addresses is None:
+                addresses = self.engine.dns_cache.resolve(host, port)
+            last_error = None
+            for family, sockaddr in addresses:
+                s = socket.socket(family, socket.SOCK_STREAM)
+                try:
+                    s.settimeout(timeout)
+                    s.connect(sockaddr)
+                except OSError as e:
+                    s.close()
+                    last_error = e
+                    continue
+                print(f"[Handler] Direct connection established to {s.getpeername()}.")
+                return s
+            raise last_error or OSError(f"No addresses for {host}")
         except socket.gaierror as e:
              print(f"[Handler] DNS Error connecting directly to {host}: {e}")
              raise # Re-raise to be caught by main handler exception block
@@ -368,7 +662,7 @@ class ProxyRequestHandler(socketserver.BaseRequestHandler):
             return s
 
         # Keep specific exception catching for proxy errors
-        except (socks.ProxyConnectionError, socks.GeneralProxyError, ConnectionRefusedError) as e:
+        except (*SOCKS_ERRORS, ConnectionRefusedError) as e:
             print(f"[Handler] Proxy connection error via '{proxy_name}': {e}")
             if s: s.close()
             raise e
@@ -378,57 +672,25 @@ class ProxyRequestHandler(socketserver.BaseRequestHandler):
                 raise e
 
 
-    def _relay_data(self, server_socket):
-        """Relays data between self.request (client) and server_socket (upstream)."""
-        client_socket = self.request
-        sockets = [client_socket, server_socket]
-        client_addr = self.client_address # Cache for logging
-        target_peer = server_socket.getpeername() if server_socket else "N/A" # Cache for logging
+    def _relay_data(self, server_socket, rule_id: str | None = None, target_host: str = ""):
+        """
+        Hands the client socket and server_socket to the engine's shared relay loop, which
+        relays both directions until either side closes and then closes both. The handler
+        thread returns right away; the loop credits the relayed bytes to rule_id.
+        """
+        client_socket = socket.socket(fileno=self.request.detach()) # socketserver must not shut it down on return
+        rule_stats = self.engine.rule_stats
 
-        while True:
-            try:
-                # Wait for readiness or error using select
-                readable, writable, exceptional = select.select(sockets, [], sockets, 15.0) # Increased timeout slightly
-
-                if exceptional:
-                     print(f"[Relay {client_addr} <-> {target_peer}] Exceptional condition on socket.")
-                     break # Abort relay
-
-                if not readable:
-                     # Timeout: Check if sockets are still valid, otherwise break
-                     # Basic check: try a non-blocking recv of 0 bytes
-                     try:
-                         if client_socket.recv(0, socket.MSG_PEEK) == b'' or server_socket.recv(0, socket.MSG_PEEK) == b'':
-                             print(f"[Relay {client_addr} <-> {target_peer}] Socket closed during idle timeout check.")
-                             break
-                     except BlockingIOError: pass # Expected if socket is alive and idle
-                     except Exception as check_err:
-                         print(f"[Relay {client_addr} <-> {target_peer}] Error checking socket liveness: {check_err}")
-                         break
-                     continue # Continue loop if sockets seem okay
-
-                for sock in readable:
-                    peer = server_socket if sock is client_socket else client_socket
-                    data = sock.recv(BUFFER_SIZE)
-                    if not data:
-                        # Socket closed by peer
-                        peer_desc = 'client' if sock is client_socket else 'server'
-                        print(f"[Relay {client_addr} <-> {target_peer}] Peer ({peer_desc}) disconnected.")
-                        return # End relay normally
-
-                    # print(f"[Relay {client_addr} -> {'server' if sock is client_socket else 'client'}] Sending {len(data)} bytes") # Very verbose
-                    peer.sendall(data)
-
-            except socket.error as e:
-                # More specific error handling (e.g., ConnectionResetError)
-                print(f"[Relay {client_addr} <-> {target_peer}] Socket error during relay: {e}")
-                return # End relay on error
-            except Exception as e:
-                 print(f"[Relay {client_addr} <-> {target_peer}] Unexpected error during relay: {e}", exc_info=True)
-                 return # End relay on error
+        def on_close(byte_count):
+            if rule_id and byte_count:
+                rule_stats.record(rule_id, hits=0, byte_count=byte_count)
+
+        self.engine.relay_loop.add(client_socket, server_socket, on_close, f"{self.client_address} <-> {target_host}")
 
     def _send_error_response(self, code: int, message: str):
         """Sends a basic HTTP error response to the client."""
+        if self.tunnel_established or self.response_started:
+            return # The client got 200 already and speaks TLS now (or is reading a response), closing is all that is left
         try:
             response = f"HTTP/1.1 {code} {message}\r\nConnection: close\r\nContent-Length: 0\r\n\r\n"
             self.request.sendall(response.encode())
@@ -452,17 +714,43 @@ class ProxyEngine(QObject):
     status_changed = Signal(str) # Overall engine status
     error_occurred = Signal(str)
     proxy_test_result = Signal(str, bool) # Emits (proxy_id, is_ok)
+    rule_stats_updated = Signal(dict) # Emits {rule_id: (hits, bytes)} while running
 
     def __init__(self, parent=None):
         super().__init__(parent)
         self._is_active = False
         self._proxies = {}
-        self.rule_matcher = RuleMatcher()
+        self.rule_stats = RuleStats() # Shared by every profile's matcher
+        self.global_matcher = RuleMatcher(self.rule_stats) # Global rules, the base layer of every profile's matcher
+        self.rule_matcher = RuleMatcher(self.rule_stats, self.global_matcher) # Matcher of the active profile
+        self._profile_matchers = {} # {profile_id: RuleMatcher}, compiled on first use
+        self._profile_rules = {}    # {profile_id: {rule_id: rule_data}}, the engine's copy of every profile's rules
+        self._rule_profiles = {}    # {rule_id: profile_id}
+        self._profile_versions = {} # {profile_id: n}, bumped whenever the rules of a profile change
+        self._compiled_versions = {GLOBAL_PROFILE_ID: 0} # {profile_id: n} the profile's matcher is up to date with
         self._lock = threading.Lock()
         self._tcp_server = None
         self._server_thread = None
+        self.relay_loop = RelayLoopGroup() # Relays the established tunnels of the threaded backend
         self.listening_port = DEFAULT_LISTENING_PORT
+        self.backend = BACKEND_THREADS # Server implementation, applied on the next start()
         self.active_profile_id = None # Store active ID used by matcher
+        self.rule_index_path = None # Compiled rule index file, reused while the rules are unchanged
+        self.dns_cache = DNSCache() # Shared by every handler's direct connects
+        self.resolve_hostnames = False # Resolve hostnames no domain rule matches and try their addresses against IP rules
+        self.sni_routing = False # Route CONNECTs to an IP address by the server name of their TLS ClientHello
+        self.geo_database = None # GeoDatabase behind 'geo:' / 'asn:' rules, see set_geo_databases
+        self.pac_path = None # PAC script file kept in sync with the rules, see write_pac_file
+        self._pac_lock = threading.Lock()
+        self._pac_cache = (None, None) # (rules/settings key, script) of the last built PAC script
+        self._pac_timer = QTimer(self) # Batches rule edits into one PAC file write
+        self._pac_timer.setSingleShot(True)
+        self._pac_timer.setInterval(PAC_WRITE_DELAY_MS)
+        self._pac_timer.timeout.connect(self.write_pac_file)
+        self._published_rule_stats = {}
+        self._rule_stats_timer = QTimer(self) # Merges the handlers' per-thread counters
+        self._rule_stats_timer.setInterval(RULE_STATS_INTERVAL_MS)
+        self._rule_stats_timer.timeout.connect(self._publish_rule_stats)
 
         # --- Network Interception ---
         # The current implementation uses socketserver to create an explicit proxy
@@ -483,26 +771,215 @@ class ProxyEngine(QObject):
 
     def update_config(self, all_rules: dict, proxies: dict, active_profile_id: str):
         """
-        Updates the engine's proxies and filters rules for the RuleMatcher
-        based on the currently active profile ID.
+        Updates the engine's proxies and rules and switches the RuleMatcher to the
+        currently active profile. Every profile keeps its compiled matcher until its rules
+        change (see _rules_changed); only profiles whose rules differ from the engine's
+        copy are recompiled. Global rules (profile_id GLOBAL_PROFILE_ID) are compiled once
+        into the base layer shared by all profile matchers. To only switch profiles, use
+        set_active_profile.
         """
         with self._lock: # Protect access to shared resources if needed
             self._proxies = proxies.copy() # Update internal proxy copy for handlers
             self.active_profile_id = active_profile_id # Store the active profile
 
-            # Filter rules for the active profile
-            active_rules = {
-                rule_id: rule_data for rule_id, rule_data in all_rules.items()
-                if rule_data.get('profile_id') == active_profile_id and rule_data.get('enabled', True) # Only consider enabled rules
-            }
+            # Group rules by profile. Disabled rules are passed along too,
+            # the matcher skips them but keeps them around for set_rule_enabled.
+            rules_by_profile = {}
+            for rule_id, rule_data in all_rules.items():
+                rules_by_profile.setdefault(rule_data.get('profile_id'), {})[rule_id] = dict(rule_data)
+            for profile_id in self._profile_rules.keys() | rules_by_profile.keys():
+                if self._profile_rules.get(profile_id, {}) != rules_by_profile.get(profile_id, {}): # Rule order aside
+                    self._rules_changed(profile_id)
+            self._profile_rules = rules_by_profile
+            self._rule_profiles = {rule_id: rule_data.get('profile_id') for rule_id, rule_data in all_rules.items()}
+            global_rules = rules_by_profile.get(GLOBAL_PROFILE_ID, {})
+            active_rules = rules_by_profile.get(active_profile_id, {})
 
         print(f"[Engine] Updating config for active profile '{active_profile_id}'.")
-        print(f"[Engine] Received {len(all_rules)} total rules, filtered to {len(active_rules)} active rules.")
+        print(f"[Engine] Received {len(all_rules)} total rules, {len(active_rules)} rules of the active profile, "
+              f"{len(global_rules)} global rules.")
         print(f"[Engine] Received {len(proxies)} proxies.")
 
-        # Update the rule matcher with only the active profile's rules
-        self.rule_matcher.update_rules(active_rules)
-        print(f"[Engine] Configuration updated. Matcher has {self.rule_matcher.rule_count()} rules for the active profile.")
+        cache_stats = self.rule_matcher.cache_stats()
+        print(f"[Engine] Match cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+              f"{cache_stats['evictions']} evictions ({cache_stats['hit_rate']:.0%} hit rate) for the previous rules.")
+        hostname_stats = hostname_cache_stats()
+        print(f"[Engine] Hostname normalization cache: {hostname_stats['size']} hosts, "
+              f"{hostname_stats['hit_rate']:.0%} hit rate.")
+        self._activate_rules(active_profile_id)
+        print(f"[Engine] Configuration updated. Matcher has {self.rule_matcher.rule_count()} rules for the active profile "
+              f"and {self.global_matcher.rule_count()} global rules.")
+        self.schedule_pac_write()
+
+    def set_active_profile(self, active_profile_id: str):
+        """
+        Switches to another profile with the rules the engine already has: a lookup of
+        its cached matcher, compiled only if the profile is new or its rules changed since.
+        """
+        with self._lock:
+            self.active_profile_id = active_profile_id
+        print(f"[Engine] Switching to profile '{active_profile_id}'.")
+        self._activate_rules(active_profile_id)
+        self.schedule_pac_write()
+
+    def _activate_rules(self, active_profile_id: str):
+        """Recompiles the global layer and the profile's matcher if their rules changed, then swaps the matcher in."""
+        if self._compiled_versions.get(GLOBAL_PROFILE_ID) != self._profile_versions.get(GLOBAL_PROFILE_ID, 0):
+            # Compile the global rules; the profile matchers pick up the new layer on their next lookup
+            self._compiled_versions[GLOBAL_PROFILE_ID] = self._profile_versions.get(GLOBAL_PROFILE_ID, 0)
+            self.global_matcher.update_rules(self._profile_rules.get(GLOBAL_PROFILE_ID, {}),
+                                             self._rule_index_path_for(GLOBAL_PROFILE_ID))
+        matcher = self._profile_matchers.get(active_profile_id)
+        version = self._profile_versions.get(active_profile_id, 0)
+        if matcher is not None and self._compiled_versions.get(active_profile_id) == version:
+            print(f"[Engine] Reusing compiled rules of profile '{active_profile_id}'.")
+        else:
+            if matcher is None:
+                matcher = RuleMatcher(self.rule_stats, self.global_matcher)
+                matcher.set_geo_database(self.geo_database)
+            # Compile the active profile's rules
+            matcher.update_rules(self._profile_rules.get(active_profile_id, {}), self._rule_index_path_for(active_profile_id))
+            self._profile_matchers[active_profile_id] = matcher
+            self._compiled_versions[active_profile_id] = version
+        self.rule_matcher = matcher # Single reference swap, handlers pick it up on their next match
+
+    def _rules_changed(self, profile_id: str, applied: bool = False):
+        """
+        Bumps the rule version of a profile. applied: the edit was made to its live matcher
+        (the active profile's or the global layer) as well. Otherwise the profile's cached
+        matcher is out of date; that of an inactive profile is dropped, to be compiled again
+        when the profile becomes active.
+        """
+        version = self._profile_versions.get(profile_id, 0) + 1
+        self._profile_versions[profile_id] = version
+        if applied:
+            self._compiled_versions[profile_id] = version
+        elif profile_id not in (self.active_profile_id, GLOBAL_PROFILE_ID):
+            self._profile_matchers.pop(profile_id, None)
+
+    def _store_rule(self, rule_id: str, rule_data: dict | None):
+        """Applies one edit (rule_data None: removal) to the engine's copy of the rules, see add_rule."""
+        with self._lock:
+            old_profile_id = self._rule_profiles.get(rule_id, None)
+            new_profile_id = rule_data.get('profile_id') if rule_data is not None else None
+            changed = []
+            if rule_id in self._rule_profiles and (rule_data is None or old_profile_id != new_profile_id):
+                del self._rule_profiles[rule_id]
+                self._profile_rules.get(old_profile_id, {}).pop(rule_id, None)
+                changed.append(old_profile_id)
+            if rule_data is not None:
+                self._profile_rules.setdefault(new_profile_id, {})[rule_id] = dict(rule_data) # Keeps its position if edited in place
+                self._rule_profiles[rule_id] = new_profile_id
+                changed.append(new_profile_id)
+            for profile_id in changed:
+                self._rules_changed(profile_id, applied=profile_id in (self.active_profile_id, GLOBAL_PROFILE_ID))
+
+    def set_geo_databases(self, paths: list) -> bool:
+        """
+        Opens the country/ASN databases (MaxMind .mmdb or compiled .geodb files) the
+        'geo:' and 'asn:' rules are matched against, and hands them to every matcher.
+        An empty list turns those rules off. Returns False if a database cannot be
+        opened, keeping the previous ones.
+        """
+        geo_database = None
+        if paths:
+            try:
+                geo_database = GeoDatabase(paths)
+            except (OSError, ValueError) as e:
+                print(f"[Engine] Error: Could not open geo database: {e}")
+                return False
+        # The previous databases are not closed: lookups in flight may still be using them
+        self.geo_database = geo_database
+        with self._lock:
+            matchers = [self.global_matcher, self.rule_matcher, *self._profile_matchers.values()]
+        for matcher in dict.fromkeys(matchers):
+            matcher.set_geo_database(geo_database)
+        print(f"[Engine] Geo databases: {', '.join(paths) if paths else 'none'}.")
+        self.schedule_pac_write()
+        return True
+
+    def pac_script(self, engine_host: str = "127.0.0.1") -> str:
+        """
+        Returns the PAC script of the active profile's and the global rules, which sends
+        proxied and blocked hosts to the engine at engine_host and everything else
+        directly. It is rebuilt only when the rules or the routing settings change.
+        """
+        matcher = self.rule_matcher
+        key = (matcher, matcher.generation, engine_host, self.listening_port, self.resolve_hostnames, self.sni_routing)
+        with self._pac_lock:
+            cached_key, script = self._pac_cache
+            if cached_key != key:
+                layers = [matcher.loaded_rules(), self.global_matcher.loaded_rules()]
+                script = build_pac(layers, f"{engine_host}:{self.listening_port}", str(self.active_profile_id),
+                                   self.resolve_hostnames, SNI_PEEK_PORTS if self.sni_routing else ())
+                self._pac_cache = (key, script)
+        return script
+
+    def schedule_pac_write(self):
+        """Rewrites the PAC file shortly, once for a burst of rule or setting changes."""
+        if self.pac_path:
+            self._pac_timer.start()
+
+    def write_pac_file(self) -> bool:
+        """Writes pac_script() to pac_path (through a temporary file). Returns False on failure."""
+        if not self.pac_path:
+            return False
+        try:
+            temp_path = self.pac_path + ".tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                f.write(self.pac_script())
+            os.replace(temp_path, self.pac_path)
+        except OSError as e:
+            print(f"[Engine] Warning: Could not write PAC file '{self.pac_path}': {e}")
+            return False
+        print(f"[Engine] Wrote PAC file '{self.pac_path}'.")
+        return True
+
+    def _rule_index_path_for(self, profile_id: str) -> str | None:
+        """Rule index path of a profile, named after rule_index_path (each rule set adds its digest, see RuleMatcher.update_rules)."""
+        if not self.rule_index_path or not profile_id:
+            return None
+        base, ext = os.path.splitext(self.rule_index_path)
+        return f"{base}-{profile_id}{ext}"
+
+    def add_rule(self, rule_id: str, rule_data: dict):
+        """
+        Applies one added or edited rule to the matcher without reloading the others.
+        Global rules go to the global layer; rules moved out of the active profile (or
+        out of the global layer) are dropped from the matcher they left. Edits of inactive
+        profiles are kept for when the profile is activated.
+        """
+        self._store_rule(rule_id, rule_data)
+        profile_id = rule_data.get('profile_id')
+        if profile_id == GLOBAL_PROFILE_ID:
+            self.rule_matcher.remove_rule(rule_id)
+            self.global_matcher.add_rule(rule_id, rule_data)
+        else:
+            self.global_matcher.remove_rule(rule_id)
+            if profile_id == self.active_profile_id:
+                self.rule_matcher.add_rule(rule_id, rule_data)
+            else:
+                self.rule_matcher.remove_rule(rule_id)
+        self.schedule_pac_write()
+
+    def remove_rule(self, rule_id: str):
+        """Removes one rule from the matchers without reloading the others."""
+        self._store_rule(rule_id, None)
+        self.rule_matcher.remove_rule(rule_id)
+        self.global_matcher.remove_rule(rule_id)
+        self.schedule_pac_write()
+
+    def set_rule_enabled(self, rule_id: str, enabled: bool):
+        """Enables or disables one rule in the matchers without reloading the others."""
+        with self._lock:
+            profile_id = self._rule_profiles.get(rule_id)
+            rule_data = self._profile_rules.get(profile_id, {}).get(rule_id)
+            if rule_data is not None and rule_data.get('enabled', True) != enabled:
+                rule_data['enabled'] = enabled
+                self._rules_changed(profile_id, applied=profile_id in (self.active_profile_id, GLOBAL_PROFILE_ID))
+        self.rule_matcher.set_enabled(rule_id, enabled)
+        self.global_matcher.set_enabled(rule_id, enabled)
+        self.schedule_pac_write()
 
     def start(self):
         """Starts the proxy engine."""
@@ -520,14 +997,19 @@ class ProxyEngine(QObject):
         self.status_changed.emit("starting")
 
         # The rule matcher should have been updated via update_config already
-        if self.rule_matcher.rule_count() == 0:
+        if self.rule_matcher.rule_count() == 0 and self.global_matcher.rule_count() == 0:
              print(f"[Engine] Warning: Starting with no rules enabled for active profile '{self.active_profile_id}'.")
 
         try:
             ProxyRequestHandler.engine = self
-            print(f"[Engine] Starting TCP server on port {self.listening_port} for profile '{self.active_profile_id}'...")
-            self._tcp_server = ThreadingTCPServer(("", self.listening_port), ProxyRequestHandler)
-            self._tcp_server.engine_instance = self # Pass engine reference to server
+            print(f"[Engine] Starting {self.backend} TCP server on port {self.listening_port} for profile '{self.active_profile_id}'...")
+            if self.backend == BACKEND_ASYNCIO:
+                from .async_engine import AsyncProxyServer # Imported here, it builds on this module
+                self._tcp_server = AsyncProxyServer(("", self.listening_port), self)
+            else:
+                self.relay_loop.start()
+                self._tcp_server = ThreadingTCPServer(("", self.listening_port), ProxyRequestHandler)
+                self._tcp_server.engine_instance = self # Pass engine reference to server
             self._server_thread = threading.Thread(target=self._tcp_server.serve_forever, daemon=True)
             self._server_thread.start()
             print(f"[Engine] Server thread started.")
@@ -536,6 +1018,7 @@ class ProxyEngine(QObject):
             if not self._server_thread.is_alive():
                  raise RuntimeError(f"Server thread failed (Port {self.listening_port} likely in use).")
 
+            self._rule_stats_timer.start()
             self.status_changed.emit("active") # Emit 'active' on success
             print("[Engine] Started successfully.")
             return True
@@ -545,6 +1028,7 @@ class ProxyEngine(QObject):
             self.error_occurred.emit(error_msg)
             self.status_changed.emit("error") # Ensure status is error
             self._is_active = False
+            self.relay_loop.stop()
             if self._tcp_server:
                 try: self._tcp_server.server_close()
                 except: pass
@@ -569,6 +1053,7 @@ class ProxyEngine(QObject):
              self._tcp_server.server_close() # Close listening socket
              print("[Engine] TCP server shut down.")
         except Exception as e: print(f"[Engine] Error during server shutdown: {e}")
+        self.relay_loop.stop() # Closes the open tunnels
 
         if self._server_thread and self._server_thread.is_alive():
             print("[Engine] Waiting for server thread...")
@@ -578,9 +1063,18 @@ class ProxyEngine(QObject):
         self._tcp_server = None
         self._server_thread = None
         self._is_active = False
+        self._rule_stats_timer.stop()
+        self._publish_rule_stats() # Final counts of the connections that just ended
         self.status_changed.emit("inactive") # Emit 'inactive' on completion
         print("[Engine] Stopped.")
 
+    def _publish_rule_stats(self):
+        """Merges the per-rule counters and emits them if anything changed."""
+        totals = self.rule_stats.merge()
+        if totals != self._published_rule_stats:
+            self._published_rule_stats = totals
+            self.rule_stats_updated.emit(dict(totals))
+
     def test_proxy(self, proxy_id: str):
         """Tests connectivity through a specific proxy (async)."""
         print(f"[Engine] Requesting test for proxy ID: {proxy_id}")
@@ -0,0 +1,185 @@
+"""
+Offline routing replay: feeds a host list or an access log through one profile's rules
+(on top of the global rules) and prints the routing decisions and the matching throughput.
+
+    python -m src.core.route_replay hosts.txt --profile "Work VPN"
+    python -m src.core.route_replay access.log --settings path/to/settings.ini --summary
+    python -m src.core.route_replay hosts.txt --report   # Also list duplicate and redundant rules
+    python -m src.core.route_replay ips.txt --geo-db GeoLite2-Country.mmdb   # For geo: / asn: rules
+
+Input lines may be 'host', 'host:port', 'host port', a URL, or an access log line
+containing a URL or a 'CONNECT host:port' request. '-' reads from stdin.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+from .geo_db import GeoDatabase
+from .rule_matcher import GLOBAL_PROFILE_ID, RuleMatcher
+
+_CONNECT_RE = re.compile(r"\bCONNECT\s+(\[[0-9a-fA-F:.]+\]|[^\s:/]+):(\d+)")
+_URL_RE = re.compile(r"\b(https?)://(\[[0-9a-fA-F:.]+\]|[^\s:/?#\"]+)(?::(\d+))?")
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def parse_target(line: str, default_port: int | None = None) -> tuple[str, int | None] | None:
+    """Extracts (host, port) from a host list or access log line, None if there is none."""
+    match = _CONNECT_RE.search(line)
+    if match:
+        return match.group(1).strip("[]"), int(match.group(2))
+    match = _URL_RE.search(line)
+    if match:
+        scheme, host, port = match.groups()
+        return host.strip("[]"), int(port) if port else _DEFAULT_PORTS[scheme]
+    fields = line.split()
+    if not fields or fields[0].startswith("#"):
+        return None
+    host = fields[0]
+    if len(fields) > 1 and fields[1].isdigit():
+        return host, int(fields[1])
+    if host.startswith("["): # [v6]:port
+        address, _, port = host[1:].partition("]:")
+        return address.rstrip("]"), int(port) if port.isdigit() else default_port
+    if host.count(":") == 1: # host:port (more colons: a bare IPv6 address)
+        name, _, port = host.partition(":")
+        if port.isdigit():
+            return name, int(port)
+    return host, default_port
+
+
+def default_settings_file() -> str:
+    """The settings.ini the application uses (QStandardPaths AppConfigLocation)."""
+    from PySide6.QtCore import QCoreApplication, QStandardPaths
+    QCoreApplication.setOrganizationName("wyrtensi")
+    QCoreApplication.setApplicationName("ProxieWy")
+    config_dir = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.AppConfigLocation)
+    return os.path.join(config_dir, "settings.ini")
+
+
+def _read_group(settings, name: str) -> dict:
+    """Reads a settings section stored as one group per item, or as the old JSON blob."""
+    settings.beginGroup(name)
+    items = {}
+    child_groups = settings.childGroups()
+    if child_groups:
+        for group in child_groups:
+            settings.beginGroup(group)
+            item = {k: settings.value(k, type=str) for k in settings.childKeys()}
+            items[str(item.get("id", group))] = item
+            settings.endGroup()
+    else:
+        try:
+            items = json.loads(settings.value("data_json", defaultValue="{}", type=str))
+        except json.JSONDecodeError:
+            items = {}
+    settings.endGroup()
+    return items if isinstance(items, dict) else {}
+
+
+def load_settings(settings_file: str) -> tuple[dict, dict, dict, str | None]:
+    """Returns (profiles, proxies, rules, active_profile_id) from a settings.ini."""
+    from PySide6.QtCore import QSettings
+    settings = QSettings(settings_file, QSettings.Format.IniFormat)
+    profiles = _read_group(settings, "profiles")
+    proxies = _read_group(settings, "proxies")
+    rules = _read_group(settings, "rules")
+    for rule in rules.values():
+        enabled = rule.get("enabled", True)
+        if isinstance(enabled, str): # Same normalization as MainWindow.load_settings
+            rule["enabled"] = enabled.lower() in ("true", "1", "yes")
+    active_profile_id = settings.value("ui/active_profile_id", defaultValue=None, type=str)
+    return profiles, proxies, rules, active_profile_id
+
+
+def _resolve_profile(profiles: dict, wanted: str | None, active_profile_id: str | None) -> str | None:
+    if not wanted:
+        return active_profile_id if active_profile_id in profiles else next(iter(profiles), None)
+    if wanted in profiles:
+        return wanted
+    for profile_id, profile in profiles.items():
+        if profile.get("name", "").lower() == wanted.lower():
+            return profile_id
+    return None
+
+
+def main(argv: list | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay hosts or an access log through a profile's routing rules.")
+    parser.add_argument("input", help="Host list or access log ('-' for stdin)")
+    parser.add_argument("--settings", help="settings.ini to read (default: the application's)")
+    parser.add_argument("--profile", help="Profile name or id (default: the active profile)")
+    parser.add_argument("--port", type=int, default=None, help="Port for entries without one (default: any)")
+    parser.add_argument("--summary", action="store_true", help="Only print totals, not every decision")
+    parser.add_argument("--report", action="store_true",
+                        help="Print the duplicate, conflicting and shadowed rules found while compiling")
+    parser.add_argument("--geo-db", action="append", default=[], metavar="PATH",
+                        help="Country/ASN database (.mmdb or .geodb) for geo: and asn: rules, may be repeated")
+    args = parser.parse_args(argv)
+
+    settings_file = args.settings or default_settings_file()
+    if not os.path.exists(settings_file):
+        print(f"[Replay] Error: Settings file not found: {settings_file}", file=sys.stderr)
+        return 2
+    profiles, proxies, rules, active_profile_id = load_settings(settings_file)
+    profile_id = _resolve_profile(profiles, args.profile, active_profile_id)
+    if profile_id is None:
+        print(f"[Replay] Error: Profile '{args.profile}' not found.", file=sys.stderr)
+        return 2
+    profile_rules = {rule_id: rule for rule_id, rule in rules.items() if rule.get("profile_id") == profile_id}
+    global_rules = {rule_id: rule for rule_id, rule in rules.items() if rule.get("profile_id") == GLOBAL_PROFILE_ID}
+
+    try:
+        geo_database = GeoDatabase(args.geo_db) if args.geo_db else None
+    except (OSError, ValueError) as e:
+        print(f"[Replay] Error: Could not open geo database: {e}", file=sys.stderr)
+        return 2
+
+    global_matcher = RuleMatcher()
+    global_matcher.set_geo_database(geo_database)
+    global_matcher.update_rules(global_rules)
+    matcher = RuleMatcher(global_matcher.rule_stats, global_matcher)
+    matcher.set_geo_database(geo_database)
+    matcher.update_rules(profile_rules)
+    if args.report:
+        for layer, layer_matcher in (("global", global_matcher), ("profile", matcher)):
+            for line in layer_matcher.compile_report.format(rules):
+                print(f"[Replay] {layer} {line}")
+
+    stream = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8", errors="replace")
+    with stream:
+        targets = [target for target in (parse_target(line, args.port) for line in stream) if target]
+
+    start = time.perf_counter()
+    decisions = matcher.match_many(targets)
+    elapsed = time.perf_counter() - start
+
+    def route_name(proxy_id) -> str:
+        if proxy_id is None:
+            return "Direct"
+        if proxy_id == "__BLOCK__":
+            return "Block"
+        return proxies.get(proxy_id, {}).get("name", proxy_id)
+
+    routes = Counter()
+    out = sys.stdout
+    for (host, port), (proxy_id, rule_id) in zip(targets, decisions):
+        route = route_name(proxy_id)
+        routes[route] += 1
+        if not args.summary:
+            rule = profile_rules.get(rule_id) or global_rules.get(rule_id)
+            rule_target = rule.get("domain") if rule else "-"
+            out.write(f"{host}:{port if port is not None else '*'}\t{route}\t{rule_target}\n")
+
+    profile_name = profiles[profile_id].get("name", profile_id)
+    print(f"[Replay] {len(targets)} targets through profile '{profile_name}' ({len(profile_rules)} rules, {len(global_rules)} global) "
+          f"in {elapsed:.3f}s ({len(targets) / elapsed if elapsed else 0:,.0f} lookups/s).")
+    for route, count in routes.most_common():
+        print(f"[Replay]   {route}: {count}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,344 @@
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import sys
+import zlib
+from bisect import bisect_left
+
+from .bloom_filter import BloomFilter
+
+INDEX_MAGIC = b"PWRIDX\0\0"
+INDEX_VERSION = 5 # Bump whenever the layout below (or what it holds) changes, old files are then rebuilt
+DOMAIN_FILTER_MIN_KEYS = 50000 # Domain keys from which the index carries a Bloom prefilter
+DOMAIN_FILTER_FP_RATE = 0.01
+
+# Header: magic, version, rule set digest, enabled rule counts (exact, wildcard, glob, ip,
+# geo), then the file offsets of the sections (exact, wildcard, glob, geo, ipv4, ipv6,
+# strings, domain filter; 0 if there is no filter).
+_HEADER = struct.Struct("<8sH2x32s5I8Q")
+_FILTER_HEADER = struct.Struct("<I4xQQ") # hash count, 64-bit word count, key count
+_PORT_RECORD = struct.Struct("<BHHII") # kind, start, end, proxy string, rule string
+_NO_STRING = 0xFFFFFFFF                # Stands for None (e.g. proxy_id of a Direct rule)
+_KIND_ANY, _KIND_PORT, _KIND_RANGE = 0, 1, 2
+_KIND_NAMES = ("exact", "wildcard", "glob", "ip", "geo") # Slot kinds, see CompiledRules.rule_slots
+_IP_BITS = {4: 32, 6: 128}
+
+#
+# Layout (all integers little-endian, every section 4-byte aligned):
+#   port table:  u32 n, n x _PORT_RECORD
+#   key section: u32 n, u32 bucket_bits, u32 buckets[2 ** bucket_bits + 1], u32 hashes[n],
+#                u32 key_offsets[n + 1], u32 table_offsets[n], key blob (UTF-8). Keys are
+#                sorted by CRC-32; buckets[h >> (32 - bucket_bits)] is the first key of
+#                that hash prefix, so a lookup bisects a handful of hashes.
+#   ip section:  u32 directory[(bits + 1) * 2] of (first record, record count) per prefix
+#                length, u32 heads[n] (top 32 bits of each network), u32 table_offsets[n],
+#                u8 networks[n][16] (big-endian). Records are grouped by prefix length,
+#                longest first, and sorted by network within a group.
+#   strings:     u32 n, u32 offsets[n + 1], blob
+#   filter:      _FILTER_HEADER, Bloom filter bits over every exact domain and '*.suffix'
+#                suffix, so most lookups of unlisted hosts never search the key tables
+#
+
+
+def rules_digest(rules: dict) -> bytes:
+    """
+    Content hash of a rule set, {rule_id: rule_data} in rule order. Pickling is by far
+    the cheapest canonical-enough encoding; anything that changes it (a field order,
+    another Python version) only costs one recompile.
+    """
+    return hashlib.sha256(pickle.dumps(rules, protocol=4)).digest()
+
+
+def index_file(path: str, digest: bytes) -> str:
+    """
+    File holding the index of the rule set with this digest, 'rules-P.idx' ->
+    'rules-P.<digest>.idx'. A changed rule set gets a new file instead of replacing
+    the one the previous snapshot still has mapped, which Windows does not allow.
+    """
+    base, ext = os.path.splitext(path)
+    return f"{base}.{digest[:8].hex()}{ext}"
+
+
+def remove_stale_indexes(path: str, keep: str):
+    """
+    Deletes the index files of other rule sets written for path, except keep. Files
+    still mapped by a snapshot cannot be deleted on Windows; a later call gets them.
+    """
+    base, ext = os.path.splitext(path)
+    directory, prefix = os.path.split(base)
+    try:
+        names = os.listdir(directory or ".")
+    except OSError:
+        return
+    for name in names:
+        stem = name[len(prefix) + 1:len(name) - len(ext)] if name.startswith(prefix + ".") and name.endswith(ext) else ""
+        if name != prefix + ext and (len(stem) != 16 or any(c not in "0123456789abcdef" for c in stem)):
+            continue # Not an index file of path (the unsuffixed name is the layout before per-digest files)
+        candidate = os.path.join(directory, name)
+        if candidate == keep:
+            continue
+        try:
+            os.remove(candidate)
+        except OSError:
+            pass
+
+
+def _key_hash(key: bytes) -> int:
+    return zlib.crc32(key)
+
+
+def _pad(buf: bytearray):
+    buf.extend(b"\0" * (-len(buf) % 4))
+
+
+def write_rule_index(path: str, digest: bytes, kind_counts: dict, slot_items,
+                     filter_min_keys: int = DOMAIN_FILTER_MIN_KEYS) -> int:
+    """
+    Serializes compiled rule tables to path (written to a temporary file, then renamed).
+    slot_items yields (slot, [(port_key, (proxy_id, rule_id)), ...]) for every non-empty
+    slot. A domain prefilter is added once there are filter_min_keys domain keys.
+    Returns the size of the written file.
+    """
+    strings, string_ids = [], {}
+
+    def string_id(value) -> int:
+        if value is None:
+            return _NO_STRING
+        value = str(value)
+        index = string_ids.get(value)
+        if index is None:
+            index = string_ids[value] = len(strings)
+            strings.append(value)
+        return index
+
+    buf = bytearray(_HEADER.size)
+    keyed = {"exact": [], "wildcard": [], "glob": [], "geo": []}
+    networks = {4: [], 6: []}
+    for slot, items in slot_items:
+        table_offset = len(buf)
+        buf += struct.pack("<I", len(items))
+        for port_key, (proxy_id, rule_id) in items:
+            if port_key is None:
+                kind, start, end = _KIND_ANY, 0, 0
+            elif isinstance(port_key, tuple):
+                kind, (start, end) = _KIND_RANGE, port_key
+            else:
+                kind, start, end = _KIND_PORT, port_key, port_key
+            buf += _PORT_RECORD.pack(kind, start, end, string_id(proxy_id), string_id(rule_id))
+        _pad(buf)
+        if slot[0] == "ip":
+            networks[slot[1]].append((slot[3], slot[2], table_offset))
+        else:
+            keyed[slot[0]].append((slot[1].encode("utf-8"), table_offset))
+
+    offsets = []
+    for kind in ("exact", "wildcard", "glob", "geo"):
+        entries = sorted((_key_hash(key), key, table_offset) for key, table_offset in keyed[kind])
+        bucket_bits = max(0, min(16, len(entries).bit_length() - 2)) # About 4 keys per bucket
+        buckets = [len(entries)] * ((1 << bucket_bits) + 1)
+        for i in range(len(entries) - 1, -1, -1):
+            buckets[entries[i][0] >> (32 - bucket_bits)] = i
+        for b in range(len(buckets) - 2, -1, -1): # Empty buckets start where the next one does
+            buckets[b] = min(buckets[b], buckets[b + 1])
+        blob_offsets, position = [], 0
+        for _, key, _ in entries:
+            blob_offsets.append(position)
+            position += len(key)
+        blob_offsets.append(position)
+        offsets.append(len(buf))
+        buf += struct.pack(f"<II{len(buckets)}I{len(entries)}I{len(blob_offsets)}I{len(entries)}I",
+                           len(entries), bucket_bits, *buckets, *(h for h, _, _ in entries), *blob_offsets,
+                           *(table_offset for _, _, table_offset in entries))
+        buf += b"".join(key for _, key, _ in entries)
+        _pad(buf)
+    for version in (4, 6):
+        bits = _IP_BITS[version]
+        entries = sorted(networks[version], key=lambda item: (-item[0], item[1]))
+        directory = [0] * ((bits + 1) * 2)
+        for i, (prefixlen, _, _) in enumerate(entries):
+            if directory[prefixlen * 2 + 1] == 0:
+                directory[prefixlen * 2] = i
+            directory[prefixlen * 2 + 1] += 1
+        offsets.append(len(buf))
+        buf += struct.pack(f"<{len(directory)}I{len(entries)}I{len(entries)}I", *directory,
+                           *(network >> (bits - 32) for _, network, _ in entries),
+                           *(table_offset for _, _, table_offset in entries))
+        buf += b"".join(network.to_bytes(16, "big") for _, network, _ in entries)
+    offsets.append(len(buf))
+    encoded = [value.encode("utf-8") for value in strings]
+    string_offsets, position = [], 0
+    for value in encoded:
+        string_offsets.append(position)
+        position += len(value)
+    string_offsets.append(position)
+    buf += struct.pack(f"<I{len(string_offsets)}I", len(encoded), *string_offsets)
+    buf += b"".join(encoded)
+    _pad(buf)
+
+    domain_keys = {key for kind in ("exact", "wildcard") for key, _ in keyed[kind]}
+    if domain_keys and len(domain_keys) >= filter_min_keys:
+        domain_filter = BloomFilter.for_capacity(len(domain_keys), DOMAIN_FILTER_FP_RATE)
+        for key in domain_keys:
+            domain_filter.add(key)
+        buf.extend(b"\0" * (-(len(buf) + _FILTER_HEADER.size) % 8)) # Filter words 8-byte aligned
+        offsets.append(len(buf))
+        buf += _FILTER_HEADER.pack(domain_filter.hash_count, domain_filter.word_count, domain_filter.key_count)
+        buf += domain_filter.bits
+    else:
+        offsets.append(0)
+
+    counts = [kind_counts.get(kind, 0) for kind in _KIND_NAMES]
+    _HEADER.pack_into(buf, 0, INDEX_MAGIC, INDEX_VERSION, digest, *counts, *offsets)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(buf)
+    os.replace(temp_path, path)
+    return len(buf)
+
+
+class RuleIndex:
+    """
+    Read-only view of a rule index file, memory-mapped and searched in place.
+    Nothing is parsed up front: domain lookups bisect a few CRC-32 hashes of one bucket
+    of the sorted key tables, IP lookups bisect one block per prefix length present.
+    """
+
+    def __init__(self, path: str, mapping: mmap.mmap, header: tuple):
+        self.path = path
+        self._mm = mapping
+        self._words = memoryview(mapping).cast("I") # u32 view, the file is 4-byte aligned
+        _magic, _version, self.digest, *rest = header
+        self.kind_counts = dict(zip(_KIND_NAMES, rest[:5]))
+        self._exact_at, self._wildcard_at, self._glob_at, self._geo_at, ip4_at, ip6_at, self._strings_at, filter_at = rest[5:]
+        self.domain_filter = None # BloomFilter over domain keys, see may_contain
+        if filter_at:
+            hash_count, word_count, key_count = _FILTER_HEADER.unpack_from(mapping, filter_at)
+            bits_at = filter_at + _FILTER_HEADER.size
+            bits = memoryview(mapping)[bits_at:bits_at + word_count * 8]
+            self.domain_filter = BloomFilter(word_count, hash_count, bits, key_count)
+        self._ip_sections = {4: self._prefix_blocks(ip4_at, 32), 6: self._prefix_blocks(ip6_at, 128)}
+        self._string_cache = {}
+
+    @classmethod
+    def open(cls, path: str, digest: bytes) -> "RuleIndex | None":
+        """Maps path if it holds an index of this version for the rule set with this digest."""
+        if sys.byteorder != "little": # Index files are little-endian; other hosts just compile
+            return None
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < _HEADER.size:
+                    return None
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+        header = _HEADER.unpack_from(mapping, 0)
+        if header[0] != INDEX_MAGIC or header[1] != INDEX_VERSION or header[2] != digest or len(mapping) % 4:
+            mapping.close()
+            return None
+        return cls(path, mapping, header)
+
+    def _prefix_blocks(self, offset: int, bits: int) -> tuple:
+        """Returns (bits, prefix blocks, heads word index, tables word index, networks offset)."""
+        words = self._words[offset // 4:offset // 4 + (bits + 1) * 2]
+        count = sum(words[1::2])
+        heads_at = offset // 4 + len(words)
+        blocks = [(prefixlen, words[prefixlen * 2], words[prefixlen * 2 + 1])
+                  for prefixlen in range(bits, -1, -1) if words[prefixlen * 2 + 1]]
+        return bits, blocks, heads_at, heads_at + count, (heads_at + 2 * count) * 4
+
+    def _string(self, index: int):
+        if index == _NO_STRING:
+            return None
+        value = self._string_cache.get(index)
+        if value is None:
+            words, base = self._words, self._strings_at // 4
+            blob = self._strings_at + (words[base] + 2) * 4
+            value = self._mm[blob + words[base + 1 + index]:blob + words[base + 2 + index]].decode("utf-8")
+            self._string_cache[index] = value
+        return value
+
+    def _port_items(self, offset: int) -> list:
+        """Decodes the port table at offset into [(port_key, (proxy_id, rule_id))]."""
+        items = []
+        position = offset + 4
+        for _ in range(self._words[offset // 4]):
+            kind, start, end, proxy, rule = _PORT_RECORD.unpack_from(self._mm, position)
+            position += _PORT_RECORD.size
+            port_key = None if kind == _KIND_ANY else start if kind == _KIND_PORT else (start, end)
+            items.append((port_key, (self._string(proxy), self._string(rule))))
+        return items
+
+    def _find_key(self, section: int, key: str) -> list | None:
+        words, base = self._words, section // 4
+        count, bucket_bits = words[base], words[base + 1]
+        hashes_at = base + 2 + (1 << bucket_bits) + 1
+        offsets_at = hashes_at + count
+        tables_at = offsets_at + count + 1
+        blob = (tables_at + count) * 4
+        needle = key.encode("utf-8")
+        h = _key_hash(needle)
+        bucket = base + 2 + (h >> (32 - bucket_bits))
+        i = bisect_left(words, h, hashes_at + words[bucket], hashes_at + words[bucket + 1])
+        end = hashes_at + count
+        while i < end and words[i] == h: # CRC collisions are resolved by comparing the keys
+            k = i - hashes_at
+            if self._mm[blob + words[offsets_at + k]:blob + words[offsets_at + k + 1]] == needle:
+                return self._port_items(words[tables_at + k])
+            i += 1
+        return None
+
+    def may_contain(self, key: str) -> bool:
+        """False if no exact or '*.suffix' rule uses key (cheap check before exact/wildcard)."""
+        return self.domain_filter is None or key.encode("utf-8") in self.domain_filter
+
+    def exact(self, domain: str) -> list | None:
+        """Port items of the exact-domain rules for domain, or None."""
+        return self._find_key(self._exact_at, domain)
+
+    def wildcard(self, suffix: str) -> list | None:
+        """Port items of the '*.suffix' rules for suffix, or None."""
+        return self._find_key(self._wildcard_at, suffix)
+
+    def globs(self) -> list:
+        """[(pattern, port items)] for every other wildcard pattern."""
+        return self._all_keys(self._glob_at)
+
+    def geo(self) -> list:
+        """[(rule key, port items)] for every 'geo:' / 'asn:' rule target."""
+        return self._all_keys(self._geo_at)
+
+    def _all_keys(self, section: int) -> list:
+        words, base = self._words, section // 4
+        count, bucket_bits = words[base], words[base + 1]
+        offsets_at = base + 2 + (1 << bucket_bits) + 1 + count
+        tables_at = offsets_at + count + 1
+        blob = (tables_at + count) * 4
+        return [(self._mm[blob + words[offsets_at + i]:blob + words[offsets_at + i + 1]].decode("utf-8"),
+                 self._port_items(words[tables_at + i])) for i in range(count)]
+
+    def ip_count(self, version: int) -> int:
+        return sum(count for _, _, count in self._ip_sections[version][1])
+
+    def ip_lookup(self, version: int, key: int) -> list:
+        """Port items of every prefix containing address key, most specific first."""
+        bits, blocks, heads_at, tables_at, networks_at = self._ip_sections[version]
+        words, mm = self._words, self._mm
+        hits = []
+        for prefixlen, first, count in blocks:
+            network = (key >> (bits - prefixlen)) << (bits - prefixlen)
+            head = network >> (bits - 32)
+            i = bisect_left(words, head, heads_at + first, heads_at + first + count)
+            end = heads_at + first + count
+            if bits > 32: # IPv6: several networks may share their top 32 bits
+                needle = network.to_bytes(16, "big")
+                while i < end and words[i] == head:
+                    k = i - heads_at
+                    if mm[networks_at + k * 16:networks_at + k * 16 + 16] == needle:
+                        hits.append(self._port_items(words[tables_at + k]))
+                        break
+                    i += 1
+            elif i < end and words[i] == head:
+                hits.append(self._port_items(words[tables_at + i - heads_at]))
+        return hits
@@ -1,178 +1,1380 @@
-import fnmatch # For wildcard matching
 import re
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
 from urllib.parse import urlparse
 import ipaddress # Import ipaddress
 
-class RuleMatcher:
-    """Matches requested domains or IP addresses against the configured rules."""
+from .geo_db import parse_geo_target
+from .hostnames import normalize_host, normalize_rule_target
+from .ip_radix import IPRadixTree, parse_ip_target
+from .rule_index import RuleIndex, index_file, remove_stale_indexes, rules_digest, write_rule_index
+from .rule_stats import RuleStats
+
+GLOBAL_PROFILE_ID = "__GLOBAL__" # profile_id of the rules that apply in every profile
+
+
+class PortTable:
+    """
+    Port qualifiers of one rule target: exact ports, port ranges and an all-ports entry.
+    Lookups try the exact port, then the narrowest range containing the port, then the
+    all-ports entry. Ranges are compiled into sorted, non-overlapping segments that are
+    searched with bisect, so overlaps resolve the same way whatever the insertion order
+    (narrowest range wins, the lower start on equal widths).
+    """
+    __slots__ = ("any_port", "ports", "ranges", "_index")
+
+    def __init__(self):
+        self.any_port = None # Entry for all ports
+        self.ports = {}      # {port: entry}
+        self.ranges = {}     # {(start, end): entry}
+        self._index = None   # (segment_starts, segment_entries), built on first range lookup
+
+    def add(self, port_key, entry, keep_existing: bool = False):
+        """Stores an entry under None (all ports), a port or a (start, end) range."""
+        if port_key is None:
+            if not (keep_existing and self.any_port is not None):
+                self.any_port = entry
+        elif isinstance(port_key, tuple):
+            if not (keep_existing and port_key in self.ranges):
+                self.ranges[port_key] = entry
+                self._index = None
+        elif not (keep_existing and port_key in self.ports):
+            self.ports[port_key] = entry
+
+    @classmethod
+    def from_items(cls, items) -> "PortTable | None":
+        """Rebuilds a table from items() pairs (None if there are none)."""
+        table = None
+        for port_key, entry in items or ():
+            if table is None:
+                table = cls()
+            table.add(port_key, entry)
+        return table
+
+    def items(self):
+        """Yields (port_key, entry) pairs, all-ports entry first."""
+        if self.any_port is not None:
+            yield None, self.any_port
+        yield from self.ports.items()
+        yield from self.ranges.items()
+
+    def _build_index(self) -> tuple:
+        bounds = sorted({start for start, _ in self.ranges} | {end + 1 for _, end in self.ranges})
+        entries = [None] * len(bounds)
+        # Paint the widest ranges first so narrower ones overwrite them
+        for (start, end), entry in sorted(self.ranges.items(), key=lambda item: (item[0][0] - item[0][1], -item[0][0])):
+            for k in range(bisect_left(bounds, start), bisect_left(bounds, end + 1)):
+                entries[k] = entry
+        index = (bounds, entries)
+        self._index = index
+        return index
+
+    def lookup(self, port: int | None):
+        """Returns the entry for a port (None = unknown port, only all-ports rules apply)."""
+        if port is not None:
+            if self.ports:
+                entry = self.ports.get(port)
+                if entry is not None:
+                    return entry
+            if self.ranges:
+                bounds, entries = self._index or self._build_index()
+                i = bisect_right(bounds, port) - 1
+                if i >= 0 and entries[i] is not None:
+                    return entries[i]
+        return self.any_port
+
+
+class _LabelNode:
+    """One node of the reverse-label domain trie (e.g. com -> example -> www)."""
+    __slots__ = ("children", "exact", "wildcard")
+
+    def __init__(self):
+        self.children = {} # {label: _LabelNode}
+        self.exact = None     # PortTable of (proxy_id, rule_id) for the domain ending here
+        self.wildcard = None  # PortTable for '*.<domain ending at this node>'
+
+
+class DomainTrie:
+    """
+    Reverse-label trie answering exact, '*.suffix' and parent-domain lookups
+    in O(labels), independent of how many rules are loaded.
+    """
+
+    def __init__(self):
+        self.root = _LabelNode()
+
+    def _node_for(self, domain: str, create: bool = True) -> _LabelNode | None:
+        """Returns the node for a dotted domain, creating it if needed (or None if not create)."""
+        node = self.root
+        for label in reversed(domain.split('.')):
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = _LabelNode()
+                node.children[label] = child # Linked only once complete
+            node = child
+        return node
+
+    def set_exact(self, domain: str, table: PortTable | None):
+        """Stores (or clears) the PortTable for an exact domain."""
+        node = self._node_for(domain, create=table is not None)
+        if node is not None:
+            node.exact = table # Single reference store, safe for concurrent lookups
+
+    def set_wildcard(self, suffix: str, table: PortTable | None):
+        """Stores (or clears) the PortTable for '*.suffix' (pass the suffix without '*.')."""
+        node = self._node_for(suffix, create=table is not None)
+        if node is not None:
+            node.wildcard = table
+
+    def lookup(self, labels: list, port: int | None) -> tuple[list, tuple | None, int]:
+        """
+        Walks the trie for a host split into labels.
+        Returns (exact_hits, best_wildcard, wildcard_depth) where exact_hits[d] is the
+        exact entry for the suffix made of the last d labels (or None), and best_wildcard
+        is the deepest '*.suffix' entry that still leaves at least one label for the '*'.
+        Only entries whose port qualifier accepts `port` are reported.
+        """
+        node = self.root
+        depth_total = len(labels)
+        exact_hits = [None] * (depth_total + 1)
+        best_wildcard = None
+        wildcard_depth = 0
+        depth = 0
+        for label in reversed(labels):
+            node = node.children.get(label)
+            if node is None:
+                break
+            depth += 1
+            if node.exact is not None:
+                exact_hits[depth] = node.exact.lookup(port)
+            if node.wildcard is not None and depth < depth_total:
+                entry = node.wildcard.lookup(port)
+                if entry is not None:
+                    best_wildcard = entry
+                    wildcard_depth = depth
+        return exact_hits, best_wildcard, wildcard_depth
+
+
+class _DFACache:
+    """Lazily-built DFA states of a GlobAutomaton (replaced wholesale when full)."""
+    __slots__ = ("ids", "sets", "trans", "accepts", "dead")
+
+    def __init__(self):
+        self.ids = {}    # {frozenset(nfa_states): dfa_state_id}
+        self.sets = []   # [frozenset(nfa_states)] indexed by dfa_state_id
+        self.trans = []  # [{char: dfa_state_id}] indexed by dfa_state_id
+        self.accepts = [] # [tuple of accepted pattern ranks, best first]
+        self.dead = -1   # id of the state no pattern can recover from (-1 if none)
+
+
+class GlobAutomaton:
+    """
+    Combined matcher for glob patterns ('*', '?', '[...]') that cannot live in the
+    DomainTrie, e.g. 'cdn-?.example.*' or '*tracker*'.
+
+    All patterns are compiled into one NFA that is run as a lazily-built DFA, so a
+    lookup is a single pass over the hostname however many patterns are loaded.
+    Patterns are ranked by their position in the (specificity-sorted) rule list and
+    every DFA state remembers the ranks it accepts, best first, so the most specific
+    match falls out of the same pass.
+
+    States entered through a pattern's leading '*' stay alive for the whole scan.
+    They are kept out of the DFA state sets (see _persistent), otherwise thousands
+    of '*foo*' patterns would make every DFA state thousands of entries large.
+    """
+
+    _STAR, _ANY, _CHAR, _SET, _ACCEPT = range(5)
+    MAX_DFA_STATES = 4096 # The DFA cache is started over once it grows past this
+
+    def __init__(self, rules: list):
+        # rules: [(specificity, pattern, PortTable)], already sorted best-first
+        self.rules = rules
+        self._lock = threading.Lock() # Serializes DFA construction, lookups stay lock-free
+        kinds = []
+        values = []
+        starts = []
+        for rank, rule in enumerate(rules):
+            starts.append(len(kinds))
+            for kind, value in self._tokenize(rule[1]):
+                kinds.append(kind)
+                values.append(value)
+            kinds.append(self._ACCEPT)
+            values.append(rank)
+        self._kinds = kinds
+        self._values = values
+
+        self._persistent = self._closure(s for s in starts if kinds[s] == self._STAR)
+        self._persistent_accepts = tuple(sorted(values[s] for s in self._persistent if kinds[s] == self._ACCEPT))
+        self._persistent_step = {} # {char: frozenset(states the persistent set moves to)}
+        self._start = self._closure(starts) - self._persistent
+        self._cache = self._new_cache()
+
+    def __len__(self):
+        return len(self.rules)
+
+    @classmethod
+    def _tokenize(cls, pattern: str) -> list:
+        """Splits a glob into (kind, value) tokens, following fnmatch's syntax."""
+        tokens = []
+        i, n = 0, len(pattern)
+        while i < n:
+            c = pattern[i]
+            i += 1
+            if c == '*':
+                if not tokens or tokens[-1][0] != cls._STAR: # '**' is the same as '*'
+                    tokens.append((cls._STAR, None))
+            elif c == '?':
+                tokens.append((cls._ANY, None))
+            elif c == '[':
+                j = i
+                if j < n and pattern[j] == '!': j += 1
+                if j < n and pattern[j] == ']': j += 1
+                j = pattern.find(']', j)
+                if j == -1:
+                    tokens.append((cls._CHAR, '[')) # No closing bracket: literal '['
+                    continue
+                body = pattern[i:j]
+                i = j + 1
+                negate = body.startswith('!')
+                if negate: body = body[1:]
+                chars = set()
+                k = 0
+                while k < len(body):
+                    if k + 2 < len(body) and body[k + 1] == '-':
+                        chars.update(chr(o) for o in range(ord(body[k]), ord(body[k + 2]) + 1))
+                        k += 3
+                    else:
+                        chars.add(body[k])
+                        k += 1
+                tokens.append((cls._SET, (frozenset(chars), negate)))
+            else:
+                tokens.append((cls._CHAR, c))
+        return tokens
+
+    def _closure(self, states) -> frozenset:
+        """Adds the states reachable without consuming input ('*' may match nothing)."""
+        kinds = self._kinds
+        result = set()
+        stack = list(states)
+        while stack:
+            s = stack.pop()
+            if s in result: continue
+            result.add(s)
+            if kinds[s] == self._STAR:
+                stack.append(s + 1)
+        return frozenset(result)
+
+    def _step(self, states, c: str, out: set):
+        """Collects the NFA states reached from `states` on character `c`."""
+        kinds = self._kinds
+        values = self._values
+        for s in states:
+            kind = kinds[s]
+            if kind == self._STAR:
+                out.add(s)
+            elif kind == self._ANY:
+                out.add(s + 1)
+            elif kind == self._CHAR:
+                if values[s] == c: out.add(s + 1)
+            elif kind == self._SET:
+                chars, negate = values[s]
+                if (c in chars) != negate: out.add(s + 1)
+
+    def _intern(self, cache: _DFACache, states: frozenset) -> int:
+        """Returns the DFA state id for an NFA state set, creating it if needed."""
+        state_id = cache.ids.get(states)
+        if state_id is not None:
+            return state_id
+        state_id = len(cache.sets)
+        cache.ids[states] = state_id
+        cache.sets.append(states)
+        cache.trans.append({})
+        kinds = self._kinds
+        values = self._values
+        accepts = [values[s] for s in states if kinds[s] == self._ACCEPT]
+        accepts.extend(self._persistent_accepts)
+        cache.accepts.append(tuple(sorted(accepts)))
+        if not states and not self._persistent:
+            cache.dead = state_id
+        return state_id
+
+    def _new_cache(self) -> _DFACache:
+        cache = _DFACache()
+        self._intern(cache, self._start)
+        return cache
+
+    def _add_transition(self, cache: _DFACache, state_id: int, c: str) -> int:
+        """Slow path: computes (and caches) the DFA transition for one character."""
+        with self._lock:
+            next_id = cache.trans[state_id].get(c)
+            if next_id is not None:
+                return next_id
+            persistent_next = self._persistent_step.get(c)
+            if persistent_next is None:
+                out = set()
+                self._step(self._persistent, c, out)
+                persistent_next = self._closure(out) - self._persistent
+                self._persistent_step[c] = persistent_next
+            out = set()
+            self._step(cache.sets[state_id], c, out)
+            next_states = (self._closure(out) - self._persistent) | persistent_next
+            if len(cache.sets) >= self.MAX_DFA_STATES and cache is self._cache:
+                # Start future lookups on a fresh cache; this scan finishes on the old one
+                self._cache = self._new_cache()
+            next_id = self._intern(cache, next_states)
+            cache.trans[state_id][c] = next_id
+            return next_id
+
+    def match(self, text: str) -> tuple | None:
+        """Returns the most specific rule whose pattern matches the whole text, or None."""
+        matches = self.match_all(text)
+        return matches[0] if matches else None
+
+    def match_all(self, text: str) -> list:
+        """Returns every rule whose pattern matches the whole text, most specific first."""
+        cache = self._cache
+        trans = cache.trans
+        state_id = 0
+        for c in text:
+            next_id = trans[state_id].get(c)
+            if next_id is None:
+                next_id = self._add_transition(cache, state_id, c)
+            state_id = next_id
+            if state_id == cache.dead:
+                return []
+        rules = self.rules
+        return [rules[rank] for rank in cache.accepts[state_id]]
+
+
+class MatchCache:
+    """
+    Thread-safe, size-bounded LRU of (host, port) -> (proxy_id, rule_id) decisions.
+    Entries are tagged with the matcher's rule generation; an entry from an older
+    generation counts as a miss, so bumping the generation invalidates everything.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self._entries = OrderedDict() # {(host, port): (generation, result)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple, generation: int) -> tuple | None:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or item[0] != generation:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: tuple, generation: int, result: tuple):
+        with self._lock:
+            self._entries[key] = (generation, result)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns hit/miss/eviction counters and the current size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+class MatchTrace:
+    """
+    Structured record of one traced lookup: the steps checked, the candidate patterns
+    (entry None when a pattern's port qualifier rejected the port) and the winner.
+    """
+    __slots__ = ("target", "port", "generation", "steps", "candidates", "result", "reason", "pattern")
+
+    def __init__(self, target: str, port: int | None, generation: int):
+        self.target = target
+        self.port = port
+        self.generation = generation # Snapshot the lookup ran against
+        self.steps = []      # [(step, detail)]
+        self.candidates = [] # [(pattern, entry or None)]
+        self.result = (None, None)
+        self.reason = None   # Step that decided, e.g. 'exact', 'wildcard', 'parent exact'
+        self.pattern = None  # Rule target that won, if any
+
+    def step(self, name: str, detail: str):
+        self.steps.append((name, detail))
+
+    def candidate(self, pattern: str, entry: tuple | None):
+        self.candidates.append((pattern, entry))
+
+    def finish(self, entry: tuple, reason: str, pattern: str | None = None):
+        self.result = entry
+        self.reason = reason
+        self.pattern = pattern
+
+    def as_dict(self) -> dict:
+        return {
+            "target": self.target, "port": self.port, "generation": self.generation,
+            "steps": list(self.steps), "candidates": list(self.candidates),
+            "proxy_id": self.result[0], "rule_id": self.result[1],
+            "reason": self.reason, "pattern": self.pattern,
+        }
+
+    def format(self) -> str:
+        proxy_id, rule_id = self.result
+        decision = f"Proxy '{proxy_id}' (Rule '{rule_id}')" if rule_id is not None else "no match"
+        line = f"[Matcher] {self.target}:{self.port} -> {decision} via {self.reason}"
+        if self.pattern:
+            line += f" '{self.pattern}'"
+        if self.steps:
+            line += "; checked " + ", ".join(f"{name}: {detail}" for name, detail in self.steps)
+        if self.candidates:
+            line += "; candidates " + ", ".join(
+                pattern if entry is not None else f"{pattern} (port rejected)" for pattern, entry in self.candidates)
+        return line
+
+
+class CompileReport:
+    """
+    Findings of a pruning compile (see CompiledRules.build): rules that can never match
+    because another rule has the same target and port, and rules whose entries were
+    dropped because a broader rule routes the same traffic to the same proxy.
+    """
+    __slots__ = ("duplicates", "conflicts", "shadowed", "pruned_slots", "pruned_entries")
 
     def __init__(self):
-        self._exact_domain_matches = {} # {domain_lower: proxy_id}
-        self._exact_ip_matches = {}     # {ip_address_str: {None: proxy_id, port: proxy_id, ...}}
-        # Store wildcards as tuples: (specificity_key, pattern_lower, proxy_id)
+        self.duplicates = {}   # {rule_id: rule_id that wins the same target and port}
+        self.conflicts = []    # [(rule_id, winning rule_id)] duplicates with a different proxy
+        self.shadowed = {}     # {rule_id: covering rule_id}, every entry of the rule was pruned
+        self.pruned_slots = [] # Slots whose table lost entries, restored before the first edit
+        self.pruned_entries = 0
+
+    def summary(self) -> str:
+        return (f"{len(self.duplicates)} duplicate rules ({len(self.conflicts)} with a different proxy), "
+                f"{len(self.shadowed)} rules covered by a broader rule, {self.pruned_entries} entries pruned")
+
+    def format(self, rules: dict) -> list:
+        """One line per finding, naming rules by their target."""
+        def name(rule_id):
+            rule_data = rules.get(rule_id, {})
+            port = rule_data.get("port")
+            return f"'{rule_data.get('domain', rule_id)}{':' + str(port) if port else ''}' ({rule_id})"
+        conflicting = dict(self.conflicts)
+        lines = []
+        for rule_id, winner in self.duplicates.items():
+            kind = "conflict" if rule_id in conflicting else "duplicate"
+            lines.append(f"{kind}: {name(rule_id)} never matches, {name(winner)} has the same target and port")
+        for rule_id, cover in self.shadowed.items():
+            lines.append(f"shadowed: {name(rule_id)} is covered by {name(cover)} with the same proxy")
+        return lines
+
+
+class _IndexedDomainTrie:
+    """DomainTrie stand-in answering lookups from a memory-mapped RuleIndex."""
+
+    def __init__(self, index: RuleIndex):
+        self.index = index
+
+    def lookup(self, labels: list, port: int | None) -> tuple[list, tuple | None, int]:
+        """Same contract as DomainTrie.lookup, one sorted-table search per suffix."""
+        depth_total = len(labels)
+        exact_hits = [None] * (depth_total + 1)
+        best_wildcard = None
+        wildcard_depth = 0
+        index = self.index
+        domain_filter = index.domain_filter
+        for depth in range(1, depth_total + 1):
+            suffix = ".".join(labels[depth_total - depth:])
+            if domain_filter is not None and suffix.encode("utf-8") not in domain_filter:
+                continue # Definitely no exact or '*.suffix' rule for this suffix
+            table = PortTable.from_items(self.index.exact(suffix))
+            if table is not None:
+                exact_hits[depth] = table.lookup(port)
+            if depth < depth_total:
+                table = PortTable.from_items(self.index.wildcard(suffix))
+                entry = table.lookup(port) if table is not None else None
+                if entry is not None:
+                    best_wildcard = entry
+                    wildcard_depth = depth
+        return exact_hits, best_wildcard, wildcard_depth
+
+
+class _IndexedIPTree:
+    """IPRadixTree stand-in answering lookups from a memory-mapped RuleIndex."""
+
+    def __init__(self, index: RuleIndex, version: int):
+        self.index = index
+        self.version = version
+        self.size = index.ip_count(version)
+
+    def lookup(self, key: int) -> list:
+        return [PortTable.from_items(items) for items in self.index.ip_lookup(self.version, key)]
+
+
+class CompiledRules:
+    """
+    Fully compiled rule set. RuleMatcher builds a new one off to the side on every
+    reload and publishes it with a single reference assignment, so lookups running on
+    another thread always see either the old or the new rule set, never a half-cleared
+    one. Incremental edits (RuleMatcher.add_rule and friends) publish a derived snapshot
+    after swapping in the rebuilt PortTable of each affected target, again one reference
+    store at a time, so a lookup sees a rule either before or after the edit.
+    """
+
+    # Rule kinds, also the first element of a slot key (see rule_slots)
+    EXACT, WILDCARD, GLOB, IP, GEO = "exact", "wildcard", "glob", "ip", "geo"
+
+    def __init__(self, generation: int = 0):
+        self.generation = generation # Tags cached decisions made against this snapshot
+        self.domain_trie = DomainTrie() # Exact domains and '*.suffix' wildcards
+        # IPs, CIDR blocks and ranges, one longest-prefix-match tree per address family.
+        # Each prefix carries a PortTable of (proxy_id, rule_id) entries.
+        self.ip_trees = {4: IPRadixTree(32), 6: IPRadixTree(128)}
+        self.kind_counts = {self.EXACT: 0, self.WILDCARD: 0, self.GLOB: 0, self.IP: 0, self.GEO: 0} # Enabled rules per kind
+        # 'geo:de' / 'asn:13335' rules, {rule key: PortTable}, tried for IPs no prefix accepts.
+        # Needs geo_database (a geo_db.GeoDatabase) to tell the keys of an address.
+        self.geo_tables = {}
+        self.geo_database = None
+        # Wildcards that cannot live in the trie (e.g. 'cdn-?.example.*'), stored as
+        # tuples: (specificity_key, pattern_lower, PortTable), one per distinct pattern
         # Specificity key could be length or number of parts. Higher is more specific.
-        self._wildcard_domain_rules = []
+        self.glob_tables = {} # {pattern_lower: PortTable}
+        self.wildcard_domain_rules = []
+        self.glob_automaton = None        # All of the above, checked against the full host
+        self.parent_glob_automaton = None # Only those not starting with '*', for parent domains
+        # All-ports entries _prune dropped. A lookup the covering rule answers in their
+        # place is still credited to the pruned rule, as it would be without pruning.
+        self.pruned_exact = {}           # {domain: rule_id}
+        self.pruned_wildcards = {}       # {suffix: rule_id}
+        self.pruned_ips = {4: {}, 6: {}} # {version: {prefixlen: {network: rule_id}}}
+
+    def derive(self) -> "CompiledRules":
+        """Returns a new snapshot sharing this one's structures, with the next generation."""
+        derived = CompiledRules.__new__(CompiledRules)
+        derived.__dict__.update(self.__dict__)
+        derived.generation = self.generation + 1
+        derived.kind_counts = dict(self.kind_counts)
+        derived.glob_tables = dict(self.glob_tables) # Automata are rebuilt per snapshot, keep their source apart
+        derived.geo_tables = dict(self.geo_tables)
+        return derived
 
-    def _get_specificity(self, pattern: str) -> int:
+    @staticmethod
+    def get_specificity(pattern: str) -> int:
         """Calculate a specificity score (higher is more specific)."""
         # Simple: use length. Longer patterns are generally more specific.
         # Could also count dots or non-wildcard characters.
         return len(pattern)
 
-    def _is_ip_address(self, value: str) -> bool:
-        """Checks if a string is a valid IP address."""
+    @staticmethod
+    def trie_suffix(pattern: str) -> str | None:
+        """Returns 'example.com' for a plain '*.example.com' pattern, None for any other glob."""
+        if not pattern.startswith("*.") or len(pattern) < 3:
+            return None
+        suffix = pattern[2:]
+        if "*" in suffix or "?" in suffix or "[" in suffix:
+            return None
+        return suffix
+
+    @staticmethod
+    def parse_port_key(port) -> int | tuple | None:
+        """Turns a rule's port field ('443', '400-500', 443, '' or None) into a PortTable key."""
+        if isinstance(port, int):
+            return port
+        if not isinstance(port, str) or not port.strip():
+            return None
         try:
-            ipaddress.ip_address(value)
-            return True
+            if '-' in port:
+                start, end = (int(part) for part in port.split('-', 1))
+                if 1 <= start <= 65535 and 1 <= end <= 65535 and start <= end:
+                    return (start, end)
+                return None
+            return int(port)
         except ValueError:
-            return False
+            return None
 
-    def update_rules(self, rules_config: dict):
-        """Processes and stores rules for matching, separating IPs and domains, with port and port range support for IPs."""
-        print("[Matcher] Updating rules...")
-        self._exact_domain_matches.clear()
-        self._exact_ip_matches.clear()  # Now {ip: {None: proxy_id, port: proxy_id, ...}}
-        temp_wildcards = []
-
-        for rule_id, rule_data in rules_config.items():
-            target = rule_data.get("domain") # This field now holds domain or IP
-            proxy_id = rule_data.get("proxy_id") # Can be None for Direct
-            enabled = rule_data.get("enabled", True) # Process only enabled rules
-            port = rule_data.get("port") if "port" in rule_data else None
-            if port == "": port = None
-            # Parse port or port range
-            port_key = None
-            if isinstance(port, str):
-                if '-' in port:
-                    try:
-                        start, end = port.split('-', 1)
-                        start = int(start)
-                        end = int(end)
-                        if 1 <= start <= 65535 and 1 <= end <= 65535 and start <= end:
-                            port_key = (start, end)
-                        else:
-                            port_key = None
-                    except Exception:
-                        port_key = None
-                else:
-                    try:
-                        port_key = int(port)
-                    except Exception:
-                        port_key = None
-            elif isinstance(port, int):
-                port_key = port
+    @classmethod
+    def rule_slots(cls, rule_data: dict) -> list:
+        """
+        Returns the slots a rule's target compiles into: ('exact', domain),
+        ('wildcard', suffix), ('glob', pattern), ('geo', 'geo:de' or 'asn:13335') or one
+        ('ip', version, network, prefixlen) per CIDR block. Rules sharing a slot share one PortTable.
+        """
+        target = rule_data.get("domain") # This field now holds domain or IP
+        if not target:
+            return []
+        target_lower = normalize_rule_target(target) # Same spelling normalize_host gives requested hosts
+        geo_key = parse_geo_target(target_lower)
+        if geo_key is not None:
+            return [(cls.GEO, geo_key)]
+        # Differentiate between IP and Domain
+        ip_networks = parse_ip_target(target_lower)
+        if ip_networks is not None:
+            return [(cls.IP, n.version, int(n.network_address), n.prefixlen) for n in ip_networks]
+        # Process as domain (check for wildcards)
+        if "*" in target_lower or "?" in target_lower:
+            suffix = cls.trie_suffix(target_lower)
+            if suffix is not None:
+                return [(cls.WILDCARD, suffix)] # '*.suffix' goes into the trie
+            return [(cls.GLOB, target_lower)]
+        return [(cls.EXACT, target_lower)]
+
+    @classmethod
+    def build_table(cls, slot: tuple, rule_ids: list, rules: dict) -> PortTable | None:
+        """Builds the PortTable of one slot from its rules, in rule order (None if all disabled)."""
+        table = None
+        # Duplicate wildcard patterns: the first one wins, like the stable wildcard sort did
+        keep_existing = slot[0] in (cls.WILDCARD, cls.GLOB)
+        for rule_id in rule_ids:
+            rule_data = rules[rule_id]
+            if not rule_data.get("enabled", True): # Process only enabled rules
+                continue
+            if table is None:
+                table = PortTable()
+            table.add(cls.parse_port_key(rule_data.get("port")), (rule_data.get("proxy_id"), rule_id), keep_existing)
+        return table
+
+    def set_slot(self, slot: tuple, table: PortTable | None):
+        """Stores (or clears) the PortTable of one slot. Glob changes need finish_globs()."""
+        kind = slot[0]
+        if kind == self.EXACT:
+            self.domain_trie.set_exact(slot[1], table)
+        elif kind == self.WILDCARD:
+            self.domain_trie.set_wildcard(slot[1], table)
+        elif kind == self.IP:
+            self.ip_trees[slot[1]].set_value(slot[2], slot[3], table)
+        elif kind == self.GEO:
+            if table is None:
+                self.geo_tables.pop(slot[1], None)
             else:
-                port_key = None
+                self.geo_tables[slot[1]] = table
+        elif table is None:
+            self.glob_tables.pop(slot[1], None)
+        else:
+            self.glob_tables[slot[1]] = table
+
+    def finish_globs(self):
+        """(Re)compiles the glob automata from glob_tables."""
+        # Sort wildcards by specificity (descending) then alphabetically for consistency
+        temp_wildcards = [(self.get_specificity(pattern), pattern, table) for pattern, table in self.glob_tables.items()]
+        self.wildcard_domain_rules = sorted(temp_wildcards, key=lambda x: (-x[0], x[1]))
+        # A glob starting with '*' that matches a parent domain also matches the full
+        # host, so parent levels only need the anchored patterns.
+        anchored = [r for r in self.wildcard_domain_rules if not r[1].startswith('*')]
+        self.glob_automaton = GlobAutomaton(self.wildcard_domain_rules) if self.wildcard_domain_rules else None
+        self.parent_glob_automaton = GlobAutomaton(anchored) if anchored else None
+
+    def table_for(self, slot: tuple) -> PortTable | None:
+        """Returns the PortTable currently stored for a slot (built snapshots only)."""
+        kind = slot[0]
+        if kind == self.IP:
+            node = self.ip_trees[slot[1]].find(slot[2], slot[3])
+            return node.value if node is not None else None
+        if kind == self.GLOB:
+            return self.glob_tables.get(slot[1])
+        if kind == self.GEO:
+            return self.geo_tables.get(slot[1])
+        node = self.domain_trie._node_for(slot[1], create=False)
+        if node is None:
+            return None
+        return node.exact if kind == self.EXACT else node.wildcard
 
-            if not target or not enabled:
+    def count_rule(self, rule_data: dict | None, slots: list, delta: int):
+        """Adjusts kind_counts for one enabled rule being added (+1) or removed (-1)."""
+        if rule_data and slots and rule_data.get("enabled", True):
+            self.kind_counts[slots[0][0]] += delta
+
+    @classmethod
+    def build(cls, rules: dict, generation: int, report: CompileReport | None = None) -> tuple["CompiledRules", dict]:
+        """
+        Compiles rules into a new snapshot, separating IPs and domains, with port and port range support.
+        IP targets may be single addresses, CIDR blocks ('10.0.0.0/8') or ranges ('10.0.0.1-10.0.0.50').
+        Returns (snapshot, slot_rules) where slot_rules maps every slot to its rule ids in
+        order, including disabled rules, for later incremental edits.
+
+        With a report, duplicates are recorded in it and redundant all-ports entries are
+        pruned (see _prune): the snapshot routes every host and port to the same proxy,
+        and lookups the covering rule now answers are still credited to the pruned rule.
+        """
+        compiled = cls(generation)
+        slot_rules = {} # {slot: [rule_id, ...]}
+        for rule_id, rule_data in rules.items():
+            slots = cls.rule_slots(rule_data)
+            for slot in slots:
+                slot_rules.setdefault(slot, []).append(rule_id)
+            compiled.count_rule(rule_data, slots, 1)
+        exact_tables = {}
+        for slot, rule_ids in slot_rules.items():
+            table = cls.build_table(slot, rule_ids, rules)
+            if report is not None:
+                cls._find_duplicates(slot, rule_ids, rules, report)
+            if table is None:
                 continue
+            if slot[0] == cls.EXACT:
+                exact_tables[slot] = table # Inserted last, pruned ones never get a trie node
+            else:
+                compiled.set_slot(slot, table)
+        compiled.finish_globs()
+        if report is not None:
+            compiled._prune(exact_tables, slot_rules, report)
+        for slot, table in exact_tables.items():
+            if table is not None:
+                compiled.set_slot(slot, table)
+        return compiled, slot_rules
 
-            target_lower = target.lower()
+    @classmethod
+    def _find_duplicates(cls, slot: tuple, rule_ids: list, rules: dict, report: CompileReport):
+        """Records the enabled rules of a slot that lose to another rule with the same port qualifier."""
+        if len(rule_ids) < 2:
+            return
+        first_wins = slot[0] in (cls.WILDCARD, cls.GLOB) # Same order build_table resolves them in
+        winners = {} # {port_key: rule_id}
+        for rule_id in (rule_ids if first_wins else reversed(rule_ids)):
+            rule_data = rules[rule_id]
+            if not rule_data.get("enabled", True):
+                continue
+            port_key = cls.parse_port_key(rule_data.get("port"))
+            winner = winners.setdefault(port_key, rule_id)
+            if winner != rule_id and rule_id not in report.duplicates:
+                report.duplicates[rule_id] = winner
+                if rule_data.get("proxy_id") != rules[winner].get("proxy_id"):
+                    report.conflicts.append((rule_id, winner))
 
-            # Differentiate between IP and Domain
-            if self._is_ip_address(target_lower):
-                # Store exact IP matches with port and range support
-                if target_lower not in self._exact_ip_matches:
-                    self._exact_ip_matches[target_lower] = {}
-                self._exact_ip_matches[target_lower][port_key] = proxy_id
+    @staticmethod
+    def _uniform_proxy(table: PortTable | None):
+        """The proxy of a table holding only an all-ports entry: [proxy_id], else None."""
+        if table is None or table.any_port is None or table.ports or table.ranges:
+            return None
+        return [table.any_port[0]]
+
+    @staticmethod
+    def _without_any_port(table: PortTable) -> PortTable | None:
+        return PortTable.from_items([(key, entry) for key, entry in table.items() if key is not None])
+
+    def _wildcard_above(self, domain: str) -> tuple:
+        """Deepest '*.suffix' table strictly above domain in the trie: (pattern, table) or (None, None)."""
+        labels = domain.split('.')
+        node = self.domain_trie.root
+        found = (None, None)
+        for depth in range(1, len(labels)):
+            node = node.children.get(labels[-depth])
+            if node is None:
+                break
+            if node.wildcard is not None:
+                found = ("*." + ".".join(labels[-depth:]), node.wildcard)
+        return found
+
+    def _prune(self, exact_tables: dict, slot_rules: dict, report: CompileReport):
+        """
+        Drops the all-ports entry of a slot when the next rule a lookup would fall back
+        to sends every port to the same proxy anyway:
+          - an IP prefix inside a shorter prefix (the next one the IP lookup tries),
+          - an exact domain under a '*.suffix' (which also decides all its subdomains),
+            unless a glob ranked above that wildcard matches the domain with another proxy,
+          - a '*.suffix' under a shorter '*.suffix', if no glob ranks between the two.
+        Port-specific entries are kept, they take precedence over the all-ports entry.
+        Every step only relies on the tables left by the previous ones, so chains of
+        nested rules collapse into the outermost one.
+        """
+        pruned = {} # {rule_id: [covering rule_id per pruned entry]}
+        ip_slot_counts = {} # {rule_id: number of CIDR blocks}, the other kinds have one slot per rule
+
+        def drop(slot, table, cover):
+            pruned.setdefault(table.any_port[1], []).append(cover[1])
+            if slot[0] == self.EXACT:
+                self.pruned_exact[slot[1]] = table.any_port[1]
+            elif slot[0] == self.WILDCARD:
+                self.pruned_wildcards[slot[1]] = table.any_port[1]
             else:
-                # Process as domain (check for wildcards)
-                is_wildcard = "*" in target_lower or "?" in target_lower
-                if is_wildcard:
-                    # Store domain wildcards with specificity
-                    specificity = self._get_specificity(target_lower)
-                    temp_wildcards.append((specificity, target_lower, proxy_id))
-                else:
-                    # Store exact domain matches
-                    self._exact_domain_matches[target_lower] = proxy_id
+                self.pruned_ips[slot[1]].setdefault(slot[3], {})[slot[2]] = table.any_port[1]
+            report.pruned_slots.append(slot)
+            report.pruned_entries += 1
+            return self._without_any_port(table)
 
-        # Sort wildcards by specificity (descending) then alphabetically for consistency
-        self._wildcard_domain_rules = sorted(temp_wildcards, key=lambda x: (-x[0], x[1]))
+        for slot in slot_rules:
+            if slot[0] != self.IP:
+                continue
+            for rule_id in slot_rules[slot]:
+                ip_slot_counts[rule_id] = ip_slot_counts.get(rule_id, 0) + 1
+            tree = self.ip_trees[slot[1]]
+            node = tree.find(slot[2], slot[3])
+            table = node.value if node is not None else None
+            if table is None or table.any_port is None:
+                continue
+            parent = tree.parent_value(slot[2], slot[3])
+            if self._uniform_proxy(parent) == [table.any_port[0]]:
+                tree.set_value(slot[2], slot[3], drop(slot, table, parent.any_port))
+
+        glob_keys = sorted((-specificity, pattern) for specificity, pattern, _table in self.wildcard_domain_rules)
+        for slot in sorted((slot for slot in slot_rules if slot[0] == self.WILDCARD), key=lambda slot: slot[1].count('.')):
+            table = self.table_for(slot)
+            if table is None or table.any_port is None:
+                continue
+            pattern, parent = self._wildcard_above(slot[1])
+            if self._uniform_proxy(parent) != [table.any_port[0]]:
+                continue
+            # A glob ranked between the two patterns could win once the inner one is gone
+            own_key = (-self.get_specificity("*." + slot[1]), "*." + slot[1])
+            parent_key = (-self.get_specificity(pattern), pattern)
+            if bisect_left(glob_keys, parent_key) != bisect_right(glob_keys, own_key):
+                continue
+            self.domain_trie.set_wildcard(slot[1], drop(slot, table, parent.any_port))
+
+        for slot, table in exact_tables.items():
+            if table.any_port is None:
+                continue
+            pattern, parent = self._wildcard_above(slot[1])
+            proxy = self._uniform_proxy(parent)
+            if proxy != [table.any_port[0]]:
+                continue
+            if self.glob_automaton is not None:
+                parent_key = (-self.get_specificity(pattern), pattern)
+                if any((-specificity, glob) < parent_key and self._uniform_proxy(glob_table) != proxy
+                       for specificity, glob, glob_table in self.glob_automaton.match_all(slot[1])):
+                    continue
+            exact_tables[slot] = drop(slot, table, parent.any_port)
+
+        for rule_id, covers in pruned.items():
+            if len(covers) == ip_slot_counts.get(rule_id, 1):
+                report.shadowed[rule_id] = covers[0]
+
+    @classmethod
+    def from_index(cls, index: RuleIndex, generation: int) -> "CompiledRules":
+        """
+        Wraps a memory-mapped RuleIndex as a snapshot, without compiling any rule.
+        Only the glob automata are built here (glob patterns are few); the snapshot
+        cannot take set_slot edits, RuleMatcher compiles the rules before the first one.
+        """
+        compiled = cls(generation)
+        compiled.domain_trie = _IndexedDomainTrie(index)
+        compiled.ip_trees = {4: _IndexedIPTree(index, 4), 6: _IndexedIPTree(index, 6)}
+        compiled.kind_counts = dict(index.kind_counts)
+        compiled.glob_tables = {pattern: PortTable.from_items(items) for pattern, items in index.globs()}
+        compiled.geo_tables = {key: PortTable.from_items(items) for key, items in index.geo()}
+        compiled.finish_globs()
+        return compiled
+
+    def write_index(self, path: str, digest: bytes, slot_rules: dict, rules: dict, pruned_slots=()) -> int:
+        """
+        Serializes this (built) snapshot to a RuleIndex file, see rule_index.write_rule_index.
+        Pruned slots are written in full, so an index answers every lookup with the rule
+        that actually matches without carrying the pruned_* tables.
+        """
+        pruned_slots = set(pruned_slots)
+        tables = ((slot, self.build_table(slot, slot_rules[slot], rules) if slot in pruned_slots else self.table_for(slot))
+                  for slot in slot_rules)
+        slot_items = ((slot, list(table.items())) for slot, table in tables if table is not None)
+        return write_rule_index(path, digest, self.kind_counts, slot_items)
 
-        print(f"[Matcher] Loaded {len(self._exact_domain_matches)} exact domains, "
-              f"{len(self._exact_ip_matches)} exact IPs, "
-              f"and {len(self._wildcard_domain_rules)} wildcard domain rules.")
-        # print(f"[Matcher] Sorted wildcards: {[r[1] for r in self._wildcard_domain_rules]}") # Debug print
+    def rule_count(self) -> int:
+        return sum(self.kind_counts.values())
+
+    @staticmethod
+    def prepare(target_lower: str) -> tuple:
+        """Parses a normalized target once: (ip_address or None, domain labels)."""
+        try:
+            address = ipaddress.ip_address(target_lower)
+        except ValueError:
+            address = None
+        return address, target_lower.split('.')
+
+    def match(self, target_lower: str, port: int | None, trace: "MatchTrace | None" = None,
+              prepared: tuple | None = None) -> tuple[str | None, str | None]:
+        """
+        Full rule lookup for an already normalized target (see RuleMatcher.match).
+        trace, if given, records every step; without it the lookup does no logging at all.
+        prepared is prepare(target_lower), for callers matching one host on several ports.
+        """
+        # Check if the target is an IP address
+        address, parts = prepared or self.prepare(target_lower)
+        if address is not None:
+            tree = self.ip_trees[address.version]
+            prefix_hits = tree.lookup(int(address)) if tree.size else None
+            if trace is not None: trace.step("ip", f"{len(prefix_hits or ())} covering prefixes")
+            if prefix_hits:
+                for rank, port_table in enumerate(prefix_hits): # Longest prefix first
+                    # Port, then narrowest port range, then all ports
+                    entry = port_table.lookup(port)
+                    if entry is not None:
+                        if self.pruned_ips[address.version]:
+                            entry = self._credit_pruned_ip(address, rank, entry)
+                        if trace is not None: trace.finish(entry, "ip")
+                        return entry
+            # Country / AS rules rank below every IP, CIDR and range rule
+            if self.geo_tables and self.geo_database is not None:
+                entry = self._match_geo(address, port, trace)
+                if entry is not None:
+                    return entry
+            if prefix_hits:
+                if trace is not None: trace.finish((None, None), "ip: no prefix accepts the port")
+                return None, None # No match for IP
+
+        # If not IP, proceed with domain matching logic
+        num_parts = len(parts)
+        # One O(labels) walk answers every exact, parent and '*.suffix' question
+        exact_hits, trie_wildcard, wildcard_depth = self.domain_trie.lookup(parts, port)
+
+        # 1. Exact domain match for the full host
+        if exact_hits[num_parts] is not None:
+            entry = exact_hits[num_parts]
+            if trace is not None: trace.finish(entry, "exact", target_lower)
+            return entry
+        if trace is not None: trace.step("exact", "no rule")
+
+        # 2. Wildcard match against the full host: deepest '*.suffix' vs the other globs.
+        # Any '*.suffix' that matches a parent also matches the full host, so this is
+        # the only level where the trie wildcards need to be considered.
+        best_wildcard_match = None
+        best_specificity = -1
+        best_pattern = None
+        trie_won = trie_wildcard is not None
+        if trie_wildcard is not None:
+            best_pattern = "*." + ".".join(parts[num_parts - wildcard_depth:])
+            best_specificity = self.get_specificity(best_pattern)
+            best_wildcard_match = trie_wildcard
+            if trace is not None: trace.candidate(best_pattern, trie_wildcard)
+        glob_match = self._match_glob(self.glob_automaton, target_lower, port, trace)
+        if glob_match is not None:
+            specificity, pattern, entry = glob_match
+            # Same ordering as the sorted wildcard list: longer first, then alphabetical
+            if specificity > best_specificity or (specificity == best_specificity and pattern < best_pattern):
+                best_specificity = specificity
+                best_pattern = pattern
+                best_wildcard_match = entry
+                trie_won = False
+        if best_wildcard_match:
+            if self.pruned_exact or self.pruned_wildcards:
+                best_wildcard_match = self._credit_pruned_domain(target_lower, parts, best_wildcard_match,
+                                                                 wildcard_depth if trie_won else None)
+            if trace is not None: trace.finish(best_wildcard_match, "wildcard", best_pattern)
+            return best_wildcard_match
+        if trace is not None: trace.step("wildcard", "no pattern")
+
+        # 3./4. Walk the parent domains from the longest down to the TLD
+        parent_globs = self.parent_glob_automaton
+        for i in range(1, num_parts):
+            exact_entry = exact_hits[num_parts - i]
+            if exact_entry is not None:
+                if trace is not None: trace.finish(exact_entry, "parent exact", ".".join(parts[i:]))
+                return exact_entry
+            if parent_globs is None:
+                continue
+            current_check_domain = ".".join(parts[i:])
+            if not current_check_domain: continue
+            glob_match = self._match_glob(parent_globs, current_check_domain, port, trace)
+            if glob_match is not None:
+                _specificity, pattern, entry = glob_match
+                if trace is not None: trace.finish(entry, "parent wildcard", pattern)
+                return entry
+
+        if trace is not None: trace.finish((None, None), "no rule for the host or its parents")
+        return None, None # No match found
+
+    def _credit_pruned_ip(self, address, rank: int, entry: tuple) -> tuple:
+        """
+        entry, the match of the rank-th covering prefix, credited to the longest pruned
+        prefix of address that is more specific, if any: it had the same proxy for all ports.
+        """
+        tree = self.ip_trees[address.version]
+        key = int(address)
+        lengths = tree.prefix_lengths(key)
+        if rank >= len(lengths): # Tree edited since the lookup, keep the entry as found
+            return entry
+        pruned = self.pruned_ips[address.version]
+        for prefixlen in sorted(pruned, reverse=True):
+            if prefixlen <= lengths[rank]:
+                break
+            rule_id = pruned[prefixlen].get(key & tree._masks[prefixlen])
+            if rule_id is not None:
+                return entry[0], rule_id
+        return entry
+
+    def _credit_pruned_domain(self, target_lower: str, parts: list, entry: tuple, wildcard_depth: int | None) -> tuple:
+        """
+        entry, the wildcard match of a host, credited to the pruned rule that would have
+        matched instead: an exact rule for the host, or (if the trie wildcard at
+        wildcard_depth won, None otherwise) the deepest pruned '*.suffix' below it.
+        """
+        rule_id = self.pruned_exact.get(target_lower)
+        if rule_id is None and wildcard_depth is not None and self.pruned_wildcards:
+            num_parts = len(parts)
+            for depth in range(num_parts - 1, wildcard_depth, -1):
+                rule_id = self.pruned_wildcards.get(".".join(parts[num_parts - depth:]))
+                if rule_id is not None:
+                    break
+        return entry if rule_id is None else (entry[0], rule_id)
+
+    def _match_geo(self, address, port: int | None, trace: "MatchTrace | None" = None) -> tuple | None:
+        """Returns the entry of the first 'asn:' / 'geo:' rule of address accepting port, or None."""
+        keys = self.geo_database.lookup(address)
+        if trace is not None: trace.step("geo", " ".join(keys) or "address not in the geo databases")
+        for key in keys: # AS number first, then country
+            table = self.geo_tables.get(key)
+            if table is None:
+                continue
+            entry = table.lookup(port)
+            if trace is not None: trace.candidate(key, entry)
+            if entry is not None:
+                if trace is not None: trace.finish(entry, "geo", key)
+                return entry
+        return None
+
+    @staticmethod
+    def _match_glob(automaton: GlobAutomaton | None, domain: str, port: int | None,
+                    trace: "MatchTrace | None" = None) -> tuple | None:
+        """Returns (specificity, pattern, entry) of the best glob accepting domain and port."""
+        if automaton is None:
+            return None
+        for specificity, pattern, table in automaton.match_all(domain):
+            entry = table.lookup(port)
+            if trace is not None: trace.candidate(pattern, entry)
+            if entry is not None:
+                return specificity, pattern, entry
+        return None
+
+
+class RuleMatcher:
+    """
+    Matches requested domains or IP addresses against the configured rules.
+    A matcher may sit on a base matcher (the global rules shared by every profile):
+    its own rules are looked up first and the base layer only decides hosts they do
+    not match, so the base rules are compiled once instead of into every profile.
+    """
+
+    MATCH_CACHE_SIZE = 4096 # Distinct (host, port) decisions kept in the LRU cache
+
+    def __init__(self, rule_stats: RuleStats | None = None, base: "RuleMatcher | None" = None):
+        self.base = base # Global rules layer, consulted when no rule of this matcher matches
+        self._match_cache = MatchCache(self.MATCH_CACHE_SIZE)
+        # Per-rule hits (and bytes, counted by the engine), may be shared between matchers
+        self.rule_stats = rule_stats if rule_stats is not None else RuleStats()
+        self._update_lock = threading.Lock() # Serializes writers only, lookups never take it
+        self._snapshot = CompiledRules() # Published rule set, replaced as a whole on reload
+        self._rules = {}      # {rule_id: rule_data} behind the snapshot, writer side only
+        self._slot_rules = {} # {slot: [rule_id, ...]}, see CompiledRules.rule_slots
+        self._rule_order = {} # {rule_id: position}, keeps slot lists in rule order across edits
+        self._next_position = 0
+        self._pruned_slots = () # Slots the last compile pruned (see CompiledRules._prune)
+        self.compile_report = None # CompileReport of the last compile, None when served from an index
+        self.geo_database = None # geo_db.GeoDatabase for 'geo:' / 'asn:' rules, see set_geo_database
+        # Match tracing (see set_trace). Off, a lookup pays for one attribute check.
+        self._tracing = False
+        self._trace_all = False
+        self._trace_hosts = frozenset()
+        self.trace_sink = None # Callable taking a MatchTrace; None prints trace.format()
+
+    def update_rules(self, rules_config: dict, index_path: str | None = None):
+        """
+        Compiles rules into a new snapshot and publishes it atomically.
+        Lookups already in flight finish on the previous snapshot, and cached decisions
+        made against it are invalidated by the new snapshot's generation.
+        Disabled rules may be included; they are kept for set_enabled but never match.
+
+        With index_path, a rule index file written for the same rule set (same content
+        hash) is memory-mapped and used as is instead of compiling; otherwise the rules
+        are compiled and written to an index file for the next start. Each rule set
+        has its own file (see rule_index.index_file), those of earlier ones are deleted.
+
+        Compiling drops redundant entries (rules covered by a broader rule with the same
+        proxy) and reports them, with duplicate and conflicting rules, in compile_report.
+        """
+        print("[Matcher] Updating rules...")
+        with self._update_lock:
+            rules = {rule_id: dict(rule_data) for rule_id, rule_data in rules_config.items()}
+            generation = self._snapshot.generation + 1
+            digest = rules_digest(rules) if index_path else None
+            digest_path = index_file(index_path, digest) if index_path else None
+            index = RuleIndex.open(digest_path, digest) if index_path else None
+            report = None
+            if index is not None:
+                snapshot, slot_rules = CompiledRules.from_index(index, generation), None # Compiled on first edit
+                print(f"[Matcher] Using rule index '{digest_path}'.")
+                if index.domain_filter is not None:
+                    domain_filter = index.domain_filter
+                    print(f"[Matcher] Domain prefilter: {domain_filter.key_count} keys in "
+                          f"{domain_filter.size_bytes() / 1024:.0f} KiB, "
+                          f"~{domain_filter.false_positive_rate():.2%} false positives.")
+            else:
+                report = CompileReport()
+                snapshot, slot_rules = CompiledRules.build(rules, generation, report)
+            self._rules, self._slot_rules = rules, slot_rules
+            self._pruned_slots = report.pruned_slots if report is not None else ()
+            self.compile_report = report
+            self._rule_order = {rule_id: position for position, rule_id in enumerate(rules)}
+            self._next_position = len(rules)
+            snapshot.geo_database = self.geo_database
+            self._snapshot = snapshot # Single reference assignment publishes the new rules
+
+            if index is None and index_path:
+                try:
+                    size = snapshot.write_index(digest_path, digest, slot_rules, rules, self._pruned_slots)
+                    print(f"[Matcher] Wrote rule index '{digest_path}' ({size} bytes).")
+                except OSError as e:
+                    print(f"[Matcher] Warning: Could not write rule index '{digest_path}': {e}")
+            if index_path:
+                remove_stale_indexes(index_path, digest_path)
+
+        counts = snapshot.kind_counts
+        print(f"[Matcher] Loaded {counts[CompiledRules.EXACT]} exact domains, "
+              f"{counts[CompiledRules.IP]} IP/CIDR/range rules, "
+              f"{counts[CompiledRules.GEO]} country/AS rules, "
+              f"{counts[CompiledRules.WILDCARD]} suffix wildcards "
+              f"and {counts[CompiledRules.GLOB]} other wildcard domain rules.")
+        if report is not None and (report.duplicates or report.pruned_entries):
+            print(f"[Matcher] Compiled rules: {report.summary()}.")
+
+    def add_rule(self, rule_id: str, rule_data: dict):
+        """Adds or replaces one rule without recompiling the others."""
+        self._apply_delta(rule_id, dict(rule_data))
+
+    def remove_rule(self, rule_id: str):
+        """Removes one rule without recompiling the others. Unknown ids are ignored."""
+        self._apply_delta(rule_id, None)
+
+    def set_enabled(self, rule_id: str, enabled: bool):
+        """Enables or disables one loaded rule without recompiling the others."""
+        with self._update_lock:
+            rule_data = self._rules.get(rule_id)
+            if rule_data is None or rule_data.get("enabled", True) == enabled:
+                return
+            rule_data = dict(rule_data, enabled=enabled)
+            self._apply_delta_locked(rule_id, rule_data)
+
+    def _apply_delta(self, rule_id: str, rule_data: dict | None):
+        with self._update_lock:
+            self._apply_delta_locked(rule_id, rule_data)
+
+    def _apply_delta_locked(self, rule_id: str, rule_data: dict | None):
+        """
+        Replaces (rule_data=None: removes) one rule and publishes a derived snapshot.
+        Only the PortTables of the targets the old and new rule compile into are rebuilt,
+        plus the glob automata if one of those targets is a glob. The first edit after a
+        compile also restores the pruned entries, which the edit may stop being redundant.
+        """
+        old_data = self._rules.get(rule_id)
+        if old_data is None and rule_data is None:
+            return
+        if self._slot_rules is None:
+            # Snapshot served from a rule index: compile it once so it can take edits
+            compiled, self._slot_rules = CompiledRules.build(self._rules, self._snapshot.generation)
+            compiled.geo_database = self.geo_database
+            self._snapshot = compiled
+        old_slots = CompiledRules.rule_slots(old_data) if old_data else []
+        new_slots = CompiledRules.rule_slots(rule_data) if rule_data else []
+
+        for slot in old_slots:
+            if slot not in new_slots:
+                self._slot_rules[slot].remove(rule_id)
+        if rule_data is None:
+            del self._rules[rule_id]
+            del self._rule_order[rule_id]
+        else:
+            self._rules[rule_id] = rule_data
+            if rule_id not in self._rule_order:
+                self._rule_order[rule_id] = self._next_position
+                self._next_position += 1
+        order = self._rule_order
+        for slot in new_slots:
+            rule_ids = self._slot_rules.setdefault(slot, [])
+            if rule_id not in rule_ids:
+                # Same position a full rebuild would give it (duplicates resolve by rule order)
+                rule_ids.insert(bisect_left([order[r] for r in rule_ids], order[rule_id]), rule_id)
+
+        snapshot = self._snapshot.derive()
+        for slot in self._pruned_slots:
+            rule_ids = self._slot_rules.get(slot)
+            snapshot.set_slot(slot, CompiledRules.build_table(slot, rule_ids, self._rules) if rule_ids else None)
+        if self._pruned_slots:
+            snapshot.pruned_exact, snapshot.pruned_wildcards, snapshot.pruned_ips = {}, {}, {4: {}, 6: {}}
+        self._pruned_slots = ()
+        snapshot.count_rule(old_data, old_slots, -1)
+        snapshot.count_rule(rule_data, new_slots, 1)
+        globs_changed = False
+        for slot in dict.fromkeys(old_slots + new_slots):
+            rule_ids = self._slot_rules.get(slot)
+            table = CompiledRules.build_table(slot, rule_ids, self._rules) if rule_ids else None
+            if not rule_ids:
+                self._slot_rules.pop(slot, None)
+            snapshot.set_slot(slot, table)
+            globs_changed = globs_changed or slot[0] == CompiledRules.GLOB
+        if globs_changed:
+            snapshot.finish_globs()
+        self._snapshot = snapshot # Publishes the edit and invalidates cached decisions
+        print(f"[Matcher] Applied change to rule '{rule_id}' ({snapshot.rule_count()} rules active).")
 
     def match(self, target: str, port: int = None) -> tuple[str | None, str | None]:
         """
-        Finds the best matching rule for a given domain or IP address, with port and port range support for IPs.
-        If target is an IP:
-          1. Exact IP+port match
+        Finds the best matching rule for a given domain or IP address, with port and port range support.
+        If target is an IP, the covering prefixes (exact IP, CIDR blocks, ranges) are
+        tried from the longest to the shortest, and for each of them:
+          1. IP+port match
           2. IP+port in range match
-          3. Exact IP match (all ports)
-        If target is a Domain:
+          3. IP match (all ports)
+        then, if no prefix accepts the port, the 'asn:' and 'geo:' rules of the address.
+        If target is a Domain (a rule only counts if its port qualifier accepts the port):
           1. Exact match (sub.domain.com)
           2. Wildcard match (*.domain.com) matching the full domain
           3. Parent domain exact match (domain.com)
           4. Parent domain wildcard match (*.com)
 
+        Only if none of these rules matches is the base layer (global rules) searched the
+        same way, so a profile rule always overrides a global rule for the same host.
+
+        The target is normalized first (punycode, no trailing dot, see hostnames.normalize_host),
+        the same way rule targets are at compile time.
+
         Returns (proxy_id, rule_id) or (None, None) if no match.
-        Note: Currently rule_id returned is the same as proxy_id for simplicity.
-              A future enhancement could map back to the original rule_id if needed.
+        Decisions are served from an LRU cache until the rules of either layer change.
+        Every match counts as a hit for its rule in rule_stats.
+        Nothing is logged unless tracing is enabled for the host (see set_trace).
         """
-        target_lower = target.lower().strip()
+        target_lower = normalize_host(target)
         if not target_lower: return None, None
-        print(f"[Matcher] Attempting match for: '{target_lower}' (port={port})")
+        if self._tracing and (self._trace_all or target_lower in self._trace_hosts):
+            trace = self.explain(target_lower, port)
+            if trace.result[1] is not None:
+                self.rule_stats.record(trace.result[1])
+            if self.trace_sink is not None:
+                self.trace_sink(trace)
+            else:
+                print(trace.format())
+            return trace.result
+        snapshot, base_snapshot, generation = self._layers()
+        cache_key = (target_lower, port)
+        result = self._match_cache.get(cache_key, generation)
+        if result is None:
+            result = snapshot.match(target_lower, port)
+            if result[1] is None and base_snapshot is not None:
+                result = base_snapshot.match(target_lower, port)
+            self._match_cache.put(cache_key, generation, result)
+        if result[1] is not None:
+            self.rule_stats.record(result[1])
+        return result
 
-        # Check if the target is an IP address
-        if self._is_ip_address(target_lower):
-            ip_rules = self._exact_ip_matches.get(target_lower)
-            if ip_rules:
-                # 1. Try port-specific match
-                if port is not None and port in ip_rules:
-                    proxy_id = ip_rules[port]
-                    print(f"[Matcher] Found exact IP+port match: {target_lower}:{port} -> Proxy '{proxy_id}'")
-                    return proxy_id, proxy_id
-                # 2. Try port range match
-                if port is not None:
-                    for key, proxy_id in ip_rules.items():
-                        if isinstance(key, tuple) and key[0] <= port <= key[1]:
-                            print(f"[Matcher] Found IP+port range match: {target_lower}:{port} in {key[0]}-{key[1]} -> Proxy '{proxy_id}'")
-                            return proxy_id, proxy_id
-                # 3. Try generic IP match (all ports)
-                if None in ip_rules:
-                    proxy_id = ip_rules[None]
-                    print(f"[Matcher] Found exact IP match (all ports): {target_lower} -> Proxy '{proxy_id}'")
-                    return proxy_id, proxy_id
-                print(f"[Matcher] No specific IP rule found for '{target_lower}' (port={port}).")
-                return None, None # No match for IP
+    def _layers(self) -> tuple:
+        """
+        Reads the published snapshots once, so a whole lookup uses one consistent rule
+        set: (snapshot, base snapshot or None, generation tag for cached decisions).
+        """
+        snapshot = self._snapshot
+        if self.base is None:
+            return snapshot, None, snapshot.generation
+        base_snapshot = self.base._snapshot
+        return snapshot, base_snapshot, (snapshot.generation, base_snapshot.generation)
 
-        # If not IP, proceed with domain matching logic
-        print(f"[Matcher] Target '{target_lower}' is a domain. Proceeding with domain matching...")
-        parts = target_lower.split('.')
-        # Iterate from the full domain down to the base domain
-        for i in range(len(parts)):
-            current_check_domain = ".".join(parts[i:])
-            if not current_check_domain: continue
+    @property
+    def generation(self):
+        """Tag that changes whenever the rules of this matcher or of its base layer change."""
+        return self._layers()[2]
 
-            print(f"[Matcher] Checking domain segment: '{current_check_domain}'")
+    def loaded_rules(self) -> dict:
+        """Returns a copy of the loaded rules, {rule_id: rule_data} in rule order."""
+        with self._update_lock:
+            return dict(self._rules)
 
-            # 1. Exact domain match for the current segment
-            if current_check_domain in self._exact_domain_matches:
-                proxy_id = self._exact_domain_matches[current_check_domain]
-                print(f"[Matcher] Found exact domain match: '{current_check_domain}' -> Proxy '{proxy_id}'")
-                return proxy_id, proxy_id
+    def explain(self, target: str, port: int = None) -> MatchTrace:
+        """Runs a full (uncached, uncounted) lookup and returns its MatchTrace."""
+        target_lower = normalize_host(target)
+        snapshot, base_snapshot, generation = self._layers()
+        trace = MatchTrace(target_lower, port, generation)
+        if target_lower:
+            if snapshot.match(target_lower, port, trace=trace)[1] is None and base_snapshot is not None:
+                trace.step("profile", trace.reason)
+                if base_snapshot.match(target_lower, port, trace=trace)[1] is not None:
+                    trace.reason = "global " + trace.reason
+        else:
+            trace.finish((None, None), "empty target")
+        return trace
 
-            # 2. Wildcard domain match for the current segment
-            best_wildcard_match = None
-            best_specificity = -1
+    def set_trace(self, enabled: bool, host: str | None = None):
+        """
+        Turns match tracing on or off for one host, or for every lookup when host is None.
+        Traced lookups bypass the decision cache and hand a MatchTrace to trace_sink.
+        """
+        if host is None:
+            self._trace_all = enabled
+            if not enabled:
+                self._trace_hosts = frozenset()
+        else:
+            host = normalize_host(host)
+            # Copy-on-write so lookups never see the set change under them
+            self._trace_hosts = self._trace_hosts | {host} if enabled else self._trace_hosts - {host}
+        self._tracing = self._trace_all or bool(self._trace_hosts)
 
-            for specificity, pattern, proxy_id in self._wildcard_domain_rules:
-                if fnmatch.fnmatchcase(current_check_domain, pattern):
-                    if specificity > best_specificity:
-                         best_specificity = specificity
-                         best_wildcard_match = (proxy_id, proxy_id)
-                         print(f"[Matcher] Found potential wildcard match: '{current_check_domain}' vs '{pattern}' (Specificity: {specificity}) -> Proxy '{proxy_id}'")
+    def match_many(self, targets) -> list:
+        """
+        Resolves many (target, port) pairs in one call, e.g. to replay a traffic sample.
+        All pairs are matched against the same snapshot; every distinct host is parsed
+        once and every distinct (host, port) pair resolved once, through a batch-local
+        table rather than the LRU cache so a large batch does not evict live decisions.
+        Returns [(proxy_id, rule_id)] in input order and counts hits like match().
+        """
+        snapshot, base_snapshot, _generation = self._layers()
+        decisions = {} # {(target_lower, port): (proxy_id, rule_id)}
+        prepared = {}  # {target_lower: snapshot.prepare(target_lower)}
+        hits = {}      # {rule_id: count}, recorded once per rule at the end
+        results = []
+        for target, port in targets:
+            target_lower = normalize_host(target)
+            key = (target_lower, port)
+            result = decisions.get(key)
+            if result is None:
+                if not target_lower:
+                    result = (None, None)
+                else:
+                    host = prepared.get(target_lower)
+                    if host is None:
+                        host = prepared[target_lower] = snapshot.prepare(target_lower)
+                    result = snapshot.match(target_lower, port, prepared=host)
+                    if result[1] is None and base_snapshot is not None:
+                        result = base_snapshot.match(target_lower, port, prepared=host)
+                decisions[key] = result
+            rule_id = result[1]
+            if rule_id is not None:
+                hits[rule_id] = hits.get(rule_id, 0) + 1
+            results.append(result)
+        for rule_id, count in hits.items():
+            self.rule_stats.record(rule_id, hits=count)
+        return results
 
-            if best_wildcard_match:
-                 print(f"[Matcher] Using best wildcard match: Proxy '{best_wildcard_match[0]}'")
-                 return best_wildcard_match
+    def set_geo_database(self, geo_database):
+        """
+        Sets the geo_db.GeoDatabase 'geo:' and 'asn:' rules are matched against (None:
+        those rules never match) and publishes it with a derived snapshot, which also
+        invalidates the decisions cached without it.
+        """
+        with self._update_lock:
+            self.geo_database = geo_database
+            snapshot = self._snapshot.derive()
+            snapshot.geo_database = geo_database
+            self._snapshot = snapshot
 
-        print(f"[Matcher] No domain rule found for '{target_lower}' or its parents.")
-        return None, None # No match found
+    def has_ip_rules(self) -> bool:
+        """True if this matcher or its base layer has enabled IP/CIDR/range or country/AS rules."""
+        counts = self._snapshot.kind_counts
+        if counts[CompiledRules.IP] or counts[CompiledRules.GEO]:
+            return True
+        return self.base is not None and self.base.has_ip_rules()
+
+    def cache_stats(self) -> dict:
+        """Returns hit/miss/eviction counters of the decision cache."""
+        return self._match_cache.stats()
 
     def rule_count(self) -> int:
-        """Returns the total number of loaded rules."""
-        # Update count to include IPs
-        return len(self._exact_domain_matches) + len(self._exact_ip_matches) + len(self._wildcard_domain_rules) 
\ No newline at end of file
+        """Returns the total number of loaded rules (without the base layer's)."""
+        return self._snapshot.rule_count()
@@ -0,0 +1,64 @@
+import threading
+
+
+class _StatsShard:
+    """Counters written by one handler thread. Its lock is only contended while merging."""
+    __slots__ = ("lock", "counts", "thread")
+
+    def __init__(self, thread: threading.Thread):
+        self.lock = threading.Lock()
+        self.counts = {} # {rule_id: [hits, bytes]}
+        self.thread = thread
+
+
+class RuleStats:
+    """
+    Per-rule hit and byte counters. Every thread counts into its own shard, so
+    concurrent handlers never wait on each other; merge() periodically folds the shards
+    into the totals (and drops the shards of finished threads).
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []                     # Every live shard, guarded by _registry_lock
+        self._registry_lock = threading.Lock() # Taken once per new thread and by merge()
+        self._totals = {}                     # {rule_id: (hits, bytes)}, replaced on merge
+
+    def _shard(self) -> _StatsShard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = _StatsShard(threading.current_thread())
+            with self._registry_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def record(self, rule_id: str, hits: int = 1, byte_count: int = 0):
+        """Counts hits and relayed bytes for a rule from the calling thread."""
+        shard = self._shard()
+        with shard.lock:
+            counter = shard.counts.get(rule_id)
+            if counter is None:
+                shard.counts[rule_id] = [hits, byte_count]
+            else:
+                counter[0] += hits
+                counter[1] += byte_count
+
+    def merge(self) -> dict:
+        """Folds every shard into the totals and returns them as {rule_id: (hits, bytes)}."""
+        with self._registry_lock: # Also serializes concurrent merges
+            shards = self._shards
+            self._shards = [shard for shard in shards if shard.thread.is_alive()]
+            totals = dict(self._totals)
+            for shard in shards:
+                with shard.lock:
+                    counts, shard.counts = shard.counts, {}
+                for rule_id, (hits, byte_count) in counts.items():
+                    old_hits, old_bytes = totals.get(rule_id, (0, 0))
+                    totals[rule_id] = (old_hits + hits, old_bytes + byte_count)
+            self._totals = totals
+        return totals
+
+    def totals(self) -> dict:
+        """Returns the totals as of the last merge."""
+        return self._totals
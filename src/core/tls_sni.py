@@ -0,0 +1,67 @@
+"""
+Minimal TLS ClientHello reader: finds the server name (SNI) a client is about to send
+through a CONNECT tunnel. Works on the raw bytes in place, with index arithmetic only;
+nothing but the returned name is allocated.
+"""
+
+TLS_HANDSHAKE = 0x16
+CLIENT_HELLO = 0x01
+EXT_SERVER_NAME = 0x0000
+NAME_TYPE_HOST = 0x00
+
+
+def client_hello_length(data) -> int | None:
+    """
+    Number of bytes holding the first TLS record of data (5 while the record header is
+    incomplete), or None if data does not start with a TLS handshake record.
+    """
+    if not data or data[0] != TLS_HANDSHAKE:
+        return None
+    if len(data) < 5:
+        return 5
+    return 5 + (data[3] << 8 | data[4])
+
+
+def parse_sni(data) -> str | None:
+    """
+    Returns the host name of the server_name extension of a ClientHello at the start of
+    data (bytes or memoryview), or None if there is none, the data is not a ClientHello
+    or it is cut short. Only the first TLS record is read.
+    """
+    n = len(data)
+    if n < 9 or data[0] != TLS_HANDSHAKE or data[5] != CLIENT_HELLO:
+        return None
+    end = min(n, 5 + (data[3] << 8 | data[4]))
+    i = 5 + 4 + 2 + 32 # Record header, handshake header, client_version, random
+    if i >= end:
+        return None
+    i += 1 + data[i] # session_id
+    if i + 2 > end:
+        return None
+    i += 2 + (data[i] << 8 | data[i + 1]) # cipher_suites
+    if i >= end:
+        return None
+    i += 1 + data[i] # compression_methods
+    if i + 2 > end:
+        return None
+    extensions_end = min(end, i + 2 + (data[i] << 8 | data[i + 1]))
+    i += 2
+    while i + 4 <= extensions_end:
+        extension_type = data[i] << 8 | data[i + 1]
+        extension_end = i + 4 + (data[i + 2] << 8 | data[i + 3])
+        if extension_type == EXT_SERVER_NAME:
+            j = i + 6 # Extension header, server_name_list length
+            list_end = min(extension_end, extensions_end)
+            while j + 3 <= list_end:
+                name_end = j + 3 + (data[j + 1] << 8 | data[j + 2])
+                if name_end > list_end:
+                    return None
+                if data[j] == NAME_TYPE_HOST and name_end > j + 3:
+                    try:
+                        return str(data[j + 3:name_end], "ascii")
+                    except UnicodeDecodeError:
+                        return None
+                j = name_end
+            return None
+        i = extension_end
+    return None
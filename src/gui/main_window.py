@@ -26,8 +26,10 @@ from .widgets.proxy_edit_widget import ProxyEditWidget
 from .widgets.rule_item_widget import RuleItemWidget # Added
 from .widgets.rule_edit_widget import RuleEditWidget # Added
 from .widgets.quick_rule_add_dialog import QuickRuleAddDialog
+from .utils import GLOBAL_PROFILE_NAME
 # Import Core components using relative paths
-from ..core.proxy_engine import ProxyEngine # <<< Changed to relative import
+from ..core.proxy_engine import BACKEND_ASYNCIO, BACKEND_THREADS, ProxyEngine # <<< Changed to relative import
+from ..core.rule_matcher import GLOBAL_PROFILE_ID # profile_id of the rules that apply in every profile
 from ..core.hotkey_manager import IS_WINDOWS, HotkeyManager # <<< Import HotkeyManager
 # RuleMatcher will likely be used internally by the engine, but good to have the file
 
@@ -254,6 +256,7 @@ class MainWindow(QMainWindow):
         self.proxy_widgets = {}
         self.rules = {}
         self.rule_widgets = {}
+        self._rule_stats = {} # {rule_id: (hits, bytes)} as last published by the engine
         self.profiles = {} # Initialize empty, load_settings will handle default
         self._current_active_profile_id = None # Initialize profile ID
 
@@ -264,6 +267,8 @@ class MainWindow(QMainWindow):
 
         # Initialize Core Components (Needed before connections)
         self.proxy_engine = ProxyEngine()
+        self.proxy_engine.rule_index_path = os.path.join(config_dir, "rules.idx") # Next to settings.ini
+        self.proxy_engine.pac_path = os.path.join(config_dir, "proxy.pac")
         self.hotkey_manager = HotkeyManager()
         
         # Flag to track if we're in the middle of a profile switch
@@ -545,6 +550,43 @@ class MainWindow(QMainWindow):
         self.start_engine_checkbox.setObjectName("StartEngineCheckbox")
         settings_form_layout.addWidget(self.start_engine_checkbox)
 
+        self.resolve_hostnames_checkbox = QCheckBox("Resolve hostnames to match IP/CIDR rules")
+        self.resolve_hostnames_checkbox.setToolTip("When no domain rule matches, look up the host's addresses and apply IP rules to them")
+        self.resolve_hostnames_checkbox.setObjectName("ResolveHostnamesCheckbox")
+        settings_form_layout.addWidget(self.resolve_hostnames_checkbox)
+
+        self.sni_routing_checkbox = QCheckBox("Route HTTPS connections to IP addresses by server name (SNI)")
+        self.sni_routing_checkbox.setToolTip("For CONNECT requests to an IP address, read the TLS server name and match domain rules against it")
+        self.sni_routing_checkbox.setObjectName("SniRoutingCheckbox")
+        settings_form_layout.addWidget(self.sni_routing_checkbox)
+
+        backend_layout = QHBoxLayout()
+        backend_layout.addWidget(QLabel("Engine backend:"))
+        self.engine_backend_combo = QComboBox()
+        self.engine_backend_combo.setObjectName("EngineBackendCombo")
+        self.engine_backend_combo.addItem("Threads (one per connection)", BACKEND_THREADS)
+        self.engine_backend_combo.addItem("Asyncio (one event loop, many connections)", BACKEND_ASYNCIO)
+        self.engine_backend_combo.setToolTip("How client connections are served. Takes effect the next time the engine starts.")
+        backend_layout.addWidget(self.engine_backend_combo)
+        backend_layout.addStretch()
+        settings_form_layout.addLayout(backend_layout)
+
+        geo_databases_layout = QHBoxLayout()
+        geo_databases_layout.addWidget(QLabel("GeoIP/ASN databases:"))
+        self.geo_databases_edit = QLineEdit()
+        self.geo_databases_edit.setObjectName("GeoDatabasesEdit")
+        self.geo_databases_edit.setPlaceholderText("GeoLite2-Country.mmdb; GeoLite2-ASN.mmdb")
+        self.geo_databases_edit.setToolTip("MaxMind .mmdb or compiled .geodb files, separated by ';', used by geo:XX and asn:N rules")
+        geo_databases_layout.addWidget(self.geo_databases_edit, stretch=1)
+        settings_form_layout.addLayout(geo_databases_layout)
+
+        self.pac_info_label = QLabel(f"Proxy auto-config: point browsers at http://127.0.0.1:{self.proxy_engine.listening_port}/proxy.pac "
+                                     "(also written to proxy.pac in the settings folder) to connect directly wherever the rules say Direct.")
+        self.pac_info_label.setObjectName("PacInfoLabel")
+        self.pac_info_label.setWordWrap(True)
+        self.pac_info_label.setTextInteractionFlags(Qt.TextInteractionFlag.TextSelectableByMouse)
+        settings_form_layout.addWidget(self.pac_info_label)
+
         # System Proxy (Windows Only)
         if IS_WINDOWS:
             self.enable_system_proxy_checkbox = QCheckBox("Set as system proxy when engine is active")
@@ -748,6 +790,7 @@ class MainWindow(QMainWindow):
         self.proxy_engine.status_changed.connect(self._handle_engine_status_update_ui)
         self.proxy_engine.error_occurred.connect(self._handle_engine_error)
         self.proxy_engine.proxy_test_result.connect(self._handle_proxy_test_result)
+        self.proxy_engine.rule_stats_updated.connect(self._handle_rule_stats_updated)
 
         # Tray Icon Actions
         if self.tray_icon: # Check if tray icon was successfully created
@@ -766,6 +809,10 @@ class MainWindow(QMainWindow):
         self.theme_combo.currentIndexChanged.connect(self._handle_theme_change)
         self.close_to_tray_checkbox.stateChanged.connect(self._handle_close_setting_change)
         self.start_engine_checkbox.stateChanged.connect(self.save_settings) # Save immediately on change
+        self.resolve_hostnames_checkbox.stateChanged.connect(self._handle_resolve_hostnames_change)
+        self.sni_routing_checkbox.stateChanged.connect(self._handle_sni_routing_change)
+        self.engine_backend_combo.currentIndexChanged.connect(self._handle_engine_backend_change)
+        self.geo_databases_edit.editingFinished.connect(self._handle_geo_databases_change)
         # Hotkey Edits (Connect saving to editingFinished or textChanged?)
         # Using editingFinished is better to avoid saving on every keystroke
         self.toggle_hotkey_edit.editingFinished.connect(self._save_hotkey_setting)
@@ -1262,7 +1309,7 @@ class MainWindow(QMainWindow):
         if self._current_active_profile_id:
             for rule_id, rule_data in loaded_rules.items():
                 rule_profile_id = rule_data.get("profile_id")
-                if rule_profile_id is None or rule_profile_id not in self.profiles:
+                if rule_profile_id != GLOBAL_PROFILE_ID and (rule_profile_id is None or rule_profile_id not in self.profiles):
                     print(f"[Settings] Rule '{rule_id}' ({rule_data.get('domain')}) has invalid/missing profile ID '{rule_profile_id}'. Assigning to active profile '{self._current_active_profile_id}'.")
                     rule_data["profile_id"] = self._current_active_profile_id
                 if "enabled" not in rule_data:
@@ -1303,6 +1350,33 @@ class MainWindow(QMainWindow):
         self.start_engine_checkbox.setChecked(start_on_startup)
         self.start_engine_checkbox.blockSignals(False) # <<< Unblock signals
 
+        # Load Hostname Resolution Setting
+        resolve_hostnames = settings.value("engine/resolve_hostnames", defaultValue=False, type=bool)
+        self.resolve_hostnames_checkbox.blockSignals(True)
+        self.resolve_hostnames_checkbox.setChecked(resolve_hostnames)
+        self.resolve_hostnames_checkbox.blockSignals(False)
+        self.proxy_engine.resolve_hostnames = resolve_hostnames
+
+        # Load SNI Routing Setting
+        sni_routing = settings.value("engine/sni_routing", defaultValue=False, type=bool)
+        self.sni_routing_checkbox.blockSignals(True)
+        self.sni_routing_checkbox.setChecked(sni_routing)
+        self.sni_routing_checkbox.blockSignals(False)
+        self.proxy_engine.sni_routing = sni_routing
+
+        # Load Engine Backend Setting
+        backend = settings.value("engine/backend", defaultValue=BACKEND_THREADS, type=str)
+        backend_index = max(0, self.engine_backend_combo.findData(backend))
+        self.engine_backend_combo.blockSignals(True)
+        self.engine_backend_combo.setCurrentIndex(backend_index)
+        self.engine_backend_combo.blockSignals(False)
+        self.proxy_engine.backend = self.engine_backend_combo.currentData()
+
+        # Load Geo Database Setting
+        geo_databases = settings.value("engine/geo_databases", defaultValue="", type=str)
+        self.geo_databases_edit.setText(geo_databases)
+        self.proxy_engine.set_geo_databases(self._geo_database_paths())
+
         # Load System Proxy Setting (Windows only)
         if hasattr(self, 'enable_system_proxy_checkbox'):
             use_system_proxy = settings.value("app/set_system_proxy", defaultValue=False, type=bool)
@@ -1414,8 +1488,9 @@ class MainWindow(QMainWindow):
         settings.beginGroup("rules")
         for key in settings.childGroups():
             settings.remove(key)
-        # Only save rules with valid profile_id
-        valid_rules_to_save = [r for r in self.rules.values() if r.get("profile_id") in self.profiles]
+        # Only save rules with valid profile_id (or global rules)
+        valid_rules_to_save = [r for r in self.rules.values()
+                               if r.get("profile_id") in self.profiles or r.get("profile_id") == GLOBAL_PROFILE_ID]
         sorted_rules = sorted(valid_rules_to_save, key=lambda r: r.get('domain', '').lower())
         for rule in sorted_rules:
             group_name = f"rule:{rule.get('domain', rule.get('id', 'Unknown'))}"
@@ -1436,6 +1511,10 @@ class MainWindow(QMainWindow):
 
         # Save Startup Setting
         settings.setValue("app/start_engine_on_startup", self.start_engine_checkbox.isChecked())
+        settings.setValue("engine/resolve_hostnames", self.resolve_hostnames_checkbox.isChecked())
+        settings.setValue("engine/sni_routing", self.sni_routing_checkbox.isChecked())
+        settings.setValue("engine/backend", self.engine_backend_combo.currentData())
+        settings.setValue("engine/geo_databases", self.geo_databases_edit.text().strip())
 
         # Save System Proxy Setting (Windows only)
         if hasattr(self, 'enable_system_proxy_checkbox'):
@@ -1488,8 +1567,7 @@ class MainWindow(QMainWindow):
         """Helper to get {profile_id: profile_name} for existing profiles."""
         # Start with existing profiles
         names = {pid: pdata.get('name', 'Unnamed') for pid, pdata in self.profiles.items()}
-        # ---> Remove the line adding the non-existent constant <---
-        # names[None] = self.ALL_RULES_PROFILE_NAME # Map None ID to the display name
+        names[GLOBAL_PROFILE_ID] = GLOBAL_PROFILE_NAME # Rules that apply in every profile
         return names
 
     def _show_add_rule_editor(self):
@@ -1814,6 +1892,7 @@ class MainWindow(QMainWindow):
 
         editing_existing = bool(self.rule_edit_widget and self.rule_edit_widget._editing_rule_id)
         rule_id_to_select = None # ID of the rule to scroll to
+        changed_rule_ids = [] # Rules to push to a running engine
 
         if editing_existing:
             rule_id = self.rule_edit_widget._editing_rule_id
@@ -1833,13 +1912,14 @@ class MainWindow(QMainWindow):
                 del self.rules[rule_id]['port']
             print(f"[Rules] Updated rule ID {rule_id}: Domain='{domain}', Proxy='{proxy_id}', Profile='{profile_id}', Port={port}")
             rule_id_to_select = rule_id
+            changed_rule_ids.append(rule_id)
         else:
             new_rule_ids = []
             for domain, port in domain_port_tuples:
                  existing_id = self._find_rule_by_domain_and_profile(domain, profile_id)
                  if existing_id:
                       reply = QMessageBox.question(self, "Duplicate Rule",
-                                                f"A rule for '{domain}' already exists in profile '{self.profiles.get(profile_id, {}).get('name', profile_id)}'.\n\nDo you want to overwrite it?",
+                                                f"A rule for '{domain}' already exists in profile '{self._get_profile_name_map().get(profile_id, profile_id)}'.\n\nDo you want to overwrite it?",
                                                 QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
                                                 QMessageBox.StandardButton.No)
                       if reply == QMessageBox.StandardButton.Yes:
@@ -1849,6 +1929,7 @@ class MainWindow(QMainWindow):
                            elif 'port' in self.rules[existing_id]:
                                del self.rules[existing_id]['port']
                            print(f"[Rules] Overwrote rule ID {existing_id} for domain '{domain}'.")
+                           changed_rule_ids.append(existing_id)
                            if rule_id_to_select is None:
                                 rule_id_to_select = existing_id
                       else:
@@ -1867,8 +1948,13 @@ class MainWindow(QMainWindow):
                           rule["port"] = port
                       self.rules[new_id] = rule
                       print(f"[Rules] Added new rule ID {new_id} for domain '{domain}', Port={port}.")
+                      changed_rule_ids.append(new_id)
                       if rule_id_to_select is None:
                            rule_id_to_select = new_id
+        # Apply only the changed rules if the engine is running (moves out of the active profile drop them)
+        if self.proxy_engine.is_active:
+            for changed_id in changed_rule_ids:
+                self.proxy_engine.add_rule(changed_id, self.rules[changed_id])
         def complete_save_process():
             print("[Save Rule] Rebuilding rule list...")
             self._rebuild_rule_list_safely()
@@ -1946,9 +2032,9 @@ class MainWindow(QMainWindow):
                 # Save settings
                 self.save_settings()
                 
-                # Update engine if running and the rule was in the active profile
-                if self.proxy_engine.is_active and profile_id == self._current_active_profile_id:
-                    self.proxy_engine.update_config(self.rules, self.proxies, self._current_active_profile_id)
+                # Update engine if running; rules of inactive profiles are kept for their next activation
+                if self.proxy_engine.is_active:
+                    self.proxy_engine.remove_rule(rule_id)
                 
                 # Update the rule count label
                 self._update_rule_count_label()
@@ -1981,10 +2067,9 @@ class MainWindow(QMainWindow):
             if rule_id in self.rule_widgets:
                 self.rule_widgets[rule_id].set_enabled_style(enabled)
 
-            # Update engine if running and the rule is in the active profile
-            rule_profile_id = self.rules[rule_id].get('profile_id')
-            if self.proxy_engine.is_active and rule_profile_id == self._current_active_profile_id:
-                 self.proxy_engine.update_config(self.rules, self.proxies, self._current_active_profile_id)
+            # Update engine if running; rules of inactive profiles are kept for their next activation
+            if self.proxy_engine.is_active:
+                 self.proxy_engine.set_rule_enabled(rule_id, enabled)
 
             self.save_settings()
             self.show_status_message(f"Rule {'enabled' if enabled else 'disabled'}.")
@@ -2049,6 +2134,8 @@ class MainWindow(QMainWindow):
                         widget.edit_rule.connect(self._show_edit_rule_editor)
                         widget.delete_rule.connect(self._delete_rule_entry)
                         widget.toggle_enabled.connect(self._toggle_rule_enabled)
+                        if rule_id in self._rule_stats:
+                            widget.set_stats(*self._rule_stats[rule_id])
                         self.rule_widgets[rule_id] = widget
                     
                     # Create list item and add widget to it
@@ -2526,6 +2613,39 @@ class MainWindow(QMainWindow):
         self.close_behavior = "minimize" if self.close_to_tray_checkbox.isChecked() else "exit"
         self.save_settings() # Save setting immediately
 
+    def _handle_resolve_hostnames_change(self):
+        """Applies the hostname resolution setting to the engine, running or not."""
+        self.proxy_engine.resolve_hostnames = self.resolve_hostnames_checkbox.isChecked()
+        self.proxy_engine.schedule_pac_write()
+        self.save_settings()
+
+    def _handle_sni_routing_change(self):
+        """Applies the SNI routing setting to the engine, running or not."""
+        self.proxy_engine.sni_routing = self.sni_routing_checkbox.isChecked()
+        self.proxy_engine.schedule_pac_write()
+        self.save_settings()
+
+    def _handle_engine_backend_change(self):
+        """Selects the engine backend; a running engine keeps its current one until restarted."""
+        self.proxy_engine.backend = self.engine_backend_combo.currentData()
+        if self.proxy_engine.is_active:
+            self.show_status_message("Engine backend changes apply after the engine restarts.", 4000)
+        self.save_settings()
+
+    def _geo_database_paths(self) -> list:
+        return [path.strip() for path in self.geo_databases_edit.text().split(";") if path.strip()]
+
+    def _handle_geo_databases_change(self):
+        """Opens the geo databases entered in settings and hands them to the engine."""
+        if not self.geo_databases_edit.isModified():
+            return
+        self.geo_databases_edit.setModified(False)
+        if not self.proxy_engine.set_geo_databases(self._geo_database_paths()):
+            QMessageBox.warning(self, "Geo Databases", "Could not open the geo databases, see the logs for details.\n"
+                                "geo: and asn: rules keep using the previous databases.")
+            return
+        self.save_settings()
+
     def _handle_proxy_test_result(self, proxy_id: str, is_ok: bool):
         """Updates the status of a specific proxy item in the list."""
         if proxy_id in self.proxy_widgets:
@@ -2540,6 +2660,16 @@ class MainWindow(QMainWindow):
         else:
             print(f"[UI Update] Received test result for unknown/hidden proxy ID: {proxy_id}")
 
+    def _handle_rule_stats_updated(self, stats: dict):
+        """Updates the hit/traffic counters shown on the rule items."""
+        for rule_id, (hits, byte_count) in stats.items():
+            if self._rule_stats.get(rule_id) == (hits, byte_count):
+                continue
+            widget = self.rule_widgets.get(rule_id)
+            if widget:
+                widget.set_stats(hits, byte_count)
+        self._rule_stats = stats
+
     # Added method to show status messages
     def show_status_message(self, message: str, timeout: int = 4000):
         """Displays a message in the status bar for a specified timeout."""
@@ -2801,8 +2931,8 @@ class MainWindow(QMainWindow):
             # Wait a brief moment to ensure all connections are properly closed
             QTimer.singleShot(100, lambda: self._restart_engine_with_new_profile())
         else:
-            # If engine wasn't active, just update the configuration
-            self.proxy_engine.update_config(self.rules, self.proxies, self._current_active_profile_id)
+            # If engine wasn't active, just switch its rules (start() syncs edits made meanwhile)
+            self.proxy_engine.set_active_profile(self._current_active_profile_id)
 
         # --- Update UI ---
         # Rules display doesn't change when switching profiles since we show all rules
@@ -2824,8 +2954,8 @@ class MainWindow(QMainWindow):
 
     def _restart_engine_with_new_profile(self):
         """Helper method to restart the engine with the current active profile after stopping it."""
-        # Update the engine with the new profile's rules
-        self.proxy_engine.update_config(self.rules, self.proxies, self._current_active_profile_id)
+        # Switch the engine to the new profile's rules, which it has kept up to date while running
+        self.proxy_engine.set_active_profile(self._current_active_profile_id)
         # Start the engine again
         self.proxy_engine.start()
         # Update system proxy settings if enabled
@@ -3063,6 +3193,8 @@ class MainWindow(QMainWindow):
                 profile_id = rule_data.get('profile_id')
                 if profile_id and profile_id in self.profiles:
                     search_string += self.profiles[profile_id].get('name', '').lower() + " "
+                elif profile_id == GLOBAL_PROFILE_ID:
+                    search_string += GLOBAL_PROFILE_NAME.lower() + " "
                 
                 # Check if the filter text is in the search string
                 # If no filter text, show everything
@@ -3327,6 +3459,11 @@ class MainWindow(QMainWindow):
             self.apply_theme('dark')
             self.close_to_tray_checkbox.setChecked(True) # Default to minimize
             self.start_engine_checkbox.setChecked(False) # Default to off
+            self.resolve_hostnames_checkbox.setChecked(False)
+            self.sni_routing_checkbox.setChecked(False)
+            self.engine_backend_combo.setCurrentIndex(0) # Threads
+            self.geo_databases_edit.clear()
+            self.proxy_engine.set_geo_databases([])
             if IS_WINDOWS:
                 self.enable_system_proxy_checkbox.setChecked(False)
             self.toggle_hotkey_edit.clear()
@@ -3416,6 +3553,10 @@ class MainWindow(QMainWindow):
             QTimer.singleShot(50, lambda: self.show_status_message(f"Rule added for '{domain}'"))
             rule_id_to_scroll = new_rule_id
 
+        # Update engine if running; it applies global, active-profile and moved rules to the right matcher
+        if self.proxy_engine.is_active:
+            self.proxy_engine.add_rule(rule_id_to_scroll, self.rules[rule_id_to_scroll])
+
         # Debounce populate/save/scroll
         self._rebuild_rule_list_safely() # Handles populate, filter, counts
         self.save_settings() # Save changes
@@ -3745,6 +3886,8 @@ class MainWindow(QMainWindow):
                     widget.edit_rule.connect(self._show_edit_rule_editor)
                     widget.delete_rule.connect(self._delete_rule_entry)
                     widget.toggle_enabled.connect(self._toggle_rule_enabled)
+                    if rule_id in self._rule_stats:
+                        widget.set_stats(*self._rule_stats[rule_id])
                     self.rule_widgets[rule_id] = widget
                     
                     # Create list item and add widget to it
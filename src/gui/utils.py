@@ -7,6 +7,7 @@ import os
 import re
 
 CHEVRON_DOWN_ICON_PATH = "src/assets/icons/chevron_down.svg"
+GLOBAL_PROFILE_NAME = "All Profiles (Global)" # Display name of the global rules (GLOBAL_PROFILE_ID)
 
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -46,6 +47,14 @@ def generate_color_from_id(id_str: str, saturation: float = 0.7, lightness: floa
     color.setHslF(hue / 360.0, saturation, lightness)
     return color
 
+def format_byte_count(byte_count: int) -> str:
+    """Formats a byte count for display, e.g. 1536 -> '1.5 KB'."""
+    value = float(byte_count)
+    for unit in ("B", "KB", "MB", "GB"):
+        if value < 1024 or unit == "GB":
+            return f"{value:.0f} {unit}" if unit == "B" else f"{value:.1f} {unit}"
+        value /= 1024
+
 # --- SVG Loading/Coloring Functions (Consolidated Here) ---
 
 def load_and_colorize_svg_content(icon_path: str, color: str) -> bytes:
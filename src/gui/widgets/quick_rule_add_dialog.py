@@ -10,6 +10,12 @@ import time
 import platform
 import ipaddress # For IP validation
 
+from ...core.geo_db import parse_geo_target # geo:XX / asn:N rule targets
+from ...core.hostnames import normalize_rule_target # IDN targets are validated in punycode
+from ...core.ip_radix import parse_ip_target # CIDR / range rule targets
+from ...core.rule_matcher import GLOBAL_PROFILE_ID # Rules that apply in every profile
+from ..utils import GLOBAL_PROFILE_NAME
+
 # Assuming utils provides validation or other helpers if needed
 # from ..utils import some_validation_function
 
@@ -48,7 +54,7 @@ class QuickRuleAddDialog(QDialog):
         domain_label = QLabel("Domain/IP:")
         domain_label.setFixedWidth(60)
         self.domain_input = QLineEdit()
-        self.domain_input.setPlaceholderText("e.g., example.com, *.net, 1.1.1.1")
+        self.domain_input.setPlaceholderText("e.g., example.com, *.net, 1.1.1.1, 10.0.0.0/8")
         if initial_domain:
             self.domain_input.setText(initial_domain)
         domain_layout.addWidget(domain_label)
@@ -148,6 +154,7 @@ class QuickRuleAddDialog(QDialog):
         for profile_id, profile_data in sorted_profiles:
             name = profile_data.get('name', f"Profile {profile_id[:6]}...")
             self.profile_combo.addItem(name, profile_id) # User data is profile_id
+        self.profile_combo.addItem(GLOBAL_PROFILE_NAME, GLOBAL_PROFILE_ID) # Applies in every profile
 
         # Select the first profile by default if none was pre-selected in __init__
         if self.profile_combo.currentIndex() == -1:
@@ -156,6 +163,8 @@ class QuickRuleAddDialog(QDialog):
     def _is_valid_domain_or_ip(self, value: str) -> bool:
         """Checks if a string is a valid domain name (allowing wildcard start) or a valid IP address."""
         if not value: return False
+        value = normalize_rule_target(value) # Internationalized names are checked in their punycode form
+        if not value: return False
 
         # 1. Check for valid IP address (IPv4 or IPv6)
         try:
@@ -165,7 +174,15 @@ class QuickRuleAddDialog(QDialog):
                  return False
             return True # It's a valid IP
         except ValueError:
-            pass # Not a valid IP, proceed to domain check
+            pass # Not a valid IP, proceed to CIDR / range check
+
+        # CIDR blocks and IP ranges
+        if parse_ip_target(value) is not None:
+            return True
+
+        # Country and AS number targets (geo:DE, asn:13335)
+        if parse_geo_target(value.lower()) is not None:
+            return True
 
         # 2. Check for valid domain name (reuse RuleEditWidget logic for consistency)
         pattern = r"^(\*\.)?([a-zA-Z0-9](?:[a-zA-Z0-9\-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z]{2,}$"
@@ -181,13 +198,9 @@ class QuickRuleAddDialog(QDialog):
         # Remove protocol, path, port
         if entry.startswith("http://"): entry = entry[7:]
         if entry.startswith("https://"): entry = entry[8:]
-        entry = entry.split('/')[0].split(':')[0]
-        is_ip = False
-        try:
-            ipaddress.ip_address(entry)
-            is_ip = True
-        except Exception:
-            is_ip = False
+        if parse_ip_target(entry) is None and parse_geo_target(entry.lower()) is None:
+            entry = entry.split('/')[0].split(':')[0]
+        is_ip = parse_ip_target(entry) is not None or parse_geo_target(entry.lower()) is not None
         self.port_label.setVisible(is_ip)
         self.port_input.setVisible(is_ip)
         self.port_input.setEnabled(is_ip)
@@ -201,10 +214,13 @@ class QuickRuleAddDialog(QDialog):
         # Basic cleanup: remove http(s):// prefix if present
         if entry_raw.startswith("http://"): entry_raw = entry_raw[7:]
         if entry_raw.startswith("https://"): entry_raw = entry_raw[8:]
-        # Remove trailing slashes or paths
-        entry_raw = entry_raw.split('/')[0]
-        # Remove port number
-        entry = entry_raw.split(':')[0].lower() # Use lower case
+        if parse_ip_target(entry_raw) is not None or parse_geo_target(entry_raw.lower()) is not None:
+            entry = entry_raw.lower() # IP, CIDR block, range or geo target, kept whole
+        else:
+            # Remove trailing slashes or paths
+            entry_raw = entry_raw.split('/')[0]
+            # Remove port number
+            entry = entry_raw.split(':')[0].lower() # Use lower case
         port_text = self.port_input.text().strip()
         port = None
         if port_text:
@@ -228,7 +244,8 @@ class QuickRuleAddDialog(QDialog):
         selected_proxy_id = self.proxy_combo.currentData() # Returns data (ID or None)
         selected_profile_id = self.profile_combo.currentData() # Returns data (ID)
 
-        if selected_profile_id is None or selected_profile_id not in self.available_profiles:
+        if selected_profile_id is None or (selected_profile_id not in self.available_profiles
+                                           and selected_profile_id != GLOBAL_PROFILE_ID):
              QMessageBox.warning(self, "Invalid Profile", "Please select a valid profile.")
              self.profile_combo.setFocus()
              return
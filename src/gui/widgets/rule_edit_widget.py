@@ -6,6 +6,12 @@ from PySide6.QtCore import Qt, Signal
 import re # For domain validation
 import ipaddress # For IP validation
 
+from ...core.geo_db import parse_geo_target # geo:XX / asn:N rule targets
+from ...core.hostnames import normalize_rule_target # IDN targets are validated in punycode
+from ...core.ip_radix import parse_ip_target # CIDR / range rule targets
+from ...core.rule_matcher import GLOBAL_PROFILE_ID # Rules that apply in every profile
+from ..utils import GLOBAL_PROFILE_NAME
+
 class RuleEditWidget(QFrame):
     """Widget for adding or editing domain routing rules."""
     # Change signal back
@@ -55,6 +61,8 @@ class RuleEditWidget(QFrame):
             "  1.2.3.4:443   (single port)\n"
             "  1.2.3.4:443-500   (port range)\n"
             "  1.2.3.4   (all ports)\n"
+            "  10.0.0.0/8   (CIDR block)\n"
+            "  10.0.0.1-10.0.0.50:443   (IP range, single port)\n"
             "(Note: Editing affects first entry only)"
         )
         self.domain_input.setAcceptRichText(False)
@@ -110,6 +118,8 @@ class RuleEditWidget(QFrame):
     def _is_valid_domain_or_ip(self, value: str) -> bool:
         """Checks if a string is a valid domain name (allowing wildcard start) or a valid IP address."""
         if not value: return False
+        value = normalize_rule_target(value) # Internationalized names are checked in their punycode form
+        if not value: return False
 
         # 1. Check for valid IP address (IPv4 or IPv6)
         try:
@@ -119,7 +129,15 @@ class RuleEditWidget(QFrame):
                  return False
             return True # It's a valid IP
         except ValueError:
-            pass # Not a valid IP, proceed to domain check
+            pass # Not a valid IP, proceed to CIDR / range check
+
+        # CIDR blocks (10.0.0.0/8, 2001:db8::/32) and ranges (10.0.0.1-10.0.0.50)
+        if parse_ip_target(value) is not None:
+            return True
+
+        # Country and AS number targets (geo:DE, asn:13335)
+        if parse_geo_target(value.lower()) is not None:
+            return True
 
         # 2. Check for valid domain name (allowing wildcard start)
         # Allow *. at the start, then standard domain characters
@@ -156,13 +174,20 @@ class RuleEditWidget(QFrame):
             # Basic cleanup: remove http(s):// prefix if present
             if entry.startswith("http://"): entry = entry[7:]
             if entry.startswith("https://"): entry = entry[8:]
-            # Remove trailing slashes or paths
-            entry = entry.split('/')[0]
             # Parse IP:port or IP:port-range
             domain_part = entry
             port_part = None
-            if ':' in entry:
-                domain_part, port_part = entry.split(':', 1)
+            if parse_ip_target(entry) is None and parse_geo_target(entry.lower()) is None:
+                head, sep, tail = entry.rpartition(':')
+                if sep and (parse_ip_target(head) is not None or parse_geo_target(head.lower()) is not None):
+                    # CIDR / range / IPv6 / geo target followed by a port
+                    domain_part, port_part = head, tail
+                else:
+                    # Remove trailing slashes or paths
+                    entry = entry.split('/')[0]
+                    domain_part = entry
+                    if ':' in entry:
+                        domain_part, port_part = entry.split(':', 1)
             # Validate domain or IP
             if self._is_valid_domain_or_ip(domain_part):
                 # Validate port/port range if present
@@ -250,6 +275,7 @@ class RuleEditWidget(QFrame):
             name = profile_data.get('name', f"Profile {profile_id[:6]}...")
             print(f"[RuleEditWidget] Adding profile item: '{name}' (Data: {profile_id})") # Debug print
             self.profile_combo.addItem(name, profile_id)
+        self.profile_combo.addItem(GLOBAL_PROFILE_NAME, GLOBAL_PROFILE_ID) # Last, so new rules still default to a profile
 
         index_to_select = self.profile_combo.findData(current_data)
         if index_to_select == -1: # If current data not found or was None
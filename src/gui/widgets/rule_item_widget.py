@@ -18,6 +18,7 @@ from PySide6.QtCore import Qt
 # Ensure utils is imported relatively
 from ..utils import generate_color_from_id # We don't need get_contrasting_text_color anymore
 from ..utils import load_and_colorize_svg_content, create_icon_from_svg_data # <<< Already relative, ensure it stays this way
+from ..utils import format_byte_count
 
 # Assume you have icons for edit/delete in src/assets/icons/
 EDIT_ICON_PATH = "src/assets/icons/edit.svg" # Replace with actual path
@@ -104,8 +105,14 @@ class RuleItemWidget(QFrame):
         self.profile_label.setObjectName("RuleItemProfileLabel") # Different style?
         self.profile_label.setAlignment(Qt.AlignmentFlag.AlignRight)
 
+        self.stats_label = QLabel() # Hits/traffic while the engine runs, see set_stats
+        self.stats_label.setObjectName("RuleStatsLabel")
+        self.stats_label.setStyleSheet("font-size: 11px;")
+        self.stats_label.hide() # Shown once the rule has matched
+
         sub_info_layout.addWidget(self.proxy_label)
         sub_info_layout.addWidget(self.profile_label)
+        sub_info_layout.addWidget(self.stats_label)
         sub_info_layout.addStretch() # Push info to the left
 
         info_layout.addWidget(self.domain_label)
@@ -249,6 +256,12 @@ class RuleItemWidget(QFrame):
         # Ensure the checkbox repaints if needed
         self.enable_checkbox.update()
 
+    def set_stats(self, hits: int, byte_count: int):
+        """Shows how often the rule matched and how much traffic it routed."""
+        self.stats_label.setText(f"{hits} hits · {format_byte_count(byte_count)}")
+        self.stats_label.setToolTip(f"Matched {hits} times, {byte_count} bytes relayed")
+        self.stats_label.show()
+
     def _on_edit(self):
         self.edit_rule.emit(self.rule_id)
 
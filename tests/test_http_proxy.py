@@ -0,0 +1,90 @@
+"""HTTP/1.x message framing of the plain-HTTP proxy loop."""
+import pytest
+
+from src.core.http_proxy import (BodyFramer, HTTPParseError, parse_request_head, parse_response_head,
+                                 request_body, response_body)
+
+
+def feed_all(framer: BodyFramer, data: bytes, step: int | None = None) -> int:
+    """Feeds data in pieces of step bytes (all at once without) until the body is done."""
+    step = step or len(data) or 1
+    consumed = 0
+    while consumed < len(data) and not framer.done:
+        piece = data[consumed:consumed + step]
+        count = framer.feed(piece)
+        assert 0 <= count <= len(piece)
+        consumed += count
+        if count < len(piece):
+            break
+    return consumed
+
+
+def test_content_length():
+    framer = BodyFramer(BodyFramer.LENGTH, 5)
+    assert framer.feed(b"hel") == 3 and not framer.done
+    assert framer.feed(b"loGET / HTTP/1.1") == 2 and framer.done
+    assert framer.feed(b"more") == 0
+    assert BodyFramer(BodyFramer.LENGTH, 0).done
+
+
+CHUNKED = b"5\r\nhello\r\n6;name=value\r\n world\r\nA\r\n0123456789\r\n0\r\nExpires: never\r\nX-Sum: 1\r\n\r\n"
+
+
+@pytest.mark.parametrize("step", [None, 1, 2, 3, 7])
+def test_chunked_with_trailers(step):
+    framer = BodyFramer(BodyFramer.CHUNKED)
+    assert feed_all(framer, CHUNKED + b"GET /next HTTP/1.1\r\n", step) == len(CHUNKED)
+    assert framer.done
+
+
+def test_chunked_without_trailers():
+    framer = BodyFramer(BodyFramer.CHUNKED)
+    assert framer.feed(b"3\r\nabc\r\n0\r\n\r\nnext") == 13 and framer.done
+
+
+@pytest.mark.parametrize("body", [b"zz\r\n", b"3\r\nabcX\r\n", b"1" * 9000])
+def test_chunked_errors(body):
+    with pytest.raises(HTTPParseError):
+        BodyFramer(BodyFramer.CHUNKED).feed(body)
+
+
+def test_until_close():
+    framer = BodyFramer(BodyFramer.UNTIL_CLOSE)
+    assert framer.feed(b"anything") == 8 and not framer.done
+    framer.finish()
+    assert framer.done
+
+
+def test_closed_mid_body():
+    framer = BodyFramer(BodyFramer.LENGTH, 10)
+    framer.feed(b"12345")
+    with pytest.raises(HTTPParseError):
+        framer.finish()
+    chunked = BodyFramer(BodyFramer.CHUNKED)
+    chunked.feed(b"5\r\nab")
+    with pytest.raises(HTTPParseError):
+        chunked.finish()
+
+
+def test_request_framing():
+    head = parse_request_head(b"POST http://h/ HTTP/1.1\r\nHost: h\r\nContent-Length: 3\r\n\r\n")
+    framer = request_body(head)
+    assert (framer.kind, framer.remaining) == (BodyFramer.LENGTH, 3)
+    head = parse_request_head(b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip, chunked\r\nContent-Length: 3\r\n\r\n")
+    assert request_body(head).kind == BodyFramer.CHUNKED
+    assert request_body(parse_request_head(b"get / HTTP/1.1\r\n\r\n")).done
+    with pytest.raises(HTTPParseError):
+        request_body(parse_request_head(b"POST / HTTP/1.1\r\nContent-Length: 3, 4\r\n\r\n"))
+    with pytest.raises(HTTPParseError):
+        request_body(parse_request_head(b"POST / HTTP/1.1\r\nTransfer-Encoding: gzip\r\n\r\n"))
+
+
+def test_response_framing():
+    ok = parse_response_head(b"HTTP/1.1 200 OK\r\nContent-Length: 8\r\n\r\n")
+    assert response_body(ok, "GET").remaining == 8
+    assert response_body(ok, "HEAD").done
+    assert response_body(parse_response_head(b"HTTP/1.1 204 No Content\r\n\r\n"), "GET").done
+    assert response_body(parse_response_head(b"HTTP/1.1 304 Not Modified\r\nContent-Length: 8\r\n\r\n"), "GET").done
+    assert response_body(parse_response_head(b"HTTP/1.1 200 OK\r\n\r\n"), "GET").kind == BodyFramer.UNTIL_CLOSE
+    chunked = parse_response_head(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+    assert response_body(chunked, "GET").kind == BodyFramer.CHUNKED
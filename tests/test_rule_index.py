@@ -0,0 +1,150 @@
+"""Rule index files: written from a compiled rule set, mapped back and matched in place."""
+import functools
+import os
+
+import pytest
+
+from src.core import rule_index, rule_matcher
+from src.core.rule_index import INDEX_VERSION, RuleIndex, index_file, rules_digest
+from src.core.rule_matcher import CompileReport, CompiledRules, RuleMatcher
+
+RULES = {
+    "exact": {"domain": "example.com", "proxy_id": "A", "enabled": True},
+    "exact-port": {"domain": "example.com", "proxy_id": "B", "enabled": True, "port": "8080"},
+    "wildcard": {"domain": "*.example.com", "proxy_id": "A", "enabled": True},
+    "covered": {"domain": "www.example.com", "proxy_id": "A", "enabled": True}, # Pruned, covered by 'wildcard'
+    "deep": {"domain": "*.deep.example.com", "proxy_id": "C", "enabled": True},
+    "range": {"domain": "*.ports.test", "proxy_id": "D", "enabled": True, "port": "80-90"},
+    "glob": {"domain": "cdn-?.*.net", "proxy_id": "E", "enabled": True},
+    "disabled": {"domain": "off.test", "proxy_id": "F", "enabled": False},
+    "block": {"domain": "ads.test", "proxy_id": "__BLOCK__", "enabled": True},
+    "net": {"domain": "10.0.0.0/8", "proxy_id": "G", "enabled": True},
+    "host": {"domain": "10.1.2.3", "proxy_id": "G", "enabled": True}, # Pruned, covered by 'net'
+    "subnet": {"domain": "10.1.0.0/16", "proxy_id": "H", "enabled": True, "port": "443"},
+    "ip-range": {"domain": "192.168.1.10-192.168.1.20", "proxy_id": "I", "enabled": True},
+    "ipv6": {"domain": "2001:db8::/32", "proxy_id": "J", "enabled": True},
+}
+LOOKUPS = [
+    ("example.com", 443), ("example.com", 8080), ("example.com", None), ("www.example.com", 443),
+    ("a.b.example.com", 80), ("x.deep.example.com", 443), ("deep.example.com", 443),
+    ("www.ports.test", 85), ("www.ports.test", 91), ("cdn-1.edge.net", 443), ("cdn-12.edge.net", 443),
+    ("off.test", 443), ("ads.test", 443), ("unknown.org", 443), ("10.1.2.3", 443), ("10.1.2.3", 80),
+    ("10.200.0.1", 22), ("11.0.0.1", 443), ("192.168.1.15", 443), ("192.168.1.21", 443),
+    ("2001:db8::1", 443), ("2001:db9::1", 443),
+]
+
+
+def _matcher(rules: dict, index_path: str | None = None) -> RuleMatcher:
+    matcher = RuleMatcher()
+    matcher.update_rules(rules, index_path)
+    return matcher
+
+
+def test_round_trip_matches_in_memory_build(tmp_path):
+    base = str(tmp_path / "rules-P.idx")
+    memory = _matcher(RULES)
+    _matcher(RULES, base) # Compiles and writes the index
+    digest = rules_digest(RULES)
+    path = index_file(base, digest)
+    assert os.path.exists(path)
+
+    indexed = _matcher(RULES, base)
+    assert indexed._slot_rules is None # Served from the index, nothing compiled
+    for host, port in LOOKUPS:
+        assert indexed.match(host, port) == memory.match(host, port), (host, port)
+    assert indexed.match("www.example.com", 443) == ("A", "covered")
+    assert indexed.match("10.1.2.3", 80) == ("G", "host")
+
+
+def test_round_trip_with_domain_filter(tmp_path, monkeypatch):
+    monkeypatch.setattr(rule_matcher, "write_rule_index",
+                        functools.partial(rule_index.write_rule_index, filter_min_keys=1))
+    rules = dict(RULES)
+    rules.update({f"bulk{i}": {"domain": f"host{i}.bulk.test", "proxy_id": "K", "enabled": True} for i in range(500)})
+    base = str(tmp_path / "rules-P.idx")
+    _matcher(rules, base)
+    indexed, memory = _matcher(rules, base), _matcher(rules)
+
+    index = RuleIndex.open(index_file(base, rules_digest(rules)), rules_digest(rules))
+    assert index is not None and index.domain_filter is not None
+    assert all(index.may_contain(f"host{i}.bulk.test") for i in range(500))
+    for host, port in LOOKUPS + [(f"host{i}.bulk.test", 443) for i in range(0, 600, 7)]:
+        assert indexed.match(host, port) == memory.match(host, port), (host, port)
+
+
+def test_snapshot_write_and_open(tmp_path):
+    compiled, slot_rules = CompiledRules.build(RULES, 1)
+    digest = rules_digest(RULES)
+    path = str(tmp_path / "direct.idx")
+    size = compiled.write_index(path, digest, slot_rules, RULES)
+    assert size == os.path.getsize(path)
+
+    index = RuleIndex.open(path, digest)
+    assert index is not None
+    assert index.kind_counts == compiled.kind_counts
+    served = CompiledRules.from_index(index, 2)
+    for host, port in LOOKUPS:
+        target = host.lower()
+        assert served.match(target, port) == compiled.match(target, port), (host, port)
+
+
+def test_pruned_build_writes_full_slots(tmp_path):
+    report = CompileReport()
+    compiled, slot_rules = CompiledRules.build(RULES, 1, report)
+    assert report.pruned_entries
+    digest = rules_digest(RULES)
+    path = str(tmp_path / "pruned.idx")
+    compiled.write_index(path, digest, slot_rules, RULES, report.pruned_slots)
+    served = CompiledRules.from_index(RuleIndex.open(path, digest), 2)
+    unpruned, _ = CompiledRules.build(RULES, 1)
+    for host, port in LOOKUPS:
+        target = host.lower()
+        assert served.match(target, port) == unpruned.match(target, port), (host, port)
+
+
+@pytest.fixture
+def written_index(tmp_path):
+    compiled, slot_rules = CompiledRules.build(RULES, 1)
+    digest = rules_digest(RULES)
+    path = str(tmp_path / "rules.idx")
+    compiled.write_index(path, digest, slot_rules, RULES)
+    return path, digest
+
+
+def test_wrong_digest_is_rejected(written_index):
+    path, digest = written_index
+    assert RuleIndex.open(path, rules_digest({"other": RULES["exact"]})) is None
+    assert RuleIndex.open(path, digest) is not None
+
+
+def test_stale_version_is_rejected(written_index):
+    path, digest = written_index
+    with open(path, "r+b") as f:
+        f.seek(8) # Version follows the magic
+        f.write((INDEX_VERSION - 1).to_bytes(2, "little"))
+    assert RuleIndex.open(path, digest) is None
+
+
+@pytest.mark.parametrize("damage", ["magic", "truncated", "short", "missing"])
+def test_corrupt_file_is_rejected(written_index, damage):
+    path, digest = written_index
+    data = open(path, "rb").read()
+    if damage == "missing":
+        os.remove(path)
+    else:
+        data = {"magic": b"XXXXXXXX" + data[8:], "truncated": data[:len(data) - 2], "short": data[:40]}[damage]
+        with open(path, "wb") as f:
+            f.write(data)
+    assert RuleIndex.open(path, digest) is None
+
+
+def test_rejected_index_is_rebuilt(tmp_path):
+    base = str(tmp_path / "rules-P.idx")
+    _matcher(RULES, base)
+    path = index_file(base, rules_digest(RULES))
+    with open(path, "r+b") as f:
+        f.write(b"XXXXXXXX")
+    matcher = _matcher(RULES, base)
+    assert matcher._slot_rules is not None # Compiled again
+    assert RuleIndex.open(path, rules_digest(RULES)) is not None
+    assert matcher.match("www.example.com", 443) == ("A", "covered")
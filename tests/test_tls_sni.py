@@ -0,0 +1,80 @@
+"""ClientHello server name reader, whole and cut at every byte."""
+import struct
+
+from src.core.tls_sni import client_hello_length, parse_sni
+
+
+def _extension(kind: int, body: bytes) -> bytes:
+    return struct.pack(">HH", kind, len(body)) + body
+
+
+def _server_name(*names: tuple) -> bytes:
+    entries = b"".join(struct.pack(">BH", name_type, len(name)) + name for name_type, name in names)
+    return _extension(0x0000, struct.pack(">H", len(entries)) + entries)
+
+
+def client_hello(*extensions: bytes, session_id: bytes = b"\x11" * 32) -> bytes:
+    """A TLS 1.2-style ClientHello record carrying the given extensions."""
+    ciphers = b"\x13\x01\x13\x02\xc0\x2f"
+    body = (b"\x03\x03" + b"\x00" * 32 + bytes([len(session_id)]) + session_id
+            + struct.pack(">H", len(ciphers)) + ciphers + b"\x01\x00")
+    extensions = b"".join(extensions)
+    body += struct.pack(">H", len(extensions)) + extensions
+    handshake = b"\x01" + len(body).to_bytes(3, "big") + body
+    return b"\x16\x03\x01" + struct.pack(">H", len(handshake)) + handshake
+
+
+HELLO = client_hello(_extension(0x000a, b"\x00\x02\x00\x1d"), _server_name((0, b"www.example.com")),
+                     _extension(0x0010, b"\x00\x03\x02h2"))
+
+
+def test_server_name():
+    assert parse_sni(HELLO) == "www.example.com"
+    assert parse_sni(memoryview(HELLO)) == "www.example.com"
+    assert client_hello_length(HELLO) == len(HELLO)
+
+
+def test_no_server_name():
+    assert parse_sni(client_hello(_extension(0x000a, b"\x00\x02\x00\x1d"))) is None
+    assert parse_sni(client_hello()) is None
+    assert parse_sni(client_hello(_server_name((1, b"not-a-host"), (0, b"second.test")))) == "second.test"
+
+
+def test_not_a_client_hello():
+    assert parse_sni(b"GET / HTTP/1.1\r\n\r\n") is None
+    assert client_hello_length(b"GET / HTTP/1.1\r\n\r\n") is None
+    assert client_hello_length(b"") is None
+    server_hello = HELLO[:5] + b"\x02" + HELLO[6:]
+    assert parse_sni(server_hello) is None
+
+
+def test_truncated_hello():
+    """Every prefix either yields the name or None, never an exception or a wrong name."""
+    for cut in range(len(HELLO)):
+        assert parse_sni(HELLO[:cut]) in (None, "www.example.com"), cut
+    name_end = HELLO.index(b"www.example.com") + len("www.example.com")
+    assert parse_sni(HELLO[:name_end - 1]) is None
+    assert parse_sni(HELLO[:name_end]) == "www.example.com"
+
+
+def test_fragmented_hello():
+    """A hello arriving in pieces is complete once client_hello_length bytes are buffered."""
+    buffer = b""
+    for position in range(0, len(HELLO), 7):
+        buffer += HELLO[position:position + 7]
+        needed = client_hello_length(buffer)
+        assert needed is not None
+        if len(buffer) >= needed:
+            break
+    assert len(buffer) == len(HELLO)
+    assert client_hello_length(HELLO[:3]) == 5
+    assert parse_sni(buffer) == "www.example.com"
+
+
+def test_lengths_past_the_record():
+    """Length fields pointing beyond the record are not followed."""
+    record_length = struct.unpack(">H", HELLO[3:5])[0]
+    short_record = HELLO[:3] + struct.pack(">H", record_length - 20) + HELLO[5:]
+    assert parse_sni(short_record) is None
+    oversized = client_hello(b"\x00\x00\xff\xff\x00\xfe\x00\x00\x05abc")
+    assert parse_sni(oversized) is None